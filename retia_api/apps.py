@@ -1,12 +1,25 @@
+import sys
+from pathlib import Path
+
 from django.apps import AppConfig
 
 from retia_api.configurations import settings
 from retia_api.configurations.scheduler import scheduler
 
 
+def management_command() -> bool:
+    # manage.py commands other than runserver, the detector worker included,
+    # start the scheduler themselves if at all
+    return Path(sys.argv[0]).name == "manage.py" and sys.argv[1:2] != ["runserver"]
+
+
 class RetiaApiConfig(AppConfig):
     name = "retia_api"
 
     def ready(self):
-        if settings.SCHEDULER_AUTOSTART:
+        if settings.SCHEDULER_AUTOSTART and not management_command():
             scheduler.start()
+            # Detector jobs are sharded over the processes heartbeating
+            from retia_api.helpers.jobs import start_scheduling
+
+            start_scheduling()
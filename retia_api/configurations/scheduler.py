@@ -1,10 +1,18 @@
 import logging
 
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 
 from retia_api.configurations import settings
 
-scheduler = BackgroundScheduler()
+# Heartbeats get a thread of their own, detector ticks filling the default
+# pool must not let this node's membership lapse
+scheduler = BackgroundScheduler(
+    executors={
+        "default": ThreadPoolExecutor(settings.DETECTOR_MAX_CONCURRENT_JOBS),
+        "heartbeat": ThreadPoolExecutor(1),
+    }
+)
 
 
 def start():
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from datetime import timedelta
 from pathlib import Path
 
@@ -150,7 +151,77 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
-SCHEDULER_AUTOSTART = True
+# Detection runs in `manage.py detector_worker`. Also running it inside the
+# web server is for single-process setups, management commands never do.
+SCHEDULER_AUTOSTART = False
+# Seconds an engine node stays in the membership without heartbeating, nodes
+# heartbeat three times per period. The running detectors are sharded over
+# the live nodes, the shard of a silent node moves to the others once it
+# lapses.
+ENGINE_HEARTBEAT_SECONDS = 30
+# Port of the detector worker's /metrics and /detector/<device>/latency and
+# /ticks endpoints, 0 disables them
+DETECTOR_WORKER_METRICS_PORT = 9464
+
+# Evaluate every detector sharing a sampling interval in one batched job
+DETECTOR_FLEET_MODE = False
+
+# Fire detector ticks on Elasticsearch bucket boundaries plus an ingest grace
+# in seconds and only read the buckets closed by then
+DETECTOR_ALIGNED_TICKS = False
+DETECTOR_INGEST_GRACE = 5
+
+# Spread the ticks of detectors sharing a sampling interval over the interval
+# by a hash of their device, plus up to DETECTOR_TICK_JITTER random seconds
+DETECTOR_STAGGER_TICKS = True
+DETECTOR_TICK_JITTER = 0
+# Detector jobs running at once, later ticks wait for a free slot
+DETECTOR_MAX_CONCURRENT_JOBS = 10
+
+# Seconds a detector tick may spend in a stage before it gives up on the tick,
+# stages missing here are unbounded
+DETECTOR_STAGE_DEADLINES = {"fetch": 15, "attribution": 5}
+
+# Backfill window_size buckets from Elasticsearch before a detector's first tick
+DETECTOR_WARM_START = True
+
+# Run detection kernels in the calling scheduler thread ("thread") or in a
+# pool of worker processes ("process") to keep them off the API's GIL
+DETECTOR_EXECUTION = "thread"
+DETECTOR_WORKERS = os.cpu_count()
+# Times a call is retried on a fresh pool after a worker crashed
+DETECTOR_WORKER_RETRIES = 1
+
+# Directory of the memory-mapped history ring files, one per detector and
+# resolution, kept in memory only when None. Workers write the rings of their
+# own shard and the API reads them, so with several engine nodes this has to
+# be a directory shared by all of them. DETECTOR_HISTORY_LENGTH is the
+# evaluated buckets kept when a detector sets no history_length.
+DETECTOR_HISTORY_DIR = BASE_DIR / "retia_api/databases/history"
+DETECTOR_HISTORY_LENGTH = 4320
+
+# Seconds of netflow history fetched by a parameter sweep unless requested
+DETECTOR_SWEEP_DURATION = 86400
+
+# Netflow field naming the exporting router, e.g. "observer.ip". When set,
+# fleet detectors sharing an index are fetched with one search split by this
+# field and matched on their device management address.
+DETECTOR_EXPORTER_FIELD = None
+
+# Screen detectors on the SNMP interface counters in Prometheus first and only
+# query Elasticsearch for those whose counters look suspicious
+DETECTOR_COUNTER_SCREEN = False
+PROMETHEUS_URL = "http://localhost:9090"
+PROMETHEUS_INTERFACE_LABEL = "ifDescr"
+# Let generated Prometheus recording rules keep the rolling counter statistics
+# of every detector instead of stepping the windows in the engine
+DETECTOR_COUNTER_RULES = False
+
+# Also judge the traffic of every destination on its own, per address (32) or
+# per prefix of this length, with one paged composite aggregation per tick.
+# At most DETECTOR_DESTINATION_LIMIT destinations are tracked per detector.
+DETECTOR_DESTINATION_PREFIX = None
+DETECTOR_DESTINATION_LIMIT = 4096
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
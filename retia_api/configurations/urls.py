@@ -47,6 +47,8 @@ urlpatterns = [
     path("detector/<str:device>", detector_detail),
     path("detector/<str:device>/sync", detector_sync),
     path("detector/<str:device>/run", detector_run),
+    path("detector/<str:device>/history", detector_history),
+    path("detector/<str:device>/sweep", detector_sweep),
     path("monitoring/buildinfo", monitoring_buildinfo),
     path("log/activity", log_activity),
     path("api/token", TokenObtainPairView.as_view(), name="token_obtain_pair"),
@@ -4,22 +4,27 @@ from threading import Thread
 import netifaces as ni
 import tzlocal
 import yaml
-from apscheduler.triggers.interval import IntervalTrigger
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from retia_api.configurations.scheduler import scheduler
+from retia_api.configurations import settings
 from retia_api.databases.models import ActivityLog, Detector, Device
-from retia_api.helpers.elasticclient import get_netflow_resampled
+from retia_api.helpers.elasticclient import MAX_BUCKETS, get_netflow_history
+from retia_api.helpers.features import feature_matrix, parse_buckets
+from retia_api.helpers.history import drop_history, history_response
+from retia_api.helpers.jobs import start_detector, stop_detector
 from retia_api.helpers.logging import activity_log
 from retia_api.helpers.operation import *
+from retia_api.helpers.recording import write_recording_rules
 from retia_api.helpers.serializers import (
     ActivityLogSerializer,
     DetectorSerializer,
     DeviceSerializer,
 )
-from retia_api.nescient import core
+from retia_api.helpers.sweep import rank, sweep
+from retia_api.helpers.thresholds import BETA_STEP, INITIAL_BETA
+from retia_api.nescient import read_detector_history
 
 
 @api_view(["GET", "POST"])
@@ -251,6 +256,7 @@ def device_detail(request, hostname):
                 with open("./prometheus/prometheus.yml", "w") as f:
                     yaml.safe_dump(prometheus_config, stream=f)
                 requests.post(url="http://localhost:9090/-/reload")
+                write_recording_rules()
 
             response_body = {
                 "code": {
@@ -293,6 +299,7 @@ def device_detail(request, hostname):
                 requests.post(url="http://localhost:9090/-/reload")
 
         device.delete()
+        write_recording_rules()
         activity_log(
             "info", hostname, "device", "Device %s deleted succesfully" % (hostname)
         )
@@ -625,7 +632,7 @@ def detectors(request):
             }
             if (
                 getDeviceUpStatus(detector[i].device.mgmt_ipaddr) == "1"
-                and not type(scheduler.get_job(str(detector[i].device))) == None
+                and detector[i].is_running
             ):
                 temp["status"] = "up"
             else:
@@ -636,6 +643,7 @@ def detectors(request):
         serializer = DetectorSerializer(data=request.data)
         if serializer.is_valid():
             serializer.save()
+            write_recording_rules()
             activity_log(
                 "info",
                 "retia-engine",
@@ -696,7 +704,7 @@ def detector_detail(request, device):
 
         if (
             getDeviceUpStatus(detector.device.mgmt_ipaddr) == "1"
-            and not type(scheduler.get_job(str(device))) == None
+            and detector.is_running
         ):
             data["status"] = "up"
         else:
@@ -724,6 +732,7 @@ def detector_detail(request, device):
                     )
                     return Response(data=device_operation_result)
             serializer.save()
+            write_recording_rules()
             activity_log(
                 "info",
                 "retia-engine",
@@ -744,6 +753,8 @@ def detector_detail(request, device):
         device_operation_result = del_device_detector_config(conn_strings=conn_strings)
         if device_operation_result["code"] == 204:
             detector.delete()
+            drop_history(device)
+            write_recording_rules()
             activity_log(
                 "error",
                 "retia-engine",
@@ -819,20 +830,6 @@ def detector_sync(request, device):
 
 @api_view(["PUT"])
 def detector_run(request, device):
-    def detector_job(detector_instance):
-        print(
-            "\n\n\n\n\n----------------------------------------------------------------------------------"
-        )
-        core(
-            get_netflow_resampled(
-                "now",
-                detector_instance.sampling_interval,
-                detector_instance.elastic_host,
-                detector_instance.elastic_index,
-            ),
-            detector_instance,
-        )
-
     # Check whether detector exist in database
     try:
         detector = Detector.objects.get(pk=device)
@@ -843,14 +840,7 @@ def detector_run(request, device):
         try:
             body = request.data
             if body["status"] == "up":
-                scheduler.add_job(
-                    func=detector_job,
-                    args=[detector],
-                    trigger=IntervalTrigger(seconds=detector.sampling_interval),
-                    id=str(detector.device),
-                    max_instances=1,
-                    replace_existing=True,
-                )
+                start_detector(detector)
                 activity_log(
                     "info",
                     "retia-engine",
@@ -860,7 +850,7 @@ def detector_run(request, device):
                 return Response(status=status.HTTP_204_NO_CONTENT)
 
             elif body["status"] == "down":
-                scheduler.remove_job(str(detector.device))
+                stop_detector(str(detector.device))
                 activity_log(
                     "info",
                     "retia-engine",
@@ -881,6 +871,92 @@ def detector_run(request, device):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(["GET"])
+def detector_history(request, device):
+    # Check whether detector exist in database
+    try:
+        detector = Detector.objects.get(pk=device)
+    except Detector.DoesNotExist:
+        return Response(status=status.HTTP_404_NOT_FOUND)
+
+    if request.method == "GET":
+        try:
+            # start_time and end_time are unix timestamps in seconds
+            start_time = request.query_params.get("start_time")
+            end_time = request.query_params.get("end_time")
+            limit = request.query_params.get("limit")
+            # One of the detector resolutions, its sampling interval by default
+            sampling_interval = int(
+                request.query_params.get(
+                    "sampling_interval", detector.sampling_interval
+                )
+            )
+            records = read_detector_history(detector, sampling_interval).slice(
+                None if start_time is None else int(float(start_time) * 1000),
+                None if end_time is None else int(float(end_time) * 1000),
+                None if limit is None else int(limit),
+            )
+        except ValueError as e:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"error": str(e)})
+        return Response(data=history_response(records))
+
+
+@api_view(["POST"])
+def detector_sweep(request, device):
+    # Check whether detector exist in database
+    try:
+        detector = Detector.objects.get(pk=device)
+    except Detector.DoesNotExist:
+        return Response(status=status.HTTP_404_NOT_FOUND)
+
+    if request.method == "POST":
+        if detector.algorithm != "beta":
+            # The sweep replays the beta threshold only
+            return Response(
+                status=status.HTTP_400_BAD_REQUEST,
+                data={
+                    "error": "Sweeps are not supported for the %s algorithm"
+                    % (detector.algorithm)
+                },
+            )
+        try:
+            body = request.data
+            duration = int(body.get("duration", settings.DETECTOR_SWEEP_DURATION))
+            sampling_intervals = [
+                int(sampling_interval)
+                for sampling_interval in body.get(
+                    "sampling_intervals", [detector.sampling_interval]
+                )
+            ]
+            for sampling_interval in sampling_intervals:
+                if sampling_interval <= 0 or duration <= 0:
+                    raise ValueError("duration and sampling intervals must be positive")
+                if duration // sampling_interval + 1 > MAX_BUCKETS:
+                    raise ValueError(
+                        "%ss at %ss is more than %s buckets"
+                        % (duration, sampling_interval, MAX_BUCKETS)
+                    )
+            results = {}
+            for sampling_interval in sampling_intervals:
+                buckets = get_netflow_history(
+                    duration,
+                    sampling_interval,
+                    detector.elastic_host,
+                    detector.elastic_index,
+                )
+                results[sampling_interval] = sweep(
+                    feature_matrix(parse_buckets(buckets)),
+                    body.get("window_sizes", [detector.window_size]),
+                    body.get("initial_betas", [INITIAL_BETA]),
+                    body.get("beta_steps", [BETA_STEP]),
+                )
+            limit = body.get("limit")
+            limit = None if limit is None else int(limit)
+        except (KeyError, TypeError, ValueError) as e:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data={"error": str(e)})
+        return Response(data={"duration": duration, "results": rank(results, limit)})
+
+
 @api_view(["GET"])
 def monitoring_buildinfo(request):
     if request.method == "GET":
@@ -1,5 +1,8 @@
 from django.db import models
 
+from retia_api.helpers.algorithms import ALGORITHMS
+from retia_api.helpers.runs import OVERRUN_POLICIES
+
 
 class Device(models.Model):
     hostname = models.CharField(max_length=63, primary_key=True)
@@ -22,6 +25,23 @@ class Detector(models.Model):
     device_interface_to_server = models.CharField(max_length=200, default=None)
     window_size = models.IntegerField(default=1)
     sampling_interval = models.IntegerField(default=20)
+    # Coarser sampling intervals evaluated from the same fetch, e.g. "60,300"
+    resolutions = models.CharField(max_length=64, blank=True, default="")
+    algorithm = models.CharField(
+        max_length=16,
+        choices=[(name, name) for name in ALGORITHMS],
+        default="beta",
+    )
+    # What happens to ticks that could not start on time
+    overrun_policy = models.CharField(
+        max_length=16,
+        choices=[(policy, policy) for policy in OVERRUN_POLICIES],
+        default="skip",
+    )
+    # Detection was started and is resumed by the node owning the detector
+    is_running = models.BooleanField(default=False)
+    # Evaluated buckets kept in the detector's history ring file
+    history_length = models.IntegerField(default=4320)
     elastic_host = models.CharField(max_length=200, default="127.0.0.1")
     elastic_index = models.CharField(max_length=255)
     filebeat_host = models.GenericIPAddressField()
@@ -33,6 +53,15 @@ class Detector(models.Model):
         return self.device.hostname
 
 
+class EngineNode(models.Model):
+    # Engine process sharing the running detectors, alive while it heartbeats
+    name = models.CharField(max_length=255, primary_key=True)
+    heartbeat_at = models.DateTimeField()
+
+    def __str__(self):
+        return "%s | %s" % (self.name, self.heartbeat_at)
+
+
 class ActivityLog(models.Model):
     time = models.DateTimeField(null=True)
     severity = models.CharField(max_length=10, blank=True)
@@ -0,0 +1,234 @@
+import warnings
+
+import numpy as np
+
+from retia_api.helpers.thresholds import BETA_FLOOR, BETA_STEP, FEATURES, INITIAL_BETA
+
+# Streaming detection algorithms selectable per detector, {name: algorithm}
+ALGORITHMS = {}
+
+
+def register(cls):
+    ALGORITHMS[cls.name] = cls()
+    return cls
+
+
+def get_algorithm(name: str):
+    try:
+        return ALGORITHMS[name]
+    except KeyError:
+        raise ValueError("Unknown detection algorithm %s" % (name))
+
+
+class Algorithm:
+    # State is a dict of arrays whose leading `shape` axes index detectors, so
+    # step() can evaluate a whole fleet at once. `metrics` is the length of
+    # the feature axis, the NetFlow FEATURES unless another source is used.
+    # step() judges one newly closed bucket per detector, returns (thresholds,
+    # flags, betas) shaped like values and updates the state in place in
+    # constant time per metric.
+    name = None
+
+    def init_state(
+        self, window_size: int, shape: tuple = (), metrics: int = len(FEATURES)
+    ) -> dict:
+        return {
+            "window_size": np.full(shape, window_size, dtype=np.int64),
+            "filled": np.zeros(shape, dtype=np.int64),
+            "mean": np.zeros(shape + (metrics,)),
+        }
+
+    def step(self, state: dict, values: np.ndarray) -> tuple:
+        raise NotImplementedError
+
+    def warmed_up(self, state: dict) -> np.ndarray:
+        # Verdicts are only meaningful once window_size buckets were seen
+        return (state["filled"] >= state["window_size"])[..., None]
+
+    def count(self, state: dict):
+        state["filled"] = np.minimum(state["filled"] + 1, state["window_size"])
+
+
+@register
+class BetaThreshold(Algorithm):
+    # The nescient adaptive beta threshold over a trailing window, with the
+    # window moments kept by a sliding Welford update
+    name = "beta"
+
+    def init_state(
+        self,
+        window_size: int,
+        shape: tuple = (),
+        metrics: int = len(FEATURES),
+        initial_beta=INITIAL_BETA,
+        beta_step=BETA_STEP,
+    ) -> dict:
+        # initial_beta and beta_step may also be arrays of `shape`, e.g. the
+        # parameter sets of a sweep stepped side by side
+        state = super().init_state(window_size, shape, metrics)
+        size = shape + (metrics,)
+        state.update(
+            {
+                "window": np.zeros(size + (window_size,)),
+                "position": np.zeros(shape, dtype=np.int64),
+                "m2": np.zeros(size),
+                "previous_mean": np.zeros(size),
+                "beta": np.broadcast_to(
+                    np.asarray(initial_beta, dtype=np.float64)[..., None], size
+                ).copy(),
+                "beta_step": np.broadcast_to(
+                    np.asarray(beta_step, dtype=np.float64), shape
+                ).copy(),
+            }
+        )
+        return state
+
+    def step(self, state: dict, values: np.ndarray) -> tuple:
+        window = state["window"]
+        window_size = window.shape[-1]
+        filled = state["filled"]
+        full = self.warmed_up(state)
+        mean = state["mean"]
+        std = np.sqrt(np.maximum(state["m2"], 0) / np.maximum(filled, 1)[..., None])
+
+        rising = mean > 2 * state["previous_mean"]
+        beta_step = state["beta_step"][..., None]
+        beta = np.where(
+            rising,
+            state["beta"] + beta_step,
+            np.maximum(state["beta"] - beta_step, BETA_FLOOR),
+        )
+        spread = mean + std
+        thresholds = np.where(rising, spread / beta, spread * beta)
+        flags = (values > thresholds) & full
+
+        index = np.broadcast_to(state["position"][..., None, None], mean.shape + (1,))
+        oldest = np.take_along_axis(window, index, axis=-1)[..., 0]
+        count = np.minimum(filled + 1, window_size)[..., None]
+        delta = np.where(full, values - oldest, values - mean)
+        new_mean = mean + delta / count
+        state["m2"] = state["m2"] + np.where(
+            full,
+            delta * (values - new_mean + oldest - mean),
+            delta * (values - new_mean),
+        )
+        np.put_along_axis(window, index, values[..., None], axis=-1)
+
+        state["previous_mean"] = mean
+        state["mean"] = new_mean
+        state["beta"] = beta
+        state["position"] = (state["position"] + 1) % window_size
+        self.count(state)
+
+        # Re-anchor the running moments on every full lap to shed rounding drift
+        wrapped = (state["position"] == 0) & (state["filled"] == window_size)
+        if np.any(wrapped):
+            laps = window[wrapped]
+            state["mean"][wrapped] = laps.mean(axis=-1)
+            state["m2"][wrapped] = laps.var(axis=-1) * window_size
+
+        return thresholds, flags, beta
+
+
+@register
+class EWMA(Algorithm):
+    # Exponentially weighted mean and variance, alarm above mean + 3 std.
+    # window_size sets the span of the smoothing factor.
+    name = "ewma"
+    deviations = 3.0
+
+    def init_state(
+        self, window_size: int, shape: tuple = (), metrics: int = len(FEATURES)
+    ) -> dict:
+        state = super().init_state(window_size, shape, metrics)
+        state["variance"] = np.zeros(shape + (metrics,))
+        return state
+
+    def smooth(self, state: dict, values: np.ndarray):
+        alpha = (2 / (state["window_size"] + 1))[..., None]
+        # The first bucket seeds the mean instead of being averaged with zero
+        alpha = np.where(state["filled"][..., None] == 0, 1.0, alpha)
+        delta = values - state["mean"]
+        increment = alpha * delta
+        state["mean"] = state["mean"] + increment
+        state["variance"] = (1 - alpha) * (state["variance"] + delta * increment)
+
+    def step(self, state: dict, values: np.ndarray) -> tuple:
+        thresholds = state["mean"] + self.deviations * np.sqrt(state["variance"])
+        flags = (values > thresholds) & self.warmed_up(state)
+        self.smooth(state, values)
+        self.count(state)
+        return thresholds, flags, np.full(values.shape, np.nan)
+
+
+@register
+class CUSUM(EWMA):
+    # One-sided upper CUSUM of the standardised deviation from the EWMA
+    # baseline. The threshold is the value that would push the sum over `limit`.
+    name = "cusum"
+    slack = 0.5
+    limit = 5.0
+
+    def init_state(
+        self, window_size: int, shape: tuple = (), metrics: int = len(FEATURES)
+    ) -> dict:
+        state = super().init_state(window_size, shape, metrics)
+        state["sum"] = np.zeros(shape + (metrics,))
+        return state
+
+    def step(self, state: dict, values: np.ndarray) -> tuple:
+        std = np.sqrt(state["variance"])
+        scale = np.where(std > 0, std, 1.0)
+        thresholds = state["mean"] + scale * (self.limit - state["sum"] + self.slack)
+        cusum = np.maximum(
+            0, state["sum"] + (values - state["mean"]) / scale - self.slack
+        )
+        flags = (cusum > self.limit) & self.warmed_up(state)
+        # An alarm restarts the sum so a long attack keeps re-alarming
+        state["sum"] = np.where(flags, 0, cusum)
+        self.smooth(state, values)
+        self.count(state)
+        return thresholds, flags, np.full(values.shape, np.nan)
+
+
+@register
+class MedianMAD(Algorithm):
+    # Robust threshold at median + 3 scaled MADs of the trailing window
+    name = "mad"
+    deviations = 3.0
+    # MAD to standard deviation under normal traffic
+    scale = 1.4826
+
+    def init_state(
+        self, window_size: int, shape: tuple = (), metrics: int = len(FEATURES)
+    ) -> dict:
+        state = super().init_state(window_size, shape, metrics)
+        state["window"] = np.zeros(shape + (metrics, window_size))
+        state["position"] = np.zeros(shape, dtype=np.int64)
+        return state
+
+    def step(self, state: dict, values: np.ndarray) -> tuple:
+        window = state["window"]
+        window_size = window.shape[-1]
+        full = self.warmed_up(state)
+        if np.all(full):
+            median = np.median(window, axis=-1)
+            mad = np.median(np.abs(window - median[..., None]), axis=-1)
+        else:
+            # Unfilled slots are ignored while the window warms up
+            filled = np.arange(window_size) < state["filled"][..., None, None]
+            samples = np.where(filled, window, np.nan)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                median = np.nanmedian(samples, axis=-1)
+                mad = np.nanmedian(np.abs(samples - median[..., None]), axis=-1)
+            median = np.nan_to_num(median)
+            mad = np.nan_to_num(mad)
+        thresholds = median + self.deviations * self.scale * mad
+        flags = (values > thresholds) & full
+
+        index = np.broadcast_to(state["position"][..., None, None], values.shape + (1,))
+        np.put_along_axis(window, index, values[..., None], axis=-1)
+        state["position"] = (state["position"] + 1) % window_size
+        self.count(state)
+        return thresholds, flags, np.full(values.shape, np.nan)
@@ -0,0 +1,154 @@
+import numpy as np
+
+from retia_api.configurations import settings
+from retia_api.helpers.prometheusclient import get_detector_series, get_interface_rates
+from retia_api.helpers.recording import (
+    COUNTER_METRICS,
+    MIN_RATE_WINDOW,
+    RECORDED_STATS,
+    record_name,
+)
+from retia_api.helpers.streaming import get_state, run_inline, update_fleet
+from retia_api.helpers.thresholds import INITIAL_BETA
+
+
+def counter_name(device: str) -> str:
+    # State name of the counter stage of a detector
+    return "%s@counters" % (device)
+
+
+def counter_rates(result: list, targets: list) -> np.ndarray:
+    # (targets, metrics) rates of a get_interface_rates result, NaN where the
+    # exporter has no series for a target
+    positions = {target: idx for idx, target in enumerate(targets)}
+    features = list(COUNTER_METRICS)
+    rates = np.full((len(targets), len(features)), np.nan)
+    for series in result:
+        labels = series["metric"]
+        idx = positions.get(
+            (labels.get("instance"), labels.get(settings.PROMETHEUS_INTERFACE_LABEL))
+        )
+        if idx is not None and labels.get("feature") in features:
+            rates[idx, features.index(labels["feature"])] = float(series["value"][1])
+    return rates
+
+
+def recorded_stats(result: list, detectors: list) -> np.ndarray:
+    # (detectors, RECORDED_STATS, metrics) values of a get_detector_series
+    # result, NaN where a recording rule has no sample yet
+    positions = {detector: idx for idx, detector in enumerate(detectors)}
+    records = {
+        record_name(feature, stat): (row, column)
+        for row, stat in enumerate(RECORDED_STATS)
+        for column, feature in enumerate(COUNTER_METRICS)
+    }
+    stats = np.full((len(detectors), len(RECORDED_STATS), len(COUNTER_METRICS)), np.nan)
+    for series in result:
+        labels = series["metric"]
+        idx = positions.get(labels.get("detector"))
+        if idx is not None and labels.get("__name__") in records:
+            row, column = records[labels["__name__"]]
+            stats[idx, row, column] = float(series["value"][1])
+    return stats
+
+
+def screen(
+    detector_instances: list, sampling_interval: int, now: float, execute=run_inline
+) -> list:
+    # First detection stage on the interface counters already in Prometheus,
+    # one query and one vectorized step for all detectors. Returns the
+    # detectors whose NetFlow aggregation is worth fetching this tick: a
+    # counter over its threshold, a counter window still warming up or no
+    # counters to judge by.
+    if not detector_instances:
+        return []
+    end = int(now // sampling_interval * sampling_interval)
+    if settings.DETECTOR_COUNTER_RULES:
+        selected = recorded_selection(detector_instances, end)
+    else:
+        selected = streamed_selection(
+            detector_instances, sampling_interval, end, now, execute
+        )
+    return [
+        detector_instance
+        for idx, detector_instance in enumerate(detector_instances)
+        if idx in selected
+    ]
+
+
+def recorded_selection(detector_instances: list, end: int) -> set:
+    # Judges the rolling statistics the generated recording rules keep per
+    # detector. Prometheus holds no adaptive beta, so the threshold is the
+    # (mean + std) * INITIAL_BETA that nescient starts from.
+    detectors = [
+        str(detector_instance.device) for detector_instance in detector_instances
+    ]
+    stats = recorded_stats(
+        get_detector_series(
+            [
+                record_name(feature, stat)
+                for feature in COUNTER_METRICS
+                for stat in RECORDED_STATS
+            ],
+            detectors,
+            end,
+        ),
+        detectors,
+    )
+    rate, mean, std, samples = (stats[:, idx] for idx in range(len(RECORDED_STATS)))
+    window_sizes = np.array(
+        [detector_instance.window_size for detector_instance in detector_instances]
+    )
+    missing = np.isnan(stats).any(axis=(1, 2))
+    with np.errstate(invalid="ignore"):
+        flags = (rate > (mean + std) * INITIAL_BETA).any(axis=-1)
+        warm = (samples >= window_sizes[:, None]).all(axis=-1)
+    return set(np.flatnonzero(missing | ~warm | flags).tolist())
+
+
+def streamed_selection(
+    detector_instances: list, sampling_interval: int, end: int, now: float, execute
+) -> set:
+    # Steps the detector algorithms over the live counter rates
+    key = (end - sampling_interval) * 1000
+    targets = [
+        (
+            str(detector_instance.device.mgmt_ipaddr),
+            detector_instance.device_interface_to_server,
+        )
+        for detector_instance in detector_instances
+    ]
+    rates = counter_rates(
+        get_interface_rates(
+            COUNTER_METRICS,
+            targets,
+            settings.PROMETHEUS_INTERFACE_LABEL,
+            max(sampling_interval, MIN_RATE_WINDOW),
+            end,
+        ),
+        targets,
+    )
+
+    selected, candidates, states, features, warm = set(), [], [], [], []
+    for idx, detector_instance in enumerate(detector_instances):
+        state = get_state(
+            counter_name(str(detector_instance.device)),
+            detector_instance.window_size,
+            sampling_interval,
+            detector_instance.algorithm,
+            len(COUNTER_METRICS),
+        )
+        if np.isnan(rates[idx]).any():
+            selected.add(idx)
+        elif state.new_mask(np.array([key]), now).all():
+            candidates.append(idx)
+            states.append(state)
+            features.append(rates[idx][:, None])
+            warm.append(bool(state.arrays["filled"] >= state.window_size))
+
+    results = update_fleet(states, features, [[key]] * len(states), execute)
+    for idx, is_warm, (_, flags, _) in zip(candidates, warm, results):
+        # Any counter over threshold is enough, NetFlow gives the verdict
+        if not is_warm or flags.any():
+            selected.add(idx)
+    return selected
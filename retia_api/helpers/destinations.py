@@ -0,0 +1,153 @@
+import numpy as np
+
+from retia_api.helpers.features import BUCKET_DTYPE, feature_matrix, parse_columns
+from retia_api.helpers.streaming import (
+    DetectorState,
+    detector_states,
+    detector_states_lock,
+)
+from retia_api.helpers.thresholds import FEATURES
+
+
+def destination_name(device: str) -> str:
+    # State name of the per-destination stage of a detector
+    return "%s@destinations" % (device)
+
+
+def destination_matrix(buckets: list) -> tuple:
+    # (destinations, keys, features) of get_netflow_by_destination buckets,
+    # features is (destinations, metrics, keys) and zero where a destination
+    # sent nothing in a bucket
+    count = len(buckets)
+    destinations, rows = np.unique(
+        np.array([bucket["key"]["destination"] for bucket in buckets], dtype=str),
+        return_inverse=True,
+    )
+    keys, columns = np.unique(
+        np.fromiter(
+            (bucket["key"]["timestamp"] for bucket in buckets), np.int64, count
+        ),
+        return_inverse=True,
+    )
+    # Keys are only placed by column, parse_columns is used for the ratios
+    parsed = parse_columns(
+        np.zeros(count, dtype=np.int64),
+        *(
+            np.fromiter(
+                (bucket[name]["value"] or 0 for bucket in buckets), np.float64, count
+            )
+            for name in ("packets", "USIP", "UDIP", "UPR")
+        ),
+    )
+    features = np.zeros((len(destinations), len(FEATURES), len(keys)))
+    features[rows, :, columns] = feature_matrix(parsed).T
+    return destinations, keys, features
+
+
+def destination_buckets(keys: np.ndarray, features: np.ndarray) -> np.ndarray:
+    # Parsed buckets of one destination from its (metrics, keys) features
+    data = np.empty(len(keys), dtype=BUCKET_DTYPE)
+    data["key"] = keys
+    for idx, name in enumerate(FEATURES):
+        data[name] = features[idx]
+    return data
+
+
+class DestinationState(DetectorState):
+    # Window state of every tracked destination of one detector, stacked on a
+    # leading axis so all of them are stepped as one matrix. Destinations
+    # idle for a whole window are evicted, their window holds nothing but
+    # zeros by then, and new ones are admitted busiest first up to `limit`.
+    def __init__(
+        self, window_size: int, sampling_interval: int, algorithm="beta", limit=4096
+    ):
+        super().__init__(window_size, sampling_interval, algorithm)
+        self.limit = limit
+        self.arrays = self.algorithm.init_state(window_size, shape=(0,))
+        self.destinations = np.array([], dtype=str)
+        self.last_active = np.zeros(0, dtype=np.int64)
+
+    def track(
+        self, destinations: np.ndarray, keys: np.ndarray, features: np.ndarray
+    ) -> tuple:
+        # Aligns the (destinations, metrics, keys) features of new buckets on
+        # the tracked rows, returns (tracked destinations, features)
+        with self.lock:
+            # Key of the last bucket with packets per destination, -1 if none
+            active = features[:, 0] > 0
+            last_active = np.where(
+                active.any(axis=-1),
+                keys[len(keys) - 1 - np.argmax(active[:, ::-1], axis=-1)],
+                -1,
+            )
+            rows = self.rows(destinations)
+            known = rows >= 0
+            self.last_active[rows[known]] = np.maximum(
+                self.last_active[rows[known]], last_active[known]
+            )
+
+            idle_before = keys[-1] - self.window_size * self.sampling_interval * 1000
+            keep = self.last_active > idle_before
+            if not keep.all():
+                self.arrays = {name: array[keep] for name, array in self.arrays.items()}
+                self.destinations = self.destinations[keep]
+                self.last_active = self.last_active[keep]
+
+            candidates = np.flatnonzero(~known & (last_active >= 0))
+            free = max(self.limit - len(self.destinations), 0)
+            busiest = np.argsort(-features[candidates, 0].sum(axis=-1), kind="stable")
+            admitted = candidates[busiest[:free]]
+            if len(admitted):
+                added = self.algorithm.init_state(
+                    self.window_size, shape=(len(admitted),)
+                )
+                self.arrays = {
+                    name: np.concatenate([array, added[name]])
+                    for name, array in self.arrays.items()
+                }
+                self.destinations = np.concatenate(
+                    [self.destinations, destinations[admitted]]
+                )
+                self.last_active = np.concatenate(
+                    [self.last_active, last_active[admitted]]
+                )
+
+            tracked = np.zeros(
+                (len(self.destinations),) + features.shape[1:], dtype=features.dtype
+            )
+            rows = self.rows(destinations)
+            tracked[rows[rows >= 0]] = features[rows >= 0]
+            return self.destinations, tracked
+
+    def rows(self, destinations: np.ndarray) -> np.ndarray:
+        # Tracked row of every destination, -1 when untracked
+        order = np.argsort(self.destinations)
+        positions = np.searchsorted(self.destinations, destinations, sorter=order)
+        positions = np.minimum(positions, max(len(order) - 1, 0))
+        rows = np.full(len(destinations), -1, dtype=np.int64)
+        if len(order):
+            matched = self.destinations[order[positions]] == destinations
+            rows[matched] = order[positions[matched]]
+        return rows
+
+
+def get_destination_state(
+    name: str,
+    window_size: int,
+    sampling_interval: int,
+    algorithm: str = "beta",
+    limit: int = 4096,
+) -> DestinationState:
+    # Kept next to the detector states so drop_state() also drops it
+    with detector_states_lock:
+        state = detector_states.get(name)
+        if (
+            state is None
+            or state.window_size != window_size
+            or state.sampling_interval != sampling_interval
+            or state.algorithm.name != algorithm
+            or state.limit != limit
+        ):
+            state = DestinationState(window_size, sampling_interval, algorithm, limit)
+            detector_states[name] = state
+        return state
@@ -1,92 +1,400 @@
 import os
-from datetime import datetime
+from functools import lru_cache
+from time import sleep
 
+import numpy as np
+from elastic_transport import ConnectionTimeout
 from elasticsearch import Elasticsearch
 from icecream import ic
 
+from retia_api.helpers.resolution import cardinality_aggs
+
+# Seconds between searches while waiting for a first bucket
+POLL_INTERVAL = 1
+
+# Default search.max_buckets of Elasticsearch, more histogram buckets fail
+MAX_BUCKETS = 65536
+
+# Composite buckets fetched per page of a destination search
+COMPOSITE_PAGE_SIZE = 1000
+
+# Network address of the destination under params.mask, "<address>/<prefix>"
+DESTINATION_PREFIX_SCRIPT = """
+long address = 0;
+for (String octet : doc['netflow.destination_ipv4_address'].value.splitOnToken('.')) {
+  address = address * 256 + Integer.parseInt(octet);
+}
+address = address & params.mask;
+return (address >> 24) + '.' + ((address >> 16) & 255) + '.'
+  + ((address >> 8) & 255) + '.' + (address & 255) + '/' + params.prefix;
+"""
+
+
+class SearchError(Exception):
+    # A search of an _msearch that failed on its own
+    pass
+
+
+@lru_cache(maxsize=None)
+def elastic_client(elastic_host: str) -> Elasticsearch:
+    # One client per host, its connection pool is shared by every search
+    return Elasticsearch(
+        hosts=["https://" + elastic_host + ":9200"],
+        ca_certs="/etc/elasticsearch/certs/http_ca.crt",
+        basic_auth=("elastic", "f*xBBTke-ytKJkVoZ0+M"),
+    )
+
+
+def request(elastic_host: str, api: str, deadline=None, **kwargs) -> dict:
+    # A request that gives up with the deadline of the calling stage, if any.
+    # The deadline raises once it expired or its run was cancelled.
+    client = elastic_client(elastic_host)
+    if deadline is None:
+        return getattr(client, api)(**kwargs)
+    deadline.check()
+    if deadline.remaining() is not None:
+        client = client.options(request_timeout=deadline.remaining())
+    try:
+        return getattr(client, api)(**kwargs)
+    except ConnectionTimeout:
+        deadline.check()
+        raise
+
+
+def search(elastic_host: str, deadline=None, **kwargs) -> dict:
+    return request(elastic_host, "search", deadline, **kwargs)
+
+
+def msearch(elastic_host: str, index: str, bodies: list, deadline=None) -> list:
+    # Responses of several searches sent in one round trip, in order
+    searches = []
+    for body in bodies:
+        searches += [{"index": index}, body]
+    return request(elastic_host, "msearch", deadline, searches=searches)["responses"]
+
+
+def timestamp_range(end_time, lookback: int) -> dict:
+    # end_time is "now" or the epoch milliseconds of a bucket boundary, the
+    # boundary itself belongs to the next, still open bucket
+    if isinstance(end_time, str):
+        return {"gte": "now-{}s".format(lookback), "lte": end_time}
+    return {"gte": end_time - lookback * 1000, "lt": end_time}
+
 
 def get_netflow_resampled(
     start_time: str, end_time: int, elastic_host: str, elastic_index: str
 ) -> list:
+    aggregations = get_netflow_resolutions(
+        start_time, [end_time], elastic_host, elastic_index
+    )
+    return aggregations["all_attributes"]["buckets"]
+
+
+def netflow_aggs(resolutions: list) -> dict:
+    # all_attributes at the finest resolution plus the coarser cardinalities
+    return {
+        "all_attributes": {
+            "date_histogram": {
+                "field": "@timestamp",
+                "fixed_interval": "{}s".format(resolutions[0]),
+            },
+            "aggs": {
+                "packets": {"sum": {"field": "netflow.packet_delta_count"}},
+                "USIP": {"cardinality": {"field": "netflow.source_ipv4_address"}},
+                "UDIP": {"cardinality": {"field": "netflow.destination_ipv4_address"}},
+                "UPR": {"cardinality": {"field": "netflow.protocol_identifier"}},
+            },
+        },
+        **cardinality_aggs(resolutions[1:]),
+    }
+
+
+def get_netflow_resolutions(
+    start_time: str,
+    resolutions: list,
+    elastic_host: str,
+    elastic_index: str,
+    lookback: int = None,
+    deadline=None,
+) -> dict:
+    # Waits for the finest resolution to have at least one bucket, polling
+    # until the deadline if one is given
+    while True:
+        aggregations = search_netflow_resolutions(
+            start_time, resolutions, elastic_host, elastic_index, lookback, deadline
+        )
+        if len(aggregations["all_attributes"]["buckets"]) > 0:
+            return aggregations
+        else:
+            if deadline is not None:
+                deadline.check()
+            sleep(POLL_INTERVAL)
+
+
+def search_netflow_resolutions(
+    start_time: str,
+    resolutions: list,
+    elastic_host: str,
+    elastic_index: str,
+    lookback: int = None,
+    deadline=None,
+) -> dict:
+    # One search for every resolution of a detector, the first resolution is
+    # the finest and the range covers the coarsest unless a longer lookback
+    # in seconds is given
+    response = search(
+        elastic_host,
+        deadline,
+        index=elastic_index,
+        body={
+            "size": 0,
+            "query": {
+                "range": {
+                    "@timestamp": timestamp_range(
+                        start_time, lookback or max(resolutions)
+                    )
+                }
+            },
+            "aggs": netflow_aggs(resolutions),
+        },
+    )
+    return response["aggregations"]
+
+
+def get_netflow_by_exporter(
+    start_time: str,
+    resolutions: list,
+    exporter_field: str,
+    exporters: list,
+    elastic_host: str,
+    elastic_index: str,
+    lookback: int = None,
+    deadline=None,
+) -> dict:
+    # Same aggregations as get_netflow_resolutions for several exporters
+    # sharing an index, split by a terms aggregation, {exporter: aggregations}.
+    # Exporters without flows in the range get empty buckets.
+    response = search(
+        elastic_host,
+        deadline,
+        index=elastic_index,
+        body={
+            "size": 0,
+            "query": {
+                "bool": {
+                    "filter": [
+                        {
+                            "range": {
+                                "@timestamp": timestamp_range(
+                                    start_time, lookback or max(resolutions)
+                                )
+                            }
+                        },
+                        {"terms": {exporter_field: exporters}},
+                    ]
+                }
+            },
+            "aggs": {
+                "exporters": {
+                    "terms": {"field": exporter_field, "size": len(exporters)},
+                    "aggs": netflow_aggs(resolutions),
+                }
+            },
+        },
+    )
+    empty = {name: {"buckets": []} for name in netflow_aggs(resolutions)}
+    result = {exporter: empty for exporter in exporters}
+    for bucket in response["aggregations"]["exporters"]["buckets"]:
+        result[bucket["key"]] = bucket
+    return result
+
+
+def get_netflow_by_destination(
+    start_time: str,
+    sampling_interval: int,
+    prefix: int,
+    elastic_host: str,
+    elastic_index: str,
+    lookback: int = None,
+    deadline=None,
+) -> list:
+    # all_attributes buckets of every destination address (prefix 32) or
+    # destination prefix, paged through a composite aggregation. Returns the
+    # composite buckets keyed by {"destination", "timestamp"}.
+    if prefix == 32:
+        destination = {"terms": {"field": "netflow.destination_ipv4_address"}}
+    else:
+        destination = {
+            "terms": {
+                "script": {
+                    "source": DESTINATION_PREFIX_SCRIPT,
+                    "lang": "painless",
+                    "params": {
+                        "mask": (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF,
+                        "prefix": prefix,
+                    },
+                }
+            }
+        }
+    buckets = []
+    after_key = None
     while True:
-        response = Elasticsearch(
-            hosts=["https://" + elastic_host + ":9200"],
-            ca_certs="/etc/elasticsearch/certs/http_ca.crt",
-            basic_auth=("elastic", "f*xBBTke-ytKJkVoZ0+M"),
-        ).search(
+        composite = {
+            "size": COMPOSITE_PAGE_SIZE,
+            "sources": [
+                {
+                    "timestamp": {
+                        "date_histogram": {
+                            "field": "@timestamp",
+                            "fixed_interval": "{}s".format(sampling_interval),
+                        }
+                    }
+                },
+                {"destination": destination},
+            ],
+        }
+        if after_key is not None:
+            composite["after"] = after_key
+        response = search(
+            elastic_host,
+            deadline,
             index=elastic_index,
             body={
                 "size": 0,
                 "query": {
                     "range": {
-                        "@timestamp": {
-                            "gte": "now-{}s".format(end_time),
-                            "lte": start_time,
-                        }
+                        "@timestamp": timestamp_range(
+                            start_time, lookback or sampling_interval
+                        )
                     }
                 },
                 "aggs": {
-                    "all_attributes": {
-                        "date_histogram": {
-                            "field": "@timestamp",
-                            "fixed_interval": "{}s".format(end_time),
-                        },
-                        "aggs": {
-                            "packets": {"sum": {"field": "netflow.packet_delta_count"}},
-                            "USIP": {
-                                "cardinality": {"field": "netflow.source_ipv4_address"}
-                            },
-                            "UDIP": {
-                                "cardinality": {
-                                    "field": "netflow.destination_ipv4_address"
-                                }
-                            },
-                            "UPR": {
-                                "cardinality": {"field": "netflow.protocol_identifier"}
-                            },
-                        },
+                    "destinations": {
+                        "composite": composite,
+                        "aggs": netflow_aggs([sampling_interval])["all_attributes"][
+                            "aggs"
+                        ],
                     }
                 },
             },
         )
-        if len(response["aggregations"]["all_attributes"]["buckets"]) > 0:
-            return response["aggregations"]["all_attributes"]["buckets"]
-        else:
-            continue
+        page = response["aggregations"]["destinations"]
+        buckets.extend(page["buckets"])
+        after_key = page.get("after_key")
+        if not page["buckets"] or after_key is None:
+            return buckets
 
 
-def get_netflow_data_at_nearest_time(
-    time: int, elastic_host: str, elastic_index: str, is_after=True
-) -> dict:
-    response = Elasticsearch(
-        hosts=["https://" + elastic_host + ":9200"],
-        ca_certs="/etc/elasticsearch/certs/http_ca.crt",
-        basic_auth=("elastic", "f*xBBTke-ytKJkVoZ0+M"),
-    ).search(
+def get_netflow_history(
+    duration: int,
+    sampling_interval: int,
+    elastic_host: str,
+    elastic_index: str,
+    deadline=None,
+) -> list:
+    # Buckets of the last `duration` seconds at `sampling_interval`, may be empty
+    response = search(
+        elastic_host,
+        deadline,
         index=elastic_index,
         body={
-            "size": 1,
+            "size": 0,
             "query": {
-                "match": {
-                    "@timestamp": datetime.utcfromtimestamp(time).strftime(
-                        "%Y-%m-%dT%H:%M:%S.000Z"
-                    )
+                "range": {
+                    "@timestamp": {
+                        "gte": "now-{}s".format(duration),
+                        "lte": "now",
+                    }
+                }
+            },
+            "aggs": {
+                "all_attributes": {
+                    "date_histogram": {
+                        "field": "@timestamp",
+                        "fixed_interval": "{}s".format(sampling_interval),
+                    },
+                    "aggs": {
+                        "packets": {"sum": {"field": "netflow.packet_delta_count"}},
+                        "USIP": {
+                            "cardinality": {"field": "netflow.source_ipv4_address"}
+                        },
+                        "UDIP": {
+                            "cardinality": {"field": "netflow.destination_ipv4_address"}
+                        },
+                        "UPR": {
+                            "cardinality": {"field": "netflow.protocol_identifier"}
+                        },
+                    },
                 }
             },
-            "_source": [
-                "netflow.source_ipv4_address",
-                "netflow.destination_ipv4_address",
-                "netflow.destination_transport_port",
-                "netflow.protocol_identifier",
-            ],
         },
     )
-    if (
-        response["hits"]["total"]["value"] > 0
-        and "netflow" in response["hits"]["hits"][0]["_source"]
-    ):
-        return response["hits"]["hits"][0]["_source"]["netflow"]
-    else:
-        return get_netflow_data_at_nearest_time(
-            time + 1 if is_after is True else time - 1, elastic_host, elastic_index
-        )
+    return response["aggregations"]["all_attributes"]["buckets"]
+
+
+def get_netflow_data_after(
+    times,
+    sampling_interval: int,
+    elastic_host: str,
+    elastic_index: str,
+    destination: str = None,
+    exporter_field: str = None,
+    exporter: str = None,
+    deadline=None,
+) -> list:
+    # First flow of the bucket starting at each epoch second of times, None
+    # where there is none. Every lookup of a tick goes out in one _msearch. A
+    # destination address or CIDR prefix only takes the flows sent to it, an
+    # exporter those of one router on an index shared by several.
+    times = np.asarray(times, dtype=np.int64)
+    unique, positions = np.unique(times, return_inverse=True)
+    if not len(unique):
+        return []
+    filters = [{"exists": {"field": "netflow.source_ipv4_address"}}]
+    if destination is not None:
+        # Terms on an ip field also match a CIDR prefix
+        filters.append({"term": {"netflow.destination_ipv4_address": destination}})
+    if exporter_field and exporter is not None:
+        filters.append({"term": {exporter_field: exporter}})
+    responses = msearch(
+        elastic_host,
+        elastic_index,
+        [
+            {
+                "size": 1,
+                "query": {
+                    "bool": {
+                        "filter": [
+                            {
+                                "range": {
+                                    "@timestamp": {
+                                        "gte": int(timestamp) * 1000,
+                                        "lt": (int(timestamp) + sampling_interval)
+                                        * 1000,
+                                        "format": "epoch_millis",
+                                    }
+                                }
+                            },
+                            *filters,
+                        ]
+                    }
+                },
+                "sort": [{"@timestamp": "asc"}],
+                "_source": [
+                    "netflow.source_ipv4_address",
+                    "netflow.destination_ipv4_address",
+                    "netflow.destination_transport_port",
+                    "netflow.protocol_identifier",
+                ],
+            }
+            for timestamp in unique
+        ],
+        deadline,
+    )
+    flows = []
+    for response in responses:
+        if "error" in response:
+            raise SearchError(response["error"])
+        hits = response["hits"]["hits"]
+        flows.append(hits[0]["_source"]["netflow"] if hits else None)
+    return [flows[position] for position in positions]
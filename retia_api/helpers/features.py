@@ -0,0 +1,56 @@
+import numpy as np
+
+from retia_api.helpers.thresholds import FEATURES
+
+# One row per date_histogram bucket of the all_attributes aggregation
+BUCKET_DTYPE = np.dtype([("key", np.int64)] + [(name, np.float64) for name in FEATURES])
+
+
+def parse_buckets(buckets: list) -> np.ndarray:
+    # The ratio columns are first filled with the raw UDIP/UPR cardinalities
+    # and divided in place, so parsing allocates a single structured array
+    parsed = np.fromiter(
+        (
+            (
+                bucket["key"],
+                bucket["packets"]["value"],
+                bucket["USIP"]["value"],
+                bucket["UDIP"]["value"],
+                bucket["UPR"]["value"],
+            )
+            for bucket in buckets
+        ),
+        dtype=BUCKET_DTYPE,
+        count=len(buckets),
+    )
+    return fill_ratios(parsed)
+
+
+def parse_columns(
+    key: np.ndarray,
+    packets: np.ndarray,
+    USIP: np.ndarray,
+    UDIP: np.ndarray,
+    UPR: np.ndarray,
+) -> np.ndarray:
+    # Same layout as parse_buckets for buckets stored column by column
+    parsed = np.empty(len(key), dtype=BUCKET_DTYPE)
+    for name, column in zip(BUCKET_DTYPE.names, (key, packets, USIP, UDIP, UPR)):
+        parsed[name] = column
+    return fill_ratios(parsed)
+
+
+def fill_ratios(parsed: np.ndarray) -> np.ndarray:
+    # Turns the raw UDIP/UPR held in the ratio columns into USIP/UDIP, USIP/UPR
+    usip = parsed["USIP"]
+    for name in FEATURES[2:]:
+        ratio = parsed[name]
+        defined = (usip != 0) & (ratio != 0)
+        np.divide(usip, ratio, out=ratio, where=defined)
+        ratio[~defined] = 0
+    return parsed
+
+
+def feature_matrix(parsed: np.ndarray) -> np.ndarray:
+    # (metrics, buckets) matrix of the parsed buckets for the threshold engine
+    return np.stack([parsed[name] for name in FEATURES])
@@ -0,0 +1,252 @@
+import os
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+
+from retia_api.configurations import settings
+from retia_api.helpers.thresholds import FEATURES
+
+# One record per evaluated bucket, float32 values keep the ring files small
+HISTORY_DTYPE = np.dtype(
+    [
+        ("key", np.int64),
+        ("features", np.float32, (len(FEATURES),)),
+        ("thresholds", np.float32, (len(FEATURES),)),
+        ("betas", np.float32, (len(FEATURES),)),
+        ("flags", np.bool_, (len(FEATURES),)),
+        ("verdict", np.bool_),
+    ]
+)
+
+# Key of a slot never written to
+EMPTY_KEY = np.iinfo(np.int64).min
+
+
+def empty_records(capacity: int, path: Path = None) -> np.ndarray:
+    if path is None:
+        records = np.zeros(capacity, dtype=HISTORY_DTYPE)
+    else:
+        records = np.lib.format.open_memmap(
+            path, mode="w+", dtype=HISTORY_DTYPE, shape=(capacity,)
+        )
+    records["key"] = EMPTY_KEY
+    return records
+
+
+class DetectorHistory:
+    # Fixed-size ring of the latest evaluated buckets of one detector, in
+    # memory or memory-mapped from a .npy file at `path`. A ring file is
+    # reopened where it was left. Only the process running the detector
+    # writes it: capacity changes keep the newest records in a new file that
+    # replaces the old one, so readers mapping it never see it truncated.
+    # Read-only histories never resize and stay empty without a file.
+    def __init__(self, capacity: int = None, path: Path = None, readonly=False):
+        self.path = path
+        records = None
+        if path is not None and path.exists():
+            records = np.load(path, mmap_mode="r" if readonly else "r+")
+            if records.dtype != HISTORY_DTYPE:
+                records = None
+        if readonly:
+            if records is None:
+                records = np.zeros(0, dtype=HISTORY_DTYPE)
+        else:
+            if capacity is None:
+                capacity = (
+                    settings.DETECTOR_HISTORY_LENGTH
+                    if records is None
+                    else len(records)
+                )
+            if records is None or len(records) != capacity:
+                records = resized_records(records, capacity, path)
+        self.records = records
+        self.inode = ring_inode(path)
+
+        # Slots are filled in order and keys only grow, so the newest key
+        # marks the head of a reopened ring
+        capacity = len(records)
+        keys = np.array(self.records["key"])
+        filled = int(np.count_nonzero(keys != EMPTY_KEY))
+        if filled < capacity or not capacity:
+            self.count = filled
+        else:
+            self.count = capacity + (int(np.argmax(keys)) + 1) % capacity
+        self.last_key = int(keys.max()) if filled else None
+        self.lock = Lock()
+
+    def replaced(self) -> bool:
+        # Whether the ring file was deleted or replaced since it was mapped,
+        # e.g. by the API deleting the detector
+        return self.path is not None and ring_inode(self.path) != self.inode
+
+    def append(self, keys, features, thresholds, betas, flags):
+        # Takes the (metrics, buckets) arrays produced by the threshold engine.
+        # Buckets not newer than the stored ones, e.g. re-evaluated by a warm
+        # start after a restart, are skipped.
+        capacity = len(self.records)
+        with self.lock:
+            keys = np.asarray(keys)
+            newer = len(keys)
+            if self.last_key is not None:
+                newer = len(keys) - np.searchsorted(keys, self.last_key, side="right")
+            added = min(newer, capacity)
+            if not added:
+                return
+            keys = keys[-added:]
+            positions = (self.count + np.arange(added)) % capacity
+            records = self.records
+            records["features"][positions] = features[:, -added:].T
+            records["thresholds"][positions] = thresholds[:, -added:].T
+            records["betas"][positions] = betas[:, -added:].T
+            records["flags"][positions] = flags[:, -added:].T
+            records["verdict"][positions] = flags[:, -added:].all(axis=0)
+            # Keys last, readers find the head of the ring by them
+            records["key"][positions] = keys
+            self.count += added
+            self.last_key = int(keys[-1])
+
+    def segments(self) -> list:
+        # Views of the stored records from oldest to newest
+        capacity = len(self.records)
+        if self.count <= capacity:
+            return [self.records[: self.count]]
+        head = self.count % capacity
+        return [self.records[head:], self.records[:head]]
+
+    def ordered(self) -> np.ndarray:
+        # Oldest to newest copy of the stored records
+        with self.lock:
+            return np.concatenate(self.segments())
+
+    def slice(
+        self, start: int = None, end: int = None, limit: int = None
+    ) -> np.ndarray:
+        # Records with start <= key <= end (epoch milliseconds), newest
+        # `limit`. A view of the ring unless the range wraps around its end.
+        with self.lock:
+            parts = []
+            for records in self.segments():
+                keys = records["key"]
+                lower = 0 if start is None else np.searchsorted(keys, start, "left")
+                upper = (
+                    len(keys) if end is None else np.searchsorted(keys, end, "right")
+                )
+                parts.append(records[lower:upper])
+            if limit is not None:
+                newest, older = parts[-1], parts[:-1]
+                parts = [newest[max(len(newest) - limit, 0) :]]
+                for records in reversed(older):
+                    remaining = limit - sum(len(part) for part in parts)
+                    parts.insert(0, records[max(len(records) - remaining, 0) :])
+            parts = [part for part in parts if len(part)]
+            if len(parts) == 1:
+                return parts[0]
+            if not parts:
+                return self.records[:0]
+            return np.concatenate(parts)
+
+
+def resized_records(records: np.ndarray, capacity: int, path: Path = None):
+    # A ring of `capacity` holding the newest of records. Ring files are
+    # written aside and moved over the old one.
+    kept = None if records is None else ordered_records(records)[-capacity:]
+    if path is None:
+        resized = empty_records(capacity)
+        if kept is not None:
+            resized[: len(kept)] = kept
+        return resized
+    temporary = path.with_name(path.name + ".tmp")
+    resized = empty_records(capacity, temporary)
+    if kept is not None:
+        resized[: len(kept)] = kept
+    resized.flush()
+    del resized
+    os.replace(temporary, path)
+    return np.load(path, mmap_mode="r+")
+
+
+def ring_inode(path: Path):
+    try:
+        return None if path is None else os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+
+
+def ordered_records(records: np.ndarray) -> np.ndarray:
+    # Stored records of a ring array in key order
+    return np.sort(records[records["key"] != EMPTY_KEY], order="key")
+
+
+detector_histories = {}
+detector_histories_lock = Lock()
+
+
+def history_path(name: str) -> Path:
+    if settings.DETECTOR_HISTORY_DIR is None:
+        return None
+    directory = Path(settings.DETECTOR_HISTORY_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory / ("%s.npy" % (name))
+
+
+def get_history(name: str, capacity: int = None) -> DetectorHistory:
+    # A capacity of None keeps the one the history was created with. A ring
+    # file deleted by another process is started over, writing on to the old
+    # mapping would leave the new file empty.
+    with detector_histories_lock:
+        history = detector_histories.get(name)
+        if (
+            history is None
+            or capacity not in (None, len(history.records))
+            or history.replaced()
+        ):
+            history = DetectorHistory(capacity, history_path(name))
+            detector_histories[name] = history
+        return history
+
+
+def read_history(name: str) -> DetectorHistory:
+    # Fresh read-only view of a ring file for processes not running the
+    # detector, e.g. the API. Without ring files only this process' own
+    # history exists.
+    path = history_path(name)
+    if path is None:
+        with detector_histories_lock:
+            history = detector_histories.get(name)
+        return history or DetectorHistory(0)
+    return DetectorHistory(path=path, readonly=True)
+
+
+def drop_history(name: str):
+    # Forgets the history of a detector along with its extra resolutions,
+    # ring files included
+    with detector_histories_lock:
+        for history_name in list(detector_histories):
+            if history_name == name or history_name.startswith(name + "@"):
+                del detector_histories[history_name]
+        if settings.DETECTOR_HISTORY_DIR is not None:
+            directory = Path(settings.DETECTOR_HISTORY_DIR)
+            for path in (directory / ("%s.npy" % (name)),) + tuple(
+                directory.glob("%s@*.npy" % (name))
+            ):
+                path.unlink(missing_ok=True)
+
+
+def history_response(records: np.ndarray) -> dict:
+    # Column-wise JSON body, one list per feature for charting. Algorithms
+    # without a beta store NaN, which is sent as null.
+    return {
+        "time": records["key"].tolist(),
+        "verdict": records["verdict"].tolist(),
+        **{
+            column: {
+                name: [
+                    None if value != value else value
+                    for value in records[column][:, idx].tolist()
+                ]
+                for idx, name in enumerate(FEATURES)
+            }
+            for column in ("features", "thresholds", "betas", "flags")
+        },
+    }
@@ -0,0 +1,614 @@
+import atexit
+import zlib
+from datetime import datetime, timezone
+from threading import Lock
+from time import time
+from timeit import default_timer as timer
+
+from apscheduler.events import (
+    EVENT_JOB_MAX_INSTANCES,
+    EVENT_JOB_MISSED,
+    EVENT_JOB_SUBMITTED,
+)
+from apscheduler.triggers.interval import IntervalTrigger
+from django.db import DatabaseError, close_old_connections
+
+from retia_api.configurations import settings
+from retia_api.configurations.scheduler import scheduler
+from retia_api.databases.models import Detector
+from retia_api.helpers.counters import screen
+from retia_api.helpers.elasticclient import (
+    get_netflow_by_destination,
+    get_netflow_by_exporter,
+    get_netflow_resolutions,
+    search_netflow_resolutions,
+)
+from retia_api.helpers.latency import observe, timed
+from retia_api.helpers.logging import activity_log
+from retia_api.helpers.pool import execute
+from retia_api.helpers.resolution import parse_resolutions, split_resolutions
+from retia_api.helpers.runs import (
+    bounded_run,
+    cancel_run,
+    count_tick,
+    defer_tick,
+    scheduler_options,
+    stage_deadline,
+)
+from retia_api.helpers.shards import HashRing, heartbeat, leave, node_name
+from retia_api.helpers.streaming import drop_state
+from retia_api.nescient import (
+    backfill,
+    destination_state,
+    detector_state,
+    stream_destinations,
+    stream_fleet,
+    stream_resolutions,
+)
+
+# Fleet mode members, {sampling_interval: {device: detector_instance}}
+fleet_members = {}
+fleet_members_lock = Lock()
+
+# Detectors scheduled in this process, {device: detector_instance}
+scheduled_detectors = {}
+scheduled_detectors_lock = Lock()
+
+# Ring of the live engine nodes at the last heartbeat, None while this node
+# is not a member
+node_ring = None
+# timer() of this node's last successful heartbeat, None before it joined
+last_heartbeat = None
+HEARTBEAT_JOB_ID = "engine-heartbeat"
+
+
+def fleet_job_id(sampling_interval: int) -> str:
+    return "fleet-%ss" % (sampling_interval)
+
+
+def closed_boundary(sampling_interval: int, now: float = None) -> int:
+    # Epoch seconds of the newest bucket boundary older than the ingest grace.
+    # Fixed interval buckets start on multiples of their interval since the
+    # epoch, so every bucket before it is closed and complete.
+    now = time() if now is None else now
+    return int(
+        (now - settings.DETECTOR_INGEST_GRACE) // sampling_interval * sampling_interval
+    )
+
+
+def tick_phase(job_id: str, sampling_interval: int) -> float:
+    # Seconds into every interval at which a job ticks. A hash of the job id
+    # spreads detectors sharing an interval evenly and keeps each one on the
+    # same phase across restarts.
+    if not settings.DETECTOR_STAGGER_TICKS:
+        return 0
+    return zlib.crc32(job_id.encode()) / 2**32 * sampling_interval
+
+
+def tick_trigger(sampling_interval: int, job_id: str) -> IntervalTrigger:
+    # Aligned ticks fire the ingest grace after every bucket boundary, both
+    # aligned and staggered ticks are placed on the epoch grid plus a phase
+    jitter = settings.DETECTOR_TICK_JITTER or None
+    offset = tick_phase(job_id, sampling_interval)
+    if settings.DETECTOR_ALIGNED_TICKS:
+        offset += settings.DETECTOR_INGEST_GRACE
+    elif not settings.DETECTOR_STAGGER_TICKS:
+        return IntervalTrigger(seconds=sampling_interval, jitter=jitter)
+    first_tick = (time() - offset) // sampling_interval * sampling_interval
+    return IntervalTrigger(
+        seconds=sampling_interval,
+        start_date=datetime.fromtimestamp(
+            first_tick + sampling_interval + offset, timezone.utc
+        ),
+        jitter=jitter,
+    )
+
+
+def tick_end(sampling_interval: int):
+    # End of the range a tick searches: "now", or with aligned ticks the
+    # epoch milliseconds of the last closed boundary
+    if not settings.DETECTOR_ALIGNED_TICKS:
+        return "now"
+    return closed_boundary(sampling_interval) * 1000
+
+
+def closed_buckets(resolution_data: dict, end_time) -> dict:
+    # Drops the coarser buckets still open at an aligned end_time
+    if end_time == "now":
+        return resolution_data
+    return {
+        sampling_interval: data[data["key"] + sampling_interval * 1000 <= end_time]
+        for sampling_interval, data in resolution_data.items()
+    }
+
+
+def catch_up_lookback(detector_instance: Detector, resolutions: list) -> int:
+    # Seconds of NetFlow to fetch for a detector that skipped ticks, e.g. on
+    # the counter screen: back to its oldest evaluated bucket, at most
+    # window_size buckets of the coarsest resolution
+    longest = detector_instance.window_size * max(resolutions)
+    last_keys = [
+        detector_state(detector_instance, sampling_interval).last_key
+        for sampling_interval in resolutions
+    ]
+    if None in last_keys:
+        return longest
+    return int(min(longest, max(max(resolutions), time() - min(last_keys) / 1000)))
+
+
+def recent_lookback(sampling_interval: int, now: float = None) -> int:
+    # Seconds back to the start of the bucket before the newest closed one.
+    # Rounded down, so no sliver of an older bucket is read, the range holds
+    # the newest closed bucket whole and normally its judged predecessor.
+    now = time() if now is None else now
+    return int(now % sampling_interval + 2 * sampling_interval)
+
+
+def search_resolutions(
+    resolutions: list, elastic_host: str, elastic_index: str, lookback: int = None
+) -> dict:
+    # {sampling_interval: parsed buckets} from a single Elasticsearch search.
+    # Aligned ticks only read closed buckets and never wait, otherwise the
+    # search runs up to now until a first bucket shows up.
+    end_time = tick_end(resolutions[0])
+    if end_time == "now":
+        aggregations = get_netflow_resolutions(
+            end_time,
+            resolutions,
+            elastic_host,
+            elastic_index,
+            lookback,
+            stage_deadline("fetch"),
+        )
+    else:
+        aggregations = search_netflow_resolutions(
+            end_time,
+            resolutions,
+            elastic_host,
+            elastic_index,
+            lookback,
+            stage_deadline("fetch"),
+        )
+    return closed_buckets(split_resolutions(aggregations, resolutions), end_time)
+
+
+def fetch_lookback(
+    detector_instance: Detector, resolutions: list, screened: bool
+) -> int:
+    # Ticks read from the last judged bucket on, so every bucket is judged on
+    # all of its flows. Aligned ticks always catch up, a late tick must not
+    # skip a bucket, and so do detectors with the catch_up overrun policy.
+    # Other ticks go back no further than the bucket before the newest closed
+    # one, older ones they missed stay unjudged.
+    lookback = catch_up_lookback(detector_instance, resolutions)
+    if (
+        screened
+        or settings.DETECTOR_ALIGNED_TICKS
+        or detector_instance.overrun_policy == "catch_up"
+    ):
+        return lookback
+    return min(lookback, recent_lookback(max(resolutions)))
+
+
+def fetch_resolutions(detector_instance: Detector, screened: bool = False) -> dict:
+    # Every resolution of the detector from a single Elasticsearch search
+    resolutions = parse_resolutions(
+        detector_instance.sampling_interval, detector_instance.resolutions
+    )
+    return search_resolutions(
+        resolutions,
+        detector_instance.elastic_host,
+        detector_instance.elastic_index,
+        fetch_lookback(detector_instance, resolutions, screened),
+    )
+
+
+def fetch_destinations(detector_instance: Detector) -> list:
+    # Per-destination buckets since the last judged one, at most a window
+    sampling_interval = detector_instance.sampling_interval
+    last_key = destination_state(detector_instance).last_key
+    # Aligned ticks search up to a boundary, an interval back is a whole bucket
+    lookback = (
+        sampling_interval
+        if settings.DETECTOR_ALIGNED_TICKS
+        else recent_lookback(sampling_interval)
+    )
+    if last_key is not None:
+        lookback = int(
+            min(
+                detector_instance.window_size * sampling_interval,
+                max(sampling_interval, time() - last_key / 1000),
+            )
+        )
+    return get_netflow_by_destination(
+        tick_end(sampling_interval),
+        sampling_interval,
+        settings.DETECTOR_DESTINATION_PREFIX,
+        detector_instance.elastic_host,
+        detector_instance.elastic_index,
+        lookback,
+        stage_deadline("fetch"),
+    )
+
+
+def warm_start(detector_instance: Detector):
+    # One bounded search covering window_size buckets of every resolution,
+    # so the first scheduled tick already judges against a full window
+    resolutions = parse_resolutions(
+        detector_instance.sampling_interval, detector_instance.resolutions
+    )
+    end_time = tick_end(detector_instance.sampling_interval)
+    backfill(
+        closed_buckets(
+            split_resolutions(
+                search_netflow_resolutions(
+                    end_time,
+                    resolutions,
+                    detector_instance.elastic_host,
+                    detector_instance.elastic_index,
+                    (detector_instance.window_size + 1) * max(resolutions),
+                    stage_deadline("fetch"),
+                ),
+                resolutions,
+            ),
+            end_time,
+        ),
+        detector_instance,
+    )
+
+
+def report_timeout(job_id: str):
+    activity_log(
+        "error",
+        "retia-engine",
+        "detector",
+        "Detector job %s gave up on a stage past its deadline" % (job_id),
+    )
+
+
+def detector_job(detector_instance: Detector):
+    # A tick rejected for overlapping the previous one runs right after it,
+    # unless the detector's overrun policy skips it
+    while detector_tick(detector_instance):
+        pass
+
+
+def detector_tick(detector_instance: Detector) -> bool:
+    # Returns whether a tick was deferred to after this one
+    if shard_lapsed():
+        unschedule_all()
+        return False
+    print(
+        "\n\n\n\n\n----------------------------------------------------------------------------------"
+    )
+    device = str(detector_instance.device)
+    with bounded_run(
+        device,
+        [device],
+        detector_instance.sampling_interval,
+        lambda: report_timeout(device),
+        detector_instance.overrun_policy,
+    ) as run:
+        if not settings.DETECTOR_COUNTER_SCREEN or screen(
+            [detector_instance],
+            detector_instance.sampling_interval,
+            time(),
+            execute,
+        ):
+            with timed(device, "fetch"):
+                resolution_data = fetch_resolutions(
+                    detector_instance, settings.DETECTOR_COUNTER_SCREEN
+                )
+            stream_resolutions(resolution_data, detector_instance)
+            if settings.DETECTOR_DESTINATION_PREFIX:
+                with timed(device, "fetch"):
+                    buckets = fetch_destinations(detector_instance)
+                stream_destinations(buckets, detector_instance)
+    return run.deferred
+
+
+def fetch_fleet(detector_instances: list, screened: bool = False) -> list:
+    # Detectors reading the same index at the same resolutions share a single
+    # search, returns [(resolution_data, detector_instance)]
+    groups = {}
+    for detector_instance in detector_instances:
+        resolutions = parse_resolutions(
+            detector_instance.sampling_interval, detector_instance.resolutions
+        )
+        key = (
+            detector_instance.elastic_host,
+            detector_instance.elastic_index,
+            tuple(resolutions),
+        )
+        groups.setdefault(key, []).append(detector_instance)
+
+    fleet_data = []
+    for (elastic_host, elastic_index, resolutions), members in groups.items():
+        resolutions = list(resolutions)
+        # The member furthest behind decides how far the shared search reaches
+        lookback = max(
+            fetch_lookback(member, resolutions, screened) for member in members
+        )
+        if settings.DETECTOR_EXPORTER_FIELD:
+            exporters = sorted({str(member.device.mgmt_ipaddr) for member in members})
+            end_time = tick_end(resolutions[0])
+            by_exporter = get_netflow_by_exporter(
+                end_time,
+                resolutions,
+                settings.DETECTOR_EXPORTER_FIELD,
+                exporters,
+                elastic_host,
+                elastic_index,
+                lookback,
+                stage_deadline("fetch"),
+            )
+            resolution_data = {
+                exporter: closed_buckets(
+                    split_resolutions(aggregations, resolutions), end_time
+                )
+                for exporter, aggregations in by_exporter.items()
+            }
+            for member in members:
+                fleet_data.append(
+                    (resolution_data[str(member.device.mgmt_ipaddr)], member)
+                )
+        else:
+            # Without an exporter field every detector on the index reads the
+            # same aggregation anyway
+            resolution_data = search_resolutions(
+                resolutions, elastic_host, elastic_index, lookback
+            )
+            for member in members:
+                fleet_data.append((resolution_data, member))
+    return fleet_data
+
+
+def fleet_job(sampling_interval: int):
+    while fleet_tick(sampling_interval):
+        pass
+
+
+def fleet_tick(sampling_interval: int) -> bool:
+    # Returns whether a tick was deferred to after this one
+    if shard_lapsed():
+        unschedule_all()
+        return False
+    with fleet_members_lock:
+        detector_instances = list(fleet_members.get(sampling_interval, {}).values())
+    job_id = fleet_job_id(sampling_interval)
+    with bounded_run(
+        job_id,
+        [str(detector_instance.device) for detector_instance in detector_instances],
+        sampling_interval,
+        lambda: report_timeout(job_id),
+        # Members catch up through their lookback, see fetch_fleet
+        "coalesce",
+    ) as run:
+        if settings.DETECTOR_COUNTER_SCREEN:
+            detector_instances = screen(
+                detector_instances, sampling_interval, time(), execute
+            )
+        fetch_start = timer()
+        fleet_data = fetch_fleet(detector_instances, settings.DETECTOR_COUNTER_SCREEN)
+        # Members wait on the searches of the whole fleet before being evaluated
+        for detector_instance in detector_instances:
+            observe(str(detector_instance.device), "fetch", timer() - fetch_start)
+        stream_fleet(fleet_data)
+        if settings.DETECTOR_DESTINATION_PREFIX:
+            for detector_instance in detector_instances:
+                with timed(str(detector_instance.device), "fetch"):
+                    buckets = fetch_destinations(detector_instance)
+                stream_destinations(buckets, detector_instance)
+    return run.deferred
+
+
+def job_detectors(job_id: str) -> list:
+    # Detectors served by a scheduler job
+    with fleet_members_lock:
+        for sampling_interval, members in fleet_members.items():
+            if job_id == fleet_job_id(sampling_interval):
+                return list(members)
+    return [job_id]
+
+
+def tick_listener(event):
+    # Counts the ticks APScheduler could not run on time
+    if event.job_id == HEARTBEAT_JOB_ID:
+        return
+    if event.code == EVENT_JOB_MAX_INSTANCES:
+        # A deferred tick still runs, only late
+        outcome = "late" if defer_tick(event.job_id) else "dropped"
+    elif event.code == EVENT_JOB_MISSED:
+        outcome = "late"
+    else:
+        scheduled = event.scheduled_run_times[-1]
+        if (datetime.now(timezone.utc) - scheduled).total_seconds() <= 1:
+            return
+        outcome = "late"
+    for device in job_detectors(event.job_id):
+        count_tick(device, outcome)
+
+
+scheduler.add_listener(
+    tick_listener, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED | EVENT_JOB_SUBMITTED
+)
+
+
+def schedule_detector(detector_instance: Detector):
+    # Adds the jobs of a detector to this process' scheduler
+    device = str(detector_instance.device)
+    unschedule_detector(device)
+    if settings.DETECTOR_WARM_START:
+        try:
+            warm_start(detector_instance)
+        except Exception as e:
+            # A cold start still works, thresholds settle after window_size ticks
+            activity_log(
+                "error",
+                "retia-engine",
+                "detector",
+                "Detector device %s warm start failed: %s" % (device, e),
+            )
+    with scheduled_detectors_lock:
+        scheduled_detectors[device] = detector_instance
+    if settings.DETECTOR_FLEET_MODE:
+        # Detectors sharing a sampling interval share one job per tick
+        sampling_interval = detector_instance.sampling_interval
+        with fleet_members_lock:
+            fleet_members.setdefault(sampling_interval, {})[device] = detector_instance
+        if scheduler.get_job(fleet_job_id(sampling_interval)) is None:
+            scheduler.add_job(
+                func=fleet_job,
+                args=[sampling_interval],
+                trigger=tick_trigger(
+                    sampling_interval, fleet_job_id(sampling_interval)
+                ),
+                id=fleet_job_id(sampling_interval),
+                max_instances=1,
+                replace_existing=True,
+                # Members catch up through their lookback, see fetch_fleet
+                **scheduler_options("coalesce"),
+            )
+    else:
+        scheduler.add_job(
+            func=detector_job,
+            args=[detector_instance],
+            trigger=tick_trigger(detector_instance.sampling_interval, device),
+            id=device,
+            max_instances=1,
+            replace_existing=True,
+            **scheduler_options(detector_instance.overrun_policy),
+        )
+
+
+def unschedule_detector(device: str):
+    # A run in progress stops at its next stage
+    cancel_run(device)
+    with scheduled_detectors_lock:
+        scheduled_detectors.pop(device, None)
+    if scheduler.get_job(device) is not None:
+        scheduler.remove_job(device)
+    with fleet_members_lock:
+        for sampling_interval, members in list(fleet_members.items()):
+            members.pop(device, None)
+            if not members:
+                del fleet_members[sampling_interval]
+                cancel_run(fleet_job_id(sampling_interval))
+                if scheduler.get_job(fleet_job_id(sampling_interval)) is not None:
+                    scheduler.remove_job(fleet_job_id(sampling_interval))
+    drop_state(device)
+
+
+def owns_detector(device: str) -> bool:
+    return node_ring is not None and node_ring.owner(device) == node_name
+
+
+def start_detector(detector_instance: Detector):
+    # Marks the detector running, the node owning it runs its jobs
+    Detector.objects.filter(pk=detector_instance.pk).update(is_running=True)
+    if owns_detector(str(detector_instance.device)):
+        schedule_detector(detector_instance)
+
+
+def stop_detector(device: str):
+    Detector.objects.filter(pk=device).update(is_running=False)
+    unschedule_detector(device)
+
+
+def unschedule_all():
+    with scheduled_detectors_lock:
+        devices = list(scheduled_detectors)
+    for device in devices:
+        unschedule_detector(device)
+
+
+def reconcile_detectors(ring: HashRing, previous: HashRing = None):
+    # Schedules the running detectors of this node's shard, drops the others
+    # and reschedules the ones edited since they were scheduled. A detector
+    # moving here is only taken when the previous heartbeat agreed, which
+    # gives its former owner a heartbeat to notice the new ring and drop it.
+    wanted = {
+        str(detector_instance.device): detector_instance
+        for detector_instance in Detector.objects.select_related("device").filter(
+            is_running=True
+        )
+        if ring.owner(str(detector_instance.device)) == node_name
+    }
+    with scheduled_detectors_lock:
+        scheduled = dict(scheduled_detectors)
+    for device in scheduled:
+        if device not in wanted:
+            unschedule_detector(device)
+    for device, detector_instance in wanted.items():
+        current = scheduled.get(device)
+        if current is None and (
+            previous is None or previous.owner(device) != node_name
+        ):
+            continue
+        if current is None or current.modified_at != detector_instance.modified_at:
+            schedule_detector(detector_instance)
+            # Warm starts take a while, stay alive while resuming a shard
+            beat()
+
+
+def beat() -> HashRing:
+    # heartbeat() noting when it was made. The time is taken before the
+    # write, the row the other nodes go by is never older.
+    global last_heartbeat
+    started = timer()
+    ring = heartbeat()
+    last_heartbeat = started
+    return ring
+
+
+def shard_lapsed() -> bool:
+    # Past ENGINE_HEARTBEAT_SECONDS without a heartbeat the other nodes have
+    # taken this node's shard over, running it here too would detect and
+    # mitigate its devices twice
+    return (
+        last_heartbeat is not None
+        and timer() - last_heartbeat > settings.ENGINE_HEARTBEAT_SECONDS
+    )
+
+
+def heartbeat_job():
+    # Keeps this node in the engine membership and its shard scheduled. A
+    # node losing the database drops its jobs, the other nodes take its
+    # shard over once its heartbeat lapses. A node whose heartbeat lapsed
+    # anyway rejoins like a new one.
+    global node_ring
+    close_old_connections()
+    previous = node_ring
+    if shard_lapsed():
+        previous = node_ring = None
+        unschedule_all()
+    try:
+        node_ring = beat()
+        reconcile_detectors(node_ring, previous)
+    except DatabaseError:
+        node_ring = None
+        unschedule_all()
+
+
+def leave_membership():
+    global last_heartbeat, node_ring
+    last_heartbeat = None
+    if node_ring is not None:
+        node_ring = None
+        leave()
+
+
+def start_scheduling():
+    # Joins the engine nodes sharing the running detectors
+    scheduler.add_job(
+        func=heartbeat_job,
+        trigger=IntervalTrigger(seconds=settings.ENGINE_HEARTBEAT_SECONDS / 3),
+        id=HEARTBEAT_JOB_ID,
+        executor="heartbeat",
+        next_run_time=datetime.now(timezone.utc),
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=None,
+        replace_existing=True,
+    )
+    atexit.register(leave_membership)
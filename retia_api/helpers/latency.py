@@ -0,0 +1,134 @@
+from contextlib import contextmanager
+from threading import Lock
+from timeit import default_timer as timer
+
+import numpy as np
+
+# Stages of one detection, from fetching buckets to the mitigation ACL.
+# bucket_age is the time from a bucket closing to its verdict, mitigation the
+# time from a bucket closing to its ACL being written on the router.
+STAGES = (
+    "fetch",
+    "features",
+    "compute",
+    "attribution",
+    "acl",
+    "logging",
+    "bucket_age",
+    "mitigation",
+)
+
+# Upper bounds in seconds of the histogram buckets, the last one catches all
+BOUNDS = np.array(
+    [
+        0.001,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+        60,
+        120,
+        np.inf,
+    ]
+)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = np.zeros(len(BOUNDS), dtype=np.int64)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        seconds = np.atleast_1d(np.asarray(seconds, dtype=np.float64))
+        self.counts += np.bincount(
+            np.searchsorted(BOUNDS, seconds), minlength=len(BOUNDS)
+        )
+        self.sum += float(seconds.sum())
+
+    def quantile(self, q: float):
+        # Upper bound of the bucket holding the q-quantile
+        total = self.counts.sum()
+        if not total:
+            return None
+        bound = BOUNDS[np.searchsorted(np.cumsum(self.counts), q * total)]
+        return None if np.isinf(bound) else float(bound)
+
+
+# {detector: {stage: Histogram}}
+latencies = {}
+latencies_lock = Lock()
+
+
+def observe(detector: str, stage: str, seconds):
+    with latencies_lock:
+        histograms = latencies.setdefault(detector, {})
+        histograms.setdefault(stage, Histogram()).observe(seconds)
+
+
+@contextmanager
+def timed(detector: str, stage: str):
+    start = timer()
+    try:
+        yield
+    finally:
+        observe(detector, stage, timer() - start)
+
+
+def latency_summary(detector: str) -> dict:
+    with latencies_lock:
+        histograms = dict(latencies.get(detector, {}))
+        return {
+            stage: {
+                "count": int(histogram.counts.sum()),
+                "sum": histogram.sum,
+                "p50": histogram.quantile(0.5),
+                "p95": histogram.quantile(0.95),
+                "p99": histogram.quantile(0.99),
+                "buckets": {
+                    ("+Inf" if np.isinf(bound) else str(bound)): int(count)
+                    for bound, count in zip(BOUNDS, np.cumsum(histogram.counts))
+                },
+            }
+            for stage, histogram in sorted(
+                histograms.items(),
+                key=lambda item: (
+                    STAGES.index(item[0]) if item[0] in STAGES else len(STAGES)
+                ),
+            )
+        }
+
+
+def exposition() -> str:
+    # Every histogram in the Prometheus text format
+    lines = [
+        "# HELP retia_detector_stage_seconds Time spent per detection stage.",
+        "# TYPE retia_detector_stage_seconds histogram",
+    ]
+    with latencies_lock:
+        for detector, histograms in sorted(latencies.items()):
+            for stage, histogram in sorted(histograms.items()):
+                labels = 'detector="%s",stage="%s"' % (
+                    detector.replace("\\", "\\\\").replace('"', '\\"'),
+                    stage,
+                )
+                for bound, count in zip(BOUNDS, np.cumsum(histogram.counts)):
+                    lines.append(
+                        'retia_detector_stage_seconds_bucket{%s,le="%s"} %d'
+                        % (labels, "+Inf" if np.isinf(bound) else bound, count)
+                    )
+                lines.append(
+                    "retia_detector_stage_seconds_sum{%s} %r" % (labels, histogram.sum)
+                )
+                lines.append(
+                    "retia_detector_stage_seconds_count{%s} %d"
+                    % (labels, histogram.counts.sum())
+                )
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,55 @@
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+from retia_api.configurations import settings
+
+executor = None
+executor_lock = Lock()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global executor
+    with executor_lock:
+        if executor is None:
+            # Spawned workers only import the Django-free detection modules
+            executor = ProcessPoolExecutor(
+                max_workers=settings.DETECTOR_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return executor
+
+
+def restart_executor(broken: ProcessPoolExecutor):
+    global executor
+    with executor_lock:
+        if executor is broken:
+            executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+@atexit.register
+def shutdown_executor():
+    global executor
+    with executor_lock:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = None
+
+
+def execute(function, *args):
+    # Runs a detection kernel in the worker pool when DETECTOR_EXECUTION is
+    # "process", in the calling thread otherwise. A crashed worker breaks the
+    # whole pool, so it is replaced and the call retried.
+    if settings.DETECTOR_EXECUTION != "process":
+        return function(*args)
+    for attempt in range(settings.DETECTOR_WORKER_RETRIES + 1):
+        current = get_executor()
+        try:
+            return current.submit(function, *args).result()
+        except BrokenProcessPool:
+            restart_executor(current)
+            if attempt == settings.DETECTOR_WORKER_RETRIES:
+                raise
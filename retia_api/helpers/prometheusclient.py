@@ -0,0 +1,51 @@
+import json
+import re
+
+import requests
+
+from retia_api.configurations import settings
+
+
+def promql_regex(values: list) -> str:
+    # Alternation matching exactly the given label values inside a PromQL
+    # string, where backslashes are escaped once more
+    return "|".join(re.escape(str(value)).replace("\\", "\\\\") for value in values)
+
+
+def get_interface_rates(
+    metrics: dict, targets: list, interface_label: str, window: int, time: int
+) -> list:
+    # Per-second rates of the SNMP counters {feature: metric} over `window`
+    # seconds ending at `time`, for every (instance, interface) of targets in
+    # a single query. Series carry the feature name in a "feature" label.
+    selector = '{instance=~"%s",%s=~"%s"}' % (
+        promql_regex(sorted({instance for instance, _ in targets})),
+        interface_label,
+        promql_regex(sorted({interface for _, interface in targets})),
+    )
+    return query(
+        " or ".join(
+            'label_replace(rate(%s%s[%ss]), "feature", "%s", "", "")'
+            % (metric, selector, window, feature)
+            for feature, metric in metrics.items()
+        ),
+        time,
+    )
+
+
+def get_detector_series(records: list, detectors: list, time: int) -> list:
+    # Latest samples of the recorded series `records` of every detector
+    return query(
+        '{__name__=~"%s",detector=~"%s"}'
+        % (promql_regex(records), promql_regex(detectors)),
+        time,
+    )
+
+
+def query(promql: str, time: int) -> list:
+    return json.loads(
+        requests.get(
+            url=settings.PROMETHEUS_URL + "/api/v1/query",
+            params={"query": promql, "time": time},
+        ).text
+    )["data"]["result"]
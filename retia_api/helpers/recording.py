@@ -0,0 +1,100 @@
+import json
+from pathlib import Path
+
+import requests
+import yaml
+
+from retia_api.configurations import settings
+from retia_api.databases.models import Detector
+
+PROMETHEUS_CONFIG = "./prometheus/prometheus.yml"
+# Relative to the directory of PROMETHEUS_CONFIG
+RULES_FILE = "retia_detector_rules.yml"
+
+# SNMP counters of the interface towards the protected server, {feature: metric}
+COUNTER_METRICS = {"packets": "ifHCOutUcastPkts", "octets": "ifHCOutOctets"}
+
+# Rolling statistics recorded per detector and counter feature
+RECORDED_STATS = ("rate", "avg", "stddev", "samples")
+
+# Shortest rate() window, it needs two SNMP scrapes to return a value
+MIN_RATE_WINDOW = 60
+
+
+def record_name(feature: str, stat: str) -> str:
+    return "retia_detector:%s:%s" % (feature, stat)
+
+
+def recording_rules(detector_instances: list) -> dict:
+    # Prometheus rule groups keeping the counter rate of every detector
+    # interface and its avg/stddev/sample count over the previous window_size
+    # buckets. One group per sampling interval evaluates once per bucket.
+    groups = {}
+    for detector_instance in detector_instances:
+        sampling_interval = detector_instance.sampling_interval
+        detector = json.dumps(str(detector_instance.device))
+        selector = "{instance=%s,%s=%s}" % (
+            json.dumps(str(detector_instance.device.mgmt_ipaddr)),
+            settings.PROMETHEUS_INTERFACE_LABEL,
+            json.dumps(detector_instance.device_interface_to_server),
+        )
+        window = "[%ss] offset %ss" % (
+            detector_instance.window_size * sampling_interval,
+            sampling_interval,
+        )
+        rules = groups.setdefault(sampling_interval, [])
+        for feature, metric in COUNTER_METRICS.items():
+            rate = "%s{detector=%s}" % (record_name(feature, "rate"), detector)
+            rules.append(
+                {
+                    "record": record_name(feature, "rate"),
+                    "expr": "rate(%s%s[%ss])"
+                    % (metric, selector, max(sampling_interval, MIN_RATE_WINDOW)),
+                    "labels": {"detector": str(detector_instance.device)},
+                }
+            )
+            for stat, function in (
+                ("avg", "avg_over_time"),
+                ("stddev", "stddev_over_time"),
+                ("samples", "count_over_time"),
+            ):
+                rules.append(
+                    {
+                        "record": record_name(feature, stat),
+                        "expr": "%s(%s%s)" % (function, rate, window),
+                    }
+                )
+    return {
+        "groups": [
+            {
+                "name": "retia-detector-%ss" % (sampling_interval),
+                "interval": "%ss" % (sampling_interval),
+                "rules": rules,
+            }
+            for sampling_interval, rules in sorted(groups.items())
+        ]
+    }
+
+
+def write_recording_rules():
+    # Regenerates the rules file from the Detector table, registers it in
+    # prometheus.yml and reloads Prometheus
+    if not settings.DETECTOR_COUNTER_RULES:
+        return
+    detector_instances = Detector.objects.select_related("device").all()
+    rules_path = Path(PROMETHEUS_CONFIG).parent / RULES_FILE
+    with open(rules_path, "w") as f:
+        yaml.safe_dump(
+            recording_rules(detector_instances),
+            stream=f,
+            sort_keys=False,
+        )
+
+    with open(PROMETHEUS_CONFIG) as f:
+        prometheus_config = yaml.safe_load(f)
+    rule_files = prometheus_config.get("rule_files") or []
+    if not RULES_FILE in rule_files:
+        prometheus_config["rule_files"] = rule_files + [RULES_FILE]
+        with open(PROMETHEUS_CONFIG, "w") as f:
+            yaml.safe_dump(prometheus_config, stream=f)
+    requests.post(url=settings.PROMETHEUS_URL + "/-/reload")
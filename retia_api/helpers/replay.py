@@ -0,0 +1,114 @@
+import json
+from pathlib import Path
+from timeit import default_timer as timer
+
+import numpy as np
+
+from retia_api.helpers.features import feature_matrix, parse_buckets, parse_columns
+from retia_api.helpers.streaming import DetectorState
+from retia_api.helpers.thresholds import detect
+
+# Columns of NPZ and Parquet bucket files, an optional "label" column marks
+# buckets that belong to an attack
+BUCKET_COLUMNS = ("key", "packets", "USIP", "UDIP", "UPR")
+
+
+def load_buckets(path) -> tuple:
+    # Returns (parsed buckets, labels or None) from a captured
+    # get_netflow_resampled output or a labelled trace
+    path = Path(path)
+    if path.suffix == ".npz":
+        with np.load(path) as columns:
+            parsed = parse_columns(*(columns[name] for name in BUCKET_COLUMNS))
+            labels = columns["label"].astype(bool) if "label" in columns else None
+    elif path.suffix == ".parquet":
+        try:
+            import pandas as pd
+        except ImportError as exc:
+            raise ImportError("Parquet bucket files require pandas") from exc
+        columns = pd.read_parquet(path)
+        parsed = parse_columns(*(columns[name].to_numpy() for name in BUCKET_COLUMNS))
+        labels = columns["label"].to_numpy(dtype=bool) if "label" in columns else None
+    else:
+        with open(path) as f:
+            if path.suffix == ".json":
+                buckets = json.load(f)
+                # Whole Elasticsearch responses are accepted as well
+                if isinstance(buckets, dict):
+                    buckets = buckets["aggregations"]["all_attributes"]["buckets"]
+            else:
+                buckets = [json.loads(line) for line in f if line.strip()]
+        parsed = parse_buckets(buckets)
+        labels = (
+            np.array([bool(bucket.get("label")) for bucket in buckets])
+            if any("label" in bucket for bucket in buckets)
+            else None
+        )
+    return parsed, labels
+
+
+def replay(
+    parsed: np.ndarray,
+    window_size: int,
+    sampling_interval: int,
+    labels: np.ndarray = None,
+    mode: str = "stream",
+    algorithm: str = "beta",
+) -> dict:
+    # Runs detection over stored buckets without the scheduler, Elasticsearch
+    # or mitigation. "stream" evaluates like the scheduled detector_job with
+    # the given streaming algorithm, so it flags what production would have,
+    # "batch" like core().
+    features = feature_matrix(parsed)
+    start = timer()
+    if mode == "batch":
+        thresholds, flags, betas = detect(features, window_size)
+    elif mode == "stream":
+        thresholds, flags, betas = DetectorState(
+            window_size, sampling_interval, algorithm
+        ).update(features, parsed["key"])
+    else:
+        raise ValueError("Unknown replay mode %s" % (mode))
+    elapsed = timer() - start
+    verdicts = flags.all(axis=0)
+
+    summary = {
+        "buckets": len(parsed),
+        "positives": int(verdicts.sum()),
+        "seconds": elapsed,
+        "buckets_per_second": len(parsed) / elapsed if elapsed > 0 else None,
+    }
+    if labels is not None:
+        summary.update(score(verdicts, labels))
+    return {
+        "summary": summary,
+        "timeline": {
+            "key": parsed["key"],
+            "features": features,
+            "thresholds": thresholds,
+            "betas": betas,
+            "flags": flags,
+            "verdicts": verdicts,
+        },
+    }
+
+
+def score(verdicts: np.ndarray, labels: np.ndarray) -> dict:
+    true_positives = int((verdicts & labels).sum())
+    false_positives = int((verdicts & ~labels).sum())
+    false_negatives = int((~verdicts & labels).sum())
+    return {
+        "true_positives": true_positives,
+        "false_positives": false_positives,
+        "false_negatives": false_negatives,
+        "precision": (
+            true_positives / (true_positives + false_positives)
+            if true_positives + false_positives
+            else None
+        ),
+        "recall": (
+            true_positives / (true_positives + false_negatives)
+            if true_positives + false_negatives
+            else None
+        ),
+    }
@@ -0,0 +1,82 @@
+import numpy as np
+
+from retia_api.helpers.features import parse_buckets, parse_columns
+
+# Cardinalities of the sampling interval buckets that make up a coarser bucket
+CARDINALITIES = ("USIP", "UDIP", "UPR")
+
+
+def parse_resolutions(sampling_interval: int, resolutions: str) -> list:
+    # Sampling intervals evaluated by one detector, its own first. Extra
+    # resolutions are comma separated seconds, multiples of sampling_interval.
+    intervals = [sampling_interval]
+    for item in (resolutions or "").split(","):
+        if not item.strip():
+            continue
+        interval = int(item)
+        if interval <= 0 or interval % sampling_interval:
+            raise ValueError(
+                "Resolution %ss is not a multiple of the %ss sampling interval"
+                % (interval, sampling_interval)
+            )
+        if interval not in intervals:
+            intervals.append(interval)
+    return intervals
+
+
+def aggregation_name(sampling_interval: int) -> str:
+    return "cardinalities_%ss" % (sampling_interval)
+
+
+def cardinality_aggs(resolutions: list) -> dict:
+    # Sibling date_histograms of the extra resolutions. Distinct counts do not
+    # add up across buckets, so Elasticsearch computes them in the same request
+    # while packets are summed locally from the finest buckets.
+    return {
+        aggregation_name(interval): {
+            "date_histogram": {
+                "field": "@timestamp",
+                "fixed_interval": "{}s".format(interval),
+            },
+            "aggs": {
+                "USIP": {"cardinality": {"field": "netflow.source_ipv4_address"}},
+                "UDIP": {"cardinality": {"field": "netflow.destination_ipv4_address"}},
+                "UPR": {"cardinality": {"field": "netflow.protocol_identifier"}},
+            },
+        }
+        for interval in resolutions
+    }
+
+
+def downsample_sum(
+    keys: np.ndarray, values: np.ndarray, coarse_keys: np.ndarray, interval: int
+) -> np.ndarray:
+    # Sums values into the coarse buckets their keys fall in. Fixed intervals
+    # are aligned to the epoch, so a bucket starts at key - key % interval.
+    starts = keys - keys % (interval * 1000)
+    positions = np.searchsorted(coarse_keys, starts)
+    inside = positions < len(coarse_keys)
+    inside[inside] = coarse_keys[positions[inside]] == starts[inside]
+    return np.bincount(
+        positions[inside], weights=values[inside], minlength=len(coarse_keys)
+    )
+
+
+def split_resolutions(aggregations: dict, resolutions: list) -> dict:
+    # {sampling_interval: parsed buckets} of one multi-resolution response
+    fine = parse_buckets(aggregations["all_attributes"]["buckets"])
+    result = {resolutions[0]: fine}
+    for interval in resolutions[1:]:
+        buckets = aggregations[aggregation_name(interval)]["buckets"]
+        key = np.fromiter((bucket["key"] for bucket in buckets), np.int64, len(buckets))
+        cardinalities = [
+            np.fromiter(
+                (bucket[name]["value"] for bucket in buckets),
+                np.float64,
+                len(buckets),
+            )
+            for name in CARDINALITIES
+        ]
+        packets = downsample_sum(fine["key"], fine["packets"], key, interval)
+        result[interval] = parse_columns(key, packets, *cardinalities)
+    return result
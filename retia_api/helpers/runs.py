@@ -0,0 +1,172 @@
+from contextlib import contextmanager
+from threading import Event, Lock, local
+from timeit import default_timer as timer
+
+from retia_api.configurations import settings
+
+# What happens to ticks a detector could not start on time. "skip" drops
+# them, "coalesce" runs them once however late, also right after a run they
+# overlapped, "catch_up" runs them once and fetches every bucket since the
+# last judged one.
+OVERRUN_POLICIES = ("skip", "coalesce", "catch_up")
+
+# Tick outcomes counted per detector. dropped: the previous run still held the
+# job and the policy skips, late: ticks started over a second past their time,
+# after the run they overlapped or not at all, overrun: runs longer than the
+# sampling interval, timed_out and cancelled: runs aborted early.
+TICK_OUTCOMES = ("dropped", "late", "overrun", "timed_out", "cancelled")
+
+
+class RunCancelled(Exception):
+    pass
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Run:
+    # A tick in progress. deferred is set once a later tick of its job was
+    # rejected for overlapping it, the job then runs once more right after.
+    def __init__(self):
+        self.deferred = False
+
+
+class Deadline:
+    # Time budget of one stage of a run, also aborting it once cancelled
+    def __init__(self, seconds: float = None, cancelled: Event = None):
+        self.expires = None if seconds is None else timer() + seconds
+        self.cancelled = cancelled
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(self.expires - timer(), 0)
+
+    def check(self):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise RunCancelled()
+        if self.expires is not None and timer() >= self.expires:
+            raise DeadlineExceeded()
+
+
+def scheduler_options(policy: str) -> dict:
+    # APScheduler job options of an overrun policy
+    if policy == "skip":
+        return {"coalesce": True, "misfire_grace_time": 1}
+    return {"coalesce": True, "misfire_grace_time": None}
+
+
+# {detector: {outcome: count}}
+tick_counters = {}
+tick_counters_lock = Lock()
+
+
+def count_tick(detector: str, outcome: str):
+    with tick_counters_lock:
+        counters = tick_counters.setdefault(detector, dict.fromkeys(TICK_OUTCOMES, 0))
+        counters[outcome] += 1
+
+
+def tick_summary(detector: str) -> dict:
+    with tick_counters_lock:
+        return dict(tick_counters.get(detector, dict.fromkeys(TICK_OUTCOMES, 0)))
+
+
+# Cancellation events of the runs in progress, {job_id: Event}
+running = {}
+# Runs in progress taking over the ticks they overlap, {job_id: Run}
+deferring = {}
+running_lock = Lock()
+current = local()
+
+
+def stage_deadline(stage: str) -> Deadline:
+    # Deadline of a stage of the run in progress on this thread
+    return Deadline(
+        settings.DETECTOR_STAGE_DEADLINES.get(stage),
+        getattr(current, "cancelled", None),
+    )
+
+
+def cancel_run(job_id: str):
+    with running_lock:
+        cancelled = running.get(job_id)
+    if cancelled is not None:
+        cancelled.set()
+
+
+def defer_tick(job_id: str) -> bool:
+    # Hands a tick rejected by max_instances to the run still holding its
+    # job, False when that run's policy drops it
+    with running_lock:
+        run = deferring.get(job_id)
+        if run is None:
+            return False
+        run.deferred = True
+        return True
+
+
+@contextmanager
+def bounded_run(
+    job_id: str,
+    detectors: list,
+    sampling_interval: int,
+    on_timeout=None,
+    policy: str = "skip",
+):
+    # Runs one tick of a job under its stage deadlines and counts overruns.
+    # Timeouts and cancellations end the tick without failing the job, which
+    # keeps its schedule. Yields the Run, unless the policy skips them the
+    # ticks it overlapped leave it deferred.
+    cancelled = Event()
+    run = Run()
+    with running_lock:
+        running[job_id] = cancelled
+        if policy != "skip":
+            deferring[job_id] = run
+    current.cancelled = cancelled
+    start = timer()
+    try:
+        yield run
+    except DeadlineExceeded:
+        for detector in detectors:
+            count_tick(detector, "timed_out")
+        if on_timeout is not None:
+            on_timeout()
+    except RunCancelled:
+        for detector in detectors:
+            count_tick(detector, "cancelled")
+    finally:
+        current.cancelled = None
+        with running_lock:
+            if running.get(job_id) is cancelled:
+                del running[job_id]
+            if deferring.get(job_id) is run:
+                del deferring[job_id]
+            # A stopped detector has no ticks left to run
+            if cancelled.is_set():
+                run.deferred = False
+        if timer() - start > sampling_interval:
+            for detector in detectors:
+                count_tick(detector, "overrun")
+
+
+def tick_exposition() -> str:
+    # Tick outcome counters of every detector in the Prometheus text format
+    lines = [
+        "# HELP retia_detector_ticks_total Detector ticks by outcome.",
+        "# TYPE retia_detector_ticks_total counter",
+    ]
+    with tick_counters_lock:
+        for detector, counters in sorted(tick_counters.items()):
+            for outcome in TICK_OUTCOMES:
+                lines.append(
+                    'retia_detector_ticks_total{detector="%s",outcome="%s"} %d'
+                    % (
+                        detector.replace("\\", "\\\\").replace('"', '\\"'),
+                        outcome,
+                        counters[outcome],
+                    )
+                )
+    return "\n".join(lines) + "\n"
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 
 from retia_api.databases.models import ActivityLog, Detector, Device
+from retia_api.helpers.resolution import parse_resolutions
 
 
 class DeviceSerializer(serializers.ModelSerializer):
@@ -28,6 +29,10 @@ class DetectorSerializer(serializers.ModelSerializer):
             "device_interface_to_server",
             "window_size",
             "sampling_interval",
+            "resolutions",
+            "algorithm",
+            "overrun_policy",
+            "history_length",
             "elastic_host",
             "elastic_index",
             "filebeat_host",
@@ -36,6 +41,22 @@ class DetectorSerializer(serializers.ModelSerializer):
             "modified_at",
         ]
 
+    def validate(self, data):
+        # Extra resolutions must be multiples of the sampling interval
+        current = self.instance or Detector()
+        try:
+            parse_resolutions(
+                data.get("sampling_interval", current.sampling_interval),
+                data.get("resolutions", current.resolutions),
+            )
+        except ValueError as e:
+            raise serializers.ValidationError({"resolutions": str(e)})
+        if data.get("history_length", current.history_length) < 1:
+            raise serializers.ValidationError(
+                {"history_length": "History length must be at least one bucket"}
+            )
+        return data
+
 
 class ActivityLogSerializer(serializers.ModelSerializer):
     class Meta:
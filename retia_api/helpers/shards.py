@@ -0,0 +1,61 @@
+import os
+import socket
+import zlib
+from bisect import bisect
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from retia_api.configurations import settings
+from retia_api.databases.models import EngineNode
+
+# Identity of this process in the engine node table
+node_name = "%s:%s:%s" % (socket.gethostname(), os.getpid(), uuid4().hex[:8])
+
+# Points per node on the hash ring, more of them even out the shard sizes
+VIRTUAL_NODES = 64
+
+
+def ring_hash(key: str) -> int:
+    return zlib.crc32(key.encode())
+
+
+class HashRing:
+    # Consistent hashing of detector devices over the live engine nodes. A
+    # node joining or leaving only moves the detectors on the arcs it takes
+    # or frees, about 1/N of them.
+    def __init__(self, nodes: list, replicas: int = VIRTUAL_NODES):
+        self.nodes = sorted(nodes)
+        points = sorted(
+            (ring_hash("%s#%s" % (node, idx)), node)
+            for node in self.nodes
+            for idx in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, device: str):
+        if not self.owners:
+            return None
+        return self.owners[bisect(self.hashes, ring_hash(device)) % len(self.owners)]
+
+
+def heartbeat(now: datetime = None) -> HashRing:
+    # Marks this node alive and returns the ring of the nodes seen alive
+    # within ENGINE_HEARTBEAT_SECONDS
+    now = now or datetime.now(timezone.utc)
+    timeout = timedelta(seconds=settings.ENGINE_HEARTBEAT_SECONDS)
+    EngineNode.objects.update_or_create(name=node_name, defaults={"heartbeat_at": now})
+    # Rows of processes gone for good, names are unique per process
+    EngineNode.objects.filter(heartbeat_at__lt=now - 10 * timeout).delete()
+    return HashRing(
+        list(
+            EngineNode.objects.filter(heartbeat_at__gte=now - timeout).values_list(
+                "name", flat=True
+            )
+        )
+    )
+
+
+def leave():
+    # Lets the other nodes take the shard over without waiting for a timeout
+    EngineNode.objects.filter(name=node_name).delete()
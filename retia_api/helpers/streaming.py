@@ -0,0 +1,164 @@
+from contextlib import ExitStack
+from threading import Lock
+
+import numpy as np
+
+from retia_api.helpers.algorithms import get_algorithm
+from retia_api.helpers.thresholds import FEATURES
+
+
+def run_inline(function, *args):
+    return function(*args)
+
+
+def advance(algorithm: str, arrays: dict, features: np.ndarray) -> tuple:
+    # Steps arrays through every bucket on the last axis of features. Pure and
+    # picklable so it can run in a detector worker process, returns
+    # (arrays, thresholds, flags, betas).
+    algorithm = get_algorithm(algorithm)
+    thresholds = np.empty(features.shape)
+    flags = np.empty(features.shape, dtype=bool)
+    betas = np.empty(features.shape)
+    for idx in range(features.shape[-1]):
+        thresholds[..., idx], flags[..., idx], betas[..., idx] = algorithm.step(
+            arrays, features[..., idx]
+        )
+    return arrays, thresholds, flags, betas
+
+
+def advance_fleet(
+    algorithm: str, arrays: dict, features: np.ndarray, counts: np.ndarray
+) -> tuple:
+    # advance() for states stacked on the leading axis where row i only has
+    # counts[i] buckets, features padded on the last axis. Rows out of
+    # buckets keep their arrays and get unspecified results in the padding.
+    algorithm = get_algorithm(algorithm)
+    thresholds = np.empty(features.shape)
+    flags = np.zeros(features.shape, dtype=bool)
+    betas = np.empty(features.shape)
+    for idx in range(features.shape[-1]):
+        active = counts > idx
+        if active.all():
+            thresholds[..., idx], flags[..., idx], betas[..., idx] = algorithm.step(
+                arrays, features[..., idx]
+            )
+            continue
+        subset = {name: array[active] for name, array in arrays.items()}
+        (
+            thresholds[active, ..., idx],
+            flags[active, ..., idx],
+            betas[active, ..., idx],
+        ) = algorithm.step(subset, features[active, ..., idx])
+        for name, array in subset.items():
+            arrays[name][active] = array
+    return arrays, thresholds, flags, betas
+
+
+class DetectorState:
+    def __init__(
+        self,
+        window_size: int,
+        sampling_interval: int,
+        algorithm="beta",
+        metrics: int = len(FEATURES),
+    ):
+        self.window_size = window_size
+        self.sampling_interval = sampling_interval
+        self.algorithm = get_algorithm(algorithm)
+        self.last_key = None
+        self.arrays = self.algorithm.init_state(window_size, metrics=metrics)
+        self.lock = Lock()
+
+    def new_mask(self, keys: np.ndarray, now: float) -> np.ndarray:
+        # Bucket keys are epoch milliseconds of the bucket start
+        closed = keys + self.sampling_interval * 1000 <= now * 1000
+        if self.last_key is None:
+            return closed
+        return closed & (keys > self.last_key)
+
+    def update(self, features: np.ndarray, keys: list, execute=run_inline) -> tuple:
+        # features is (metrics, buckets) ordered by key
+        with self.lock:
+            self.arrays, thresholds, flags, betas = execute(
+                advance, self.algorithm.name, self.arrays, features
+            )
+            if len(keys):
+                self.last_key = int(keys[-1])
+        return thresholds, flags, betas
+
+
+detector_states = {}
+detector_states_lock = Lock()
+
+
+def get_state(
+    name: str,
+    window_size: int,
+    sampling_interval: int,
+    algorithm: str = "beta",
+    metrics: int = len(FEATURES),
+) -> DetectorState:
+    with detector_states_lock:
+        state = detector_states.get(name)
+        if (
+            state is None
+            or state.window_size != window_size
+            or state.sampling_interval != sampling_interval
+            or state.algorithm.name != algorithm
+        ):
+            state = DetectorState(window_size, sampling_interval, algorithm, metrics)
+            detector_states[name] = state
+        return state
+
+
+def resolution_name(name: str, sampling_interval: int) -> str:
+    # State name of a detector evaluated at an extra resolution
+    return "%s@%ss" % (name, sampling_interval)
+
+
+def drop_state(name: str):
+    # Drops the state of a detector along with its extra resolutions
+    with detector_states_lock:
+        for state_name in list(detector_states):
+            if state_name == name or state_name.startswith(name + "@"):
+                del detector_states[state_name]
+
+
+def update_fleet(states: list, features: list, keys: list, execute=run_inline) -> list:
+    # Step many detectors at once: the states sharing an algorithm, window
+    # size and metrics are stacked once into (detectors, metrics, ...) arrays
+    # and go through every bucket column in a single execute() call. Returns
+    # (thresholds, flags, betas) per state.
+    results = [None] * len(states)
+    groups = {}
+    for idx, state in enumerate(states):
+        groups.setdefault(
+            (state.algorithm.name, state.window_size, features[idx].shape[0]), []
+        ).append(idx)
+
+    with ExitStack() as stack:
+        for state in states:
+            stack.enter_context(state.lock)
+        for (algorithm, _, metrics), members in groups.items():
+            counts = np.array([len(keys[idx]) for idx in members])
+            batch = {
+                name: np.stack([states[idx].arrays[name] for idx in members])
+                for name in states[members[0]].arrays
+            }
+            values = np.zeros((len(members), metrics, counts.max()))
+            for row, idx in enumerate(members):
+                values[row, :, : counts[row]] = features[idx]
+            batch, thresholds, flags, betas = execute(
+                advance_fleet, algorithm, batch, values, counts
+            )
+            for row, idx in enumerate(members):
+                for name, array in batch.items():
+                    states[idx].arrays[name] = array[row]
+                if counts[row]:
+                    states[idx].last_key = int(keys[idx][-1])
+                results[idx] = (
+                    thresholds[row, :, : counts[row]],
+                    flags[row, :, : counts[row]],
+                    betas[row, :, : counts[row]],
+                )
+    return results
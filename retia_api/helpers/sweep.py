@@ -0,0 +1,104 @@
+from itertools import product
+
+import numpy as np
+
+from retia_api.helpers.algorithms import get_algorithm
+from retia_api.helpers.streaming import advance
+from retia_api.helpers.thresholds import CHUNK_ELEMENTS
+
+
+def sweep(
+    features: np.ndarray,
+    window_sizes,
+    initial_betas,
+    beta_steps,
+    labels: np.ndarray = None,
+) -> dict:
+    # Verdict counts of the live streaming beta threshold for every
+    # (window_size, initial_beta, beta_step) on one (metrics, buckets)
+    # history, as a detector started on its first bucket: trailing windows,
+    # no verdict until a window is full. The beta settings of a window size
+    # are stacked into one state and stepped through the buckets together,
+    # in memory-bounded chunks.
+    features = np.asarray(features, dtype=np.float64)
+    count = features.shape[-1]
+    window_sizes = np.asarray(sorted(set(window_sizes)), dtype=np.int64)
+    betas = np.array(list(product(initial_betas, beta_steps)), dtype=np.float64)
+    betas = betas.reshape(-1, 2)
+    window_index = np.repeat(np.arange(len(window_sizes)), len(betas))
+    alarms = np.zeros(len(window_index), dtype=np.int64)
+    true_positives = np.zeros(len(window_index), dtype=np.int64)
+
+    algorithm = get_algorithm("beta")
+    columns = max(1, CHUNK_ELEMENTS // max(1, len(betas) * features.shape[0]))
+    for idx, window_size in enumerate(window_sizes.tolist()):
+        rows = slice(idx * len(betas), (idx + 1) * len(betas))
+        state = algorithm.init_state(
+            window_size,
+            (len(betas),),
+            features.shape[0],
+            betas[:, 0],
+            betas[:, 1],
+        )
+        for start in range(0, count, columns):
+            chunk = features[:, start : start + columns]
+            state, _, flags, _ = advance(
+                algorithm.name,
+                state,
+                np.broadcast_to(chunk, (len(betas),) + chunk.shape),
+            )
+            verdicts = flags.all(axis=1)
+            alarms[rows] += verdicts.sum(axis=-1)
+            if labels is not None:
+                true_positives[rows] += verdicts @ labels[
+                    start : start + columns
+                ].astype(np.int64)
+
+    result = {
+        "window_size": window_sizes[window_index],
+        "initial_beta": np.tile(betas[:, 0], len(window_sizes)),
+        "beta_step": np.tile(betas[:, 1], len(window_sizes)),
+        "alarms": alarms,
+        "alarm_rate": alarms / count if count else np.zeros(len(alarms)),
+    }
+    if labels is not None:
+        attacks = int(labels.sum())
+        with np.errstate(divide="ignore", invalid="ignore"):
+            precision = true_positives / alarms
+            recall = (
+                true_positives / attacks if attacks else np.full(len(alarms), np.nan)
+            )
+            f1 = 2 * precision * recall / (precision + recall)
+        result.update(
+            {
+                "true_positives": true_positives,
+                "false_positives": alarms - true_positives,
+                "false_negatives": attacks - true_positives,
+                "precision": precision,
+                "recall": recall,
+                "f1": f1,
+            }
+        )
+    return result
+
+
+def rank(results: dict, limit: int = None) -> list:
+    # One row per parameter set over every sampling interval of
+    # {sampling_interval: sweep()}, best first: highest F1 when labels were
+    # given, otherwise the fewest alarms
+    rows = []
+    for sampling_interval, result in results.items():
+        for idx in range(len(result["alarms"])):
+            row = {"sampling_interval": sampling_interval}
+            for name, column in result.items():
+                value = column[idx].item()
+                row[name] = None if value != value else value
+            rows.append(row)
+    rows.sort(
+        key=lambda row: (
+            -(row.get("f1") or 0),
+            row["alarm_rate"],
+            row["window_size"],
+        )
+    )
+    return rows if limit is None else rows[:limit]
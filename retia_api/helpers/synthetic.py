@@ -0,0 +1,67 @@
+import numpy as np
+
+SHAPES = ("baseline", "ramp", "pulse", "carpet", "low_and_slow")
+
+# Epoch milliseconds of the first synthetic bucket
+START_KEY = 1714000000000
+
+
+def synthetic_columns(
+    count: int, shape: str = "baseline", sampling_interval: int = 20, seed: int = 0
+) -> dict:
+    # Raw bucket columns (key, packets, USIP, UDIP, UPR) plus a label column.
+    # Every shape shares a diurnal baseline, attacks occupy 60%-80% of the run.
+    if shape not in SHAPES:
+        raise ValueError("Unknown traffic shape %s" % (shape))
+    rng = np.random.default_rng(seed)
+    position = np.arange(count)
+    day = 86400 / sampling_interval
+    diurnal = 1 + 0.3 * np.sin(2 * np.pi * position / day)
+
+    label = (position >= 0.6 * count) & (position < 0.8 * count)
+    progress = np.clip((position - 0.6 * count) / max(0.2 * count, 1), 0, 1)
+    intensity = np.zeros(count)
+    if shape == "ramp":
+        intensity = np.where(label, 40 * progress, 0)
+    elif shape == "pulse":
+        intensity = np.where(label & (position % 10 < 3), 40, 0)
+    elif shape == "carpet":
+        intensity = np.where(label, 20, 0)
+    elif shape == "low_and_slow":
+        intensity = np.where(label, 0.5, 0)
+    label = label & (intensity > 0)
+
+    packets = rng.poisson(5000 * diurnal * (1 + intensity))
+    USIP = rng.poisson(30 * diurnal * (1 + intensity))
+    # Carpet bombing spreads the flood over a whole prefix of destinations
+    UDIP = rng.poisson(10 * diurnal * (1 + (intensity if shape == "carpet" else 0)))
+    UPR = rng.integers(2, 5, count)
+    return {
+        "key": START_KEY + sampling_interval * 1000 * position,
+        "packets": packets.astype(np.float64),
+        "USIP": USIP,
+        "UDIP": UDIP,
+        "UPR": UPR,
+        "label": label,
+    }
+
+
+def synthetic_buckets(columns: dict) -> list:
+    # Same columns shaped like the all_attributes buckets from Elasticsearch
+    return [
+        {
+            "key": key,
+            "doc_count": 1,
+            "packets": {"value": packets},
+            "USIP": {"value": USIP},
+            "UDIP": {"value": UDIP},
+            "UPR": {"value": UPR},
+        }
+        for key, packets, USIP, UDIP, UPR in zip(
+            columns["key"].tolist(),
+            columns["packets"].tolist(),
+            columns["USIP"].tolist(),
+            columns["UDIP"].tolist(),
+            columns["UPR"].tolist(),
+        )
+    ]
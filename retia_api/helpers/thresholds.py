@@ -0,0 +1,79 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Rows of the feature matrix, in the order nescient evaluates them
+FEATURES = ("packets", "USIP", "USIP/UDIP", "USIP/UPR")
+
+INITIAL_BETA = 1.5
+BETA_STEP = 0.5
+BETA_FLOOR = 1.0
+
+# Upper bound of window elements materialised at once by rolling_mean_std
+CHUNK_ELEMENTS = 1 << 20
+
+
+def rolling_mean_std(values: np.ndarray, window_size: int) -> tuple:
+    # Mean and population std of every values[..., j : j + window_size]. Each
+    # window is reduced on its own contiguous row so the results match
+    # np.mean/np.std over the same slice bit for bit.
+    windows = sliding_window_view(values, window_size, axis=-1)
+    count = windows.shape[-2]
+    means = np.empty(windows.shape[:-1])
+    stds = np.empty(windows.shape[:-1])
+    rows = max(1, CHUNK_ELEMENTS // (window_size * max(1, values[..., 0].size)))
+    for start in range(0, count, rows):
+        chunk = np.ascontiguousarray(windows[..., start : start + rows, :])
+        means[..., start : start + rows] = chunk.mean(axis=-1)
+        stds[..., start : start + rows] = chunk.std(axis=-1)
+    return means, stds
+
+
+def beta_scan(
+    rising: np.ndarray,
+    initial_beta: float = INITIAL_BETA,
+    beta_step: float = BETA_STEP,
+    beta_floor: float = BETA_FLOOR,
+) -> np.ndarray:
+    # beta[j] = max(beta_floor, beta[j - 1] +/- beta_step) is a random walk
+    # reflected at beta_floor, so it has a closed form over the running minimum
+    # of the unreflected walk instead of a Python loop.
+    walk = np.cumsum(np.where(rising, beta_step, -beta_step), axis=-1)
+    lowest = np.minimum.accumulate(np.minimum(walk, beta_floor - initial_beta), axis=-1)
+    return beta_floor + walk - lowest
+
+
+def detect(
+    features: np.ndarray,
+    window_size: int,
+    initial_beta: float = INITIAL_BETA,
+    beta_step: float = BETA_STEP,
+    beta_floor: float = BETA_FLOOR,
+) -> tuple:
+    # Adaptive beta threshold over the last axis of features, returns
+    # (thresholds, flags, betas) shaped like features.
+    features = np.asarray(features, dtype=np.float64)
+    count = features.shape[-1]
+    thresholds = np.empty(features.shape)
+    betas = np.empty(features.shape)
+    if count == 0:
+        return thresholds, np.zeros(features.shape, dtype=bool), betas
+
+    # Windows look forward from each bucket and run into zero padding at the end
+    padding = np.zeros(features.shape[:-1] + (window_size - 1,))
+    means, stds = rolling_mean_std(
+        np.concatenate((features, padding), axis=-1), window_size
+    )
+    rising = means[..., 1:] > 2 * means[..., :-1]
+
+    betas[..., 0] = initial_beta
+    betas[..., 1:] = beta_scan(rising, initial_beta, beta_step, beta_floor)
+
+    spread = means[..., 1:] + stds[..., 1:]
+    thresholds[..., 1:] = np.where(
+        rising, spread / betas[..., 1:], spread * betas[..., 1:]
+    )
+    # The first threshold only sees the buckets that actually exist
+    head = features[..., :window_size]
+    thresholds[..., 0] = (head.mean(axis=-1) + head.std(axis=-1)) * initial_beta
+
+    return thresholds, features > thresholds, betas
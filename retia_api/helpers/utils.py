@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import NamedTuple
 
 
@@ -1043,6 +1044,7 @@ def getprotospecs() -> list:
     return speclist
 
 
+@lru_cache(maxsize=None)
 def getprotobynumber(number: int) -> str:
     speclist = getprotospecs()
     for spec in speclist:
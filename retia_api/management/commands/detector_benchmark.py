@@ -0,0 +1,243 @@
+import json
+import tracemalloc
+from contextlib import ExitStack
+from pathlib import Path
+from timeit import default_timer as timer
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.management.base import BaseCommand, CommandError
+
+from retia_api import nescient
+from retia_api.configurations import settings
+from retia_api.databases.models import Device
+from retia_api.helpers.features import feature_matrix, parse_buckets
+from retia_api.helpers.history import drop_history
+from retia_api.helpers.streaming import drop_state
+from retia_api.helpers.synthetic import SHAPES, synthetic_buckets, synthetic_columns
+from retia_api.helpers.thresholds import detect
+
+DEFAULT_BASELINE = Path(settings.BASE_DIR) / "benchmarks" / "detector_baseline.json"
+
+# Live detection steps every bucket through the streaming state, the same
+# work each time, so it is measured on at most this many buckets of a run
+STREAM_BUCKETS = 100000
+
+# Detectors stepped together in a fleet run
+FLEET_SIZE = 16
+
+# Metrics a run fails on when they grow past the tolerance
+COMPARED_METRICS = (
+    "core_ns_per_bucket",
+    "stream_ns_per_bucket",
+    "fleet_ns_per_bucket",
+    "peak_bytes",
+)
+
+# Flow returned by the stubbed attribution lookup
+STUB_FLOW = {
+    "source_ipv4_address": "198.51.100.7",
+    "destination_ipv4_address": "192.0.2.10",
+    "destination_transport_port": 80,
+    "protocol_identifier": 6,
+}
+
+
+def stub_flows(times, *args, **kwargs) -> list:
+    return [STUB_FLOW] * len(times)
+
+
+def stub_call(*args, **kwargs):
+    return None
+
+
+def stub_acl(conn_strings: dict, req_to_show: dict) -> dict:
+    return {
+        "code": 200,
+        "body": {
+            "name": req_to_show["name"],
+            "rules": [{"sequence": "1", "action": "deny", "prefix": "198.51.100.1"}],
+        },
+    }
+
+
+def stubbed_io() -> ExitStack:
+    # Replaces every Elasticsearch, RESTCONF and database call of the detection
+    # path with plain functions, so only the engine itself is measured.
+    # Histories stay in memory.
+    stack = ExitStack()
+    stack.enter_context(mock.patch.object(settings, "DETECTOR_HISTORY_DIR", None))
+    stubs = {
+        "get_netflow_data_after": stub_flows,
+        "getAclDetail": stub_acl,
+        "activity_log": stub_call,
+        "createAcl": stub_call,
+        "setAclDetail": stub_call,
+        "print": stub_call,
+    }
+    for name, stub in stubs.items():
+        stack.enter_context(mock.patch.object(nescient, name, stub, create=True))
+    return stack
+
+
+def benchmark_detector(hostname: str, window_size: int) -> SimpleNamespace:
+    return SimpleNamespace(
+        device=Device(
+            hostname=hostname,
+            mgmt_ipaddr="192.0.2.1",
+            port=443,
+            username="benchmark",
+            secret="benchmark",
+        ),
+        device_interface_to_server="GigabitEthernet1",
+        window_size=window_size,
+        sampling_interval=20,
+        resolutions="",
+        algorithm="beta",
+        history_length=settings.DETECTOR_HISTORY_LENGTH,
+        elastic_host="127.0.0.1",
+        elastic_index="benchmark",
+    )
+
+
+def start_over(detector_instances: list):
+    for detector_instance in detector_instances:
+        drop_state(str(detector_instance.device))
+        drop_history(str(detector_instance.device))
+
+
+def stream_run(data, detector_instance):
+    # A starting detector streaming every bucket in one tick
+    start_over([detector_instance])
+    nescient.stream_resolutions(
+        {detector_instance.sampling_interval: data}, detector_instance
+    )
+
+
+def fleet_run(data, detector_instances: list):
+    start_over(detector_instances)
+    nescient.stream_fleet(
+        [
+            ({detector_instance.sampling_interval: data}, detector_instance)
+            for detector_instance in detector_instances
+        ]
+    )
+
+
+def best_of(repeat: int, function, *args) -> float:
+    elapsed = []
+    for _ in range(repeat):
+        start = timer()
+        function(*args)
+        elapsed.append(timer() - start)
+    return min(elapsed)
+
+
+class Command(BaseCommand):
+    help = "Benchmark the detection engine on synthetic traffic"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shapes", default=",".join(SHAPES))
+        parser.add_argument("--sizes", default="10,100,1000,10000,100000,1000000")
+        parser.add_argument("--window-sizes", default="1,10,100")
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+        parser.add_argument(
+            "--save-baseline",
+            action="store_true",
+            help="store this run as the baseline instead of comparing against it",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.25,
+            help="allowed relative slowdown or memory growth against the baseline",
+        )
+
+    def handle(self, *args, **options):
+        rows = {}
+        with stubbed_io():
+            for shape in options["shapes"].split(","):
+                for size in map(int, options["sizes"].split(",")):
+                    columns = synthetic_columns(size, shape)
+                    buckets = synthetic_buckets(columns)
+                    for window_size in map(int, options["window_sizes"].split(",")):
+                        name = "%s/%s/%s" % (shape, size, window_size)
+                        rows[name] = self.measure(
+                            buckets, window_size, options["repeat"]
+                        )
+                        self.stdout.write("%s %s" % (name, json.dumps(rows[name])))
+
+        baseline_path = Path(options["baseline"])
+        if options["save_baseline"]:
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(baseline_path, "w") as f:
+                json.dump(rows, f, indent=2)
+            self.stdout.write("Baseline saved to %s" % (baseline_path))
+        elif baseline_path.exists():
+            with open(baseline_path) as f:
+                self.compare(rows, json.load(f), options["tolerance"])
+
+    def measure(self, buckets: list, window_size: int, repeat: int) -> dict:
+        detector_instance = benchmark_detector("benchmark", window_size)
+        fleet = [
+            benchmark_detector("benchmark-%s" % (idx), window_size)
+            for idx in range(FLEET_SIZE)
+        ]
+        count = len(buckets)
+        # Large runs are measured once, they dominate the wall-clock time
+        repeat = repeat if count < 100000 else 1
+
+        core_seconds = best_of(repeat, nescient.core, buckets, detector_instance)
+        data = parse_buckets(buckets)
+        N = detect(feature_matrix(data), window_size)[1]
+        handle_result_seconds = best_of(
+            repeat, nescient.handle_result, range(count), N, data, detector_instance
+        )
+        streamed = data[:STREAM_BUCKETS]
+        stream_seconds = best_of(repeat, stream_run, streamed, detector_instance)
+        # The fleet shares out the streamed buckets, every member a slice
+        member_data = streamed[: max(len(streamed) // FLEET_SIZE, 1)]
+        fleet_seconds = best_of(repeat, fleet_run, member_data, fleet)
+
+        # Memory of the live path. tracemalloc only sees the blocks alive at
+        # a time, not how many were allocated.
+        tracemalloc.start()
+        stream_run(streamed, detector_instance)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        # Blocks allocated during the call that are still alive afterwards
+        retained_blocks = sum(
+            stat.count for stat in tracemalloc.take_snapshot().statistics("filename")
+        )
+        tracemalloc.stop()
+        start_over([detector_instance, *fleet])
+
+        return {
+            "core_ns_per_bucket": core_seconds * 1e9 / count,
+            "handle_result_ns_per_bucket": handle_result_seconds * 1e9 / count,
+            "stream_ns_per_bucket": stream_seconds * 1e9 / len(streamed),
+            "fleet_ns_per_bucket": fleet_seconds
+            * 1e9
+            / (len(member_data) * FLEET_SIZE),
+            "peak_bytes": peak_bytes,
+            "retained_blocks": retained_blocks,
+            "positives": int(N.all(axis=0).sum()),
+        }
+
+    def compare(self, rows: dict, baseline: dict, tolerance: float):
+        regressions = []
+        for name, row in rows.items():
+            if name not in baseline:
+                continue
+            for metric in COMPARED_METRICS:
+                # Baselines saved before a metric existed don't hold it
+                if metric not in baseline[name]:
+                    continue
+                if row[metric] > baseline[name][metric] * (1 + tolerance):
+                    regressions.append(
+                        "%s %s: %.0f -> %.0f"
+                        % (name, metric, baseline[name][metric], row[metric])
+                    )
+        if regressions:
+            raise CommandError("Regressions found:\n%s" % ("\n".join(regressions)))
+        self.stdout.write("No regressions against the baseline")
@@ -0,0 +1,52 @@
+import json
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from retia_api.databases.models import Detector
+from retia_api.helpers.algorithms import ALGORITHMS
+from retia_api.helpers.replay import load_buckets, replay
+
+
+class Command(BaseCommand):
+    help = "Replay stored netflow buckets through the detector without side effects"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="NPZ, Parquet, JSON or JSON-lines buckets")
+        parser.add_argument("--device", help="take the detector config of a device")
+        parser.add_argument("--window-size", type=int)
+        parser.add_argument("--sampling-interval", type=int)
+        parser.add_argument("--mode", choices=["stream", "batch"], default="stream")
+        parser.add_argument("--algorithm", choices=list(ALGORITHMS))
+        parser.add_argument("--timeline", help="write the per-bucket timeline as NPZ")
+
+    def handle(self, *args, **options):
+        window_size = options["window_size"]
+        sampling_interval = options["sampling_interval"]
+        algorithm = options["algorithm"]
+        if options["device"]:
+            try:
+                detector = Detector.objects.get(pk=options["device"])
+            except Detector.DoesNotExist:
+                raise CommandError("Detector %s not found." % (options["device"]))
+            window_size = window_size or detector.window_size
+            sampling_interval = sampling_interval or detector.sampling_interval
+            algorithm = algorithm or detector.algorithm
+        if window_size is None or sampling_interval is None:
+            raise CommandError(
+                "Either --device or both --window-size and --sampling-interval are required."
+            )
+
+        parsed, labels = load_buckets(options["path"])
+        result = replay(
+            parsed,
+            window_size,
+            sampling_interval,
+            labels,
+            options["mode"],
+            algorithm or "beta",
+        )
+
+        if options["timeline"]:
+            np.savez_compressed(options["timeline"], **result["timeline"])
+        self.stdout.write(json.dumps(result["summary"], indent=2))
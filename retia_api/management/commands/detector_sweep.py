@@ -0,0 +1,65 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from retia_api.databases.models import Detector
+from retia_api.helpers.features import feature_matrix
+from retia_api.helpers.replay import load_buckets
+from retia_api.helpers.sweep import rank, sweep
+from retia_api.helpers.thresholds import BETA_STEP, INITIAL_BETA
+
+
+def numbers(value: str, cast=float) -> list:
+    return [cast(item) for item in value.split(",") if item]
+
+
+class Command(BaseCommand):
+    help = "Rank detector parameters over stored netflow buckets"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "paths",
+            nargs="+",
+            help="NPZ, Parquet, JSON or JSON-lines buckets, one per sampling interval",
+        )
+        parser.add_argument("--device", help="take the detector config of a device")
+        parser.add_argument(
+            "--sampling-intervals",
+            help="sampling interval of each path, in the same order",
+        )
+        parser.add_argument("--window-sizes", help="comma separated")
+        parser.add_argument("--initial-betas", default=str(INITIAL_BETA))
+        parser.add_argument("--beta-steps", default=str(BETA_STEP))
+        parser.add_argument("--limit", type=int, default=20)
+
+    def handle(self, *args, **options):
+        sampling_intervals = window_sizes = None
+        if options["sampling_intervals"]:
+            sampling_intervals = numbers(options["sampling_intervals"], int)
+        if options["window_sizes"]:
+            window_sizes = numbers(options["window_sizes"], int)
+        if options["device"]:
+            try:
+                detector = Detector.objects.get(pk=options["device"])
+            except Detector.DoesNotExist:
+                raise CommandError("Detector %s not found." % (options["device"]))
+            sampling_intervals = sampling_intervals or [detector.sampling_interval]
+            window_sizes = window_sizes or [detector.window_size]
+        if sampling_intervals is None or window_sizes is None:
+            raise CommandError(
+                "Either --device or both --window-sizes and --sampling-intervals are required."
+            )
+        if len(sampling_intervals) != len(options["paths"]):
+            raise CommandError("Give one sampling interval per path.")
+
+        results = {}
+        for path, sampling_interval in zip(options["paths"], sampling_intervals):
+            parsed, labels = load_buckets(path)
+            results[sampling_interval] = sweep(
+                feature_matrix(parsed),
+                window_sizes,
+                numbers(options["initial_betas"]),
+                numbers(options["beta_steps"]),
+                labels,
+            )
+        self.stdout.write(json.dumps(rank(results, options["limit"]), indent=2))
@@ -0,0 +1,92 @@
+import json
+import signal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+from urllib.parse import unquote
+
+from django.core.management.base import BaseCommand
+
+from retia_api.configurations import settings
+from retia_api.configurations.scheduler import scheduler
+from retia_api.helpers.jobs import (
+    leave_membership,
+    scheduled_detectors,
+    start_scheduling,
+    unschedule_all,
+)
+from retia_api.helpers.latency import exposition, latency_summary
+from retia_api.helpers.runs import tick_exposition, tick_summary
+from retia_api.helpers.shards import node_name
+
+# Per-detector JSON summaries served at /detector/<device>/<name>
+SUMMARIES = {"latency": latency_summary, "ticks": tick_summary}
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # Detection metrics of this worker, the API process does not run any
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts == ["metrics"]:
+            self.reply(
+                (exposition() + tick_exposition()).encode(),
+                "text/plain; version=0.0.4",
+            )
+        elif (
+            len(parts) == 3
+            and parts[0] == "detector"
+            and parts[2] in SUMMARIES
+            and unquote(parts[1]) in scheduled_detectors
+        ):
+            self.reply(
+                json.dumps(SUMMARIES[parts[2]](unquote(parts[1]))).encode(),
+                "application/json",
+            )
+        else:
+            # Unknown path or a detector of another worker's shard
+            self.send_error(404)
+
+    def reply(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = "Run the detectors marked running, sharded with the other workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=settings.DETECTOR_WORKER_METRICS_PORT,
+            help="serve /metrics on this port, 0 to disable",
+        )
+
+    def handle(self, *args, **options):
+        stopping = Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stopping.set())
+
+        server = None
+        if options["metrics_port"]:
+            server = ThreadingHTTPServer(("", options["metrics_port"]), MetricsHandler)
+            Thread(target=server.serve_forever, daemon=True).start()
+
+        scheduler.start()
+        start_scheduling()
+        self.stdout.write("Detector worker %s started" % (node_name))
+        while not stopping.wait(1):
+            pass
+
+        # Hands the shard over first, then cancels the runs in progress
+        self.stdout.write("Detector worker %s stopping" % (node_name))
+        leave_membership()
+        unschedule_all()
+        scheduler.shutdown()
+        if server is not None:
+            server.shutdown()
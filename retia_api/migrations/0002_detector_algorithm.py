@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("retia_api", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="detector",
+            name="algorithm",
+            field=models.CharField(
+                choices=[
+                    ("beta", "beta"),
+                    ("ewma", "ewma"),
+                    ("cusum", "cusum"),
+                    ("mad", "mad"),
+                ],
+                default="beta",
+                max_length=16,
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("retia_api", "0002_detector_algorithm"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="detector",
+            name="resolutions",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+    ]
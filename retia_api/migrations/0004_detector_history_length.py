@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("retia_api", "0003_detector_resolutions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="detector",
+            name="history_length",
+            field=models.IntegerField(default=4320),
+        ),
+    ]
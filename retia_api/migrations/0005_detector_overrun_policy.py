@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("retia_api", "0004_detector_history_length"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="detector",
+            name="overrun_policy",
+            field=models.CharField(
+                choices=[
+                    ("skip", "skip"),
+                    ("coalesce", "coalesce"),
+                    ("catch_up", "catch_up"),
+                ],
+                default="skip",
+                max_length=16,
+            ),
+        ),
+    ]
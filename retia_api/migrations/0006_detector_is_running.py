@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("retia_api", "0005_detector_overrun_policy"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="detector",
+            name="is_running",
+            field=models.BooleanField(default=False),
+        ),
+    ]
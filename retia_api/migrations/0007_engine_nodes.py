@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("retia_api", "0006_detector_is_running"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EngineNode",
+            fields=[
+                (
+                    "name",
+                    models.CharField(max_length=255, primary_key=True, serialize=False),
+                ),
+                ("heartbeat_at", models.DateTimeField()),
+            ],
+        ),
+    ]
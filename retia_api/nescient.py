@@ -1,11 +1,22 @@
 from datetime import datetime
+from time import time
 from timeit import default_timer as timer
 
 import numpy as np
-import pandas as pd
 
+from retia_api.configurations import settings
 from retia_api.databases.models import Detector
-from retia_api.helpers.elasticclient import get_netflow_data_at_nearest_time
+from retia_api.helpers.destinations import (
+    DestinationState,
+    destination_buckets,
+    destination_matrix,
+    destination_name,
+    get_destination_state,
+)
+from retia_api.helpers.elasticclient import SearchError, get_netflow_data_after
+from retia_api.helpers.features import feature_matrix, parse_buckets
+from retia_api.helpers.history import DetectorHistory, get_history, read_history
+from retia_api.helpers.latency import observe, timed
 from retia_api.helpers.logging import activity_log
 from retia_api.helpers.operation import (
     createAcl,
@@ -14,159 +25,333 @@ from retia_api.helpers.operation import (
     getAclList,
     setAclDetail,
 )
+from retia_api.helpers.pool import execute
+from retia_api.helpers.resolution import parse_resolutions
+from retia_api.helpers.runs import DeadlineExceeded, stage_deadline
+from retia_api.helpers.streaming import (
+    DetectorState,
+    get_state,
+    resolution_name,
+    update_fleet,
+)
+from retia_api.helpers.thresholds import detect
 from retia_api.helpers.utils import getprotobynumber
 
 
 def core(data_to_be_used: list, detector_instance: Detector):
-    sampling_interval = detector_instance.sampling_interval
-    window_size = detector_instance.window_size
-
-    A1_all = []
-    A2_all = []
-    A3_all = []
-    A4_all = []
-
-    for bucket in data_to_be_used:
-        A1_all.append([bucket["key"], bucket["packets"]["value"]])
-        A2_all.append([bucket["key"], bucket["USIP"]["value"]])
-        A3_all.append(
-            [
-                bucket["key"],
-                (
-                    0
-                    if bucket["USIP"]["value"] == 0 or bucket["UDIP"]["value"] == 0
-                    else bucket["USIP"]["value"] / bucket["UDIP"]["value"]
-                ),
-            ]
+    device = str(detector_instance.device)
+    with timed(device, "features"):
+        data = parse_buckets(data_to_be_used)
+        features = feature_matrix(data)
+    with timed(device, "compute"):
+        Threshold_all, N_all, beta_all = execute(
+            detect, features, detector_instance.window_size
         )
-        A4_all.append(
-            [
-                bucket["key"],
-                (
-                    0
-                    if bucket["USIP"]["value"] == 0 or bucket["UPR"]["value"] == 0
-                    else bucket["USIP"]["value"] / bucket["UPR"]["value"]
-                ),
-            ]
+
+    j_to_end = range(len(data))
+    handle_result(j_to_end, N_all, data, detector_instance)
+
+
+def state_name(detector_instance: Detector, sampling_interval: int) -> str:
+    device = str(detector_instance.device)
+    if sampling_interval == detector_instance.sampling_interval:
+        return device
+    return resolution_name(device, sampling_interval)
+
+
+def detector_state(
+    detector_instance: Detector, sampling_interval: int = None
+) -> DetectorState:
+    sampling_interval = sampling_interval or detector_instance.sampling_interval
+    return get_state(
+        state_name(detector_instance, sampling_interval),
+        detector_instance.window_size,
+        sampling_interval,
+        detector_instance.algorithm,
+    )
+
+
+def detector_history(
+    detector_instance: Detector, sampling_interval: int = None
+) -> DetectorHistory:
+    sampling_interval = sampling_interval or detector_instance.sampling_interval
+    return get_history(
+        state_name(detector_instance, sampling_interval),
+        detector_instance.history_length,
+    )
+
+
+def read_detector_history(
+    detector_instance: Detector, sampling_interval: int = None
+) -> DetectorHistory:
+    # History as last written by the process running the detector
+    sampling_interval = sampling_interval or detector_instance.sampling_interval
+    return read_history(state_name(detector_instance, sampling_interval))
+
+
+def new_buckets(data: np.ndarray, state: DetectorState) -> np.ndarray:
+    return data[state.new_mask(data["key"], time())]
+
+
+def stream(data_to_be_used: list, detector_instance: Detector):
+    stream_resolutions(
+        {detector_instance.sampling_interval: parse_buckets(data_to_be_used)},
+        detector_instance,
+    )
+
+
+def stream_resolutions(resolution_data: dict, detector_instance: Detector):
+    # Only buckets closed since the previous tick are evaluated, against the
+    # window state this detector carries between ticks for every resolution
+    # of {sampling_interval: parsed buckets}
+    evaluated = {
+        sampling_interval: evaluate(data, detector_instance, sampling_interval)
+        for sampling_interval, data in resolution_data.items()
+    }
+    # Every resolution is in the history before any is reported
+    for sampling_interval, (data, N_all) in evaluated.items():
+        if len(data):
+            observe_bucket_age(data, detector_instance, sampling_interval)
+            j_to_end = reported_buckets(
+                data, N_all, detector_instance, sampling_interval
+            )
+            handle_result(j_to_end, N_all, data, detector_instance, sampling_interval)
+
+
+def backfill(resolution_data: dict, detector_instance: Detector):
+    # Seeds the window state and history of a starting detector from past
+    # buckets. Nothing is mitigated, the verdicts on history are only kept.
+    for sampling_interval, data in resolution_data.items():
+        evaluate(data, detector_instance, sampling_interval)
+
+
+def evaluate(
+    data: np.ndarray, detector_instance: Detector, sampling_interval: int
+) -> tuple:
+    # Steps the detector state of one resolution through its new buckets,
+    # returns (new buckets, flags)
+    device = str(detector_instance.device)
+    state = detector_state(detector_instance, sampling_interval)
+    with timed(device, "features"):
+        data = new_buckets(data, state)
+        if not len(data):
+            return data, None
+        features = feature_matrix(data)
+    with timed(device, "compute"):
+        Threshold_all, N_all, beta_all = state.update(features, data["key"], execute)
+    detector_history(detector_instance, sampling_interval).append(
+        data["key"], features, Threshold_all, beta_all, N_all
+    )
+    return data, N_all
+
+
+def stream_fleet(fleet_data: list):
+    # Same as stream_resolutions() for a list of (resolution_data,
+    # detector_instance), with the threshold step of every detector and
+    # resolution done in one vectorized pass
+    states, features, keys, batches = [], [], [], []
+    for resolution_data, detector_instance in fleet_data:
+        with timed(str(detector_instance.device), "features"):
+            for sampling_interval, data in resolution_data.items():
+                state = detector_state(detector_instance, sampling_interval)
+                data = new_buckets(data, state)
+                if len(data):
+                    states.append(state)
+                    features.append(feature_matrix(data))
+                    keys.append(data["key"])
+                    batches.append((data, detector_instance, sampling_interval))
+
+    start = timer()
+    results = update_fleet(states, features, keys, execute)
+    # Every member waited for the whole fleet step
+    elapsed = timer() - start
+    for device in {str(batch[1].device) for batch in batches}:
+        observe(device, "compute", elapsed)
+
+    for batch, matrix, result in zip(batches, features, results):
+        data, detector_instance, sampling_interval = batch
+        Threshold_all, N_all, beta_all = result
+        detector_history(detector_instance, sampling_interval).append(
+            data["key"], matrix, Threshold_all, beta_all, N_all
+        )
+    for batch, result in zip(batches, results):
+        data, detector_instance, sampling_interval = batch
+        N_all = result[1]
+        observe_bucket_age(data, detector_instance, sampling_interval)
+        j_to_end = reported_buckets(data, N_all, detector_instance, sampling_interval)
+        handle_result(j_to_end, N_all, data, detector_instance, sampling_interval)
+
+
+def finer_positive(
+    data: np.ndarray, detector_instance: Detector, sampling_interval: int
+) -> np.ndarray:
+    # Buckets whose span holds a positive verdict at a finer resolution of
+    # the detector, from the history of that resolution
+    spans = data["key"] + sampling_interval * 1000
+    covered = np.zeros(len(data), dtype=bool)
+    for finer in parse_resolutions(
+        detector_instance.sampling_interval, detector_instance.resolutions
+    ):
+        if finer >= sampling_interval:
+            continue
+        records = detector_history(detector_instance, finer).slice(
+            int(data["key"][0]), int(spans[-1]) - 1
         )
+        positives = records["key"][records["verdict"]]
+        if not len(positives):
+            continue
+        first = np.minimum(np.searchsorted(positives, data["key"]), len(positives) - 1)
+        covered |= (positives[first] >= data["key"]) & (positives[first] < spans)
+    return covered
 
-    A_all = (
-        pd.DataFrame(A1_all),
-        pd.DataFrame(A2_all),
-        pd.DataFrame(A3_all),
-        pd.DataFrame(A4_all),
+
+def reported_buckets(
+    data: np.ndarray,
+    N_all: np.ndarray,
+    detector_instance: Detector,
+    sampling_interval: int,
+) -> np.ndarray:
+    # Buckets to attribute, log and mitigate. A positive bucket already
+    # flagged at a finer resolution is the same traffic, reported there once.
+    positive = N_all.all(axis=0)
+    if not positive.any() or sampling_interval == detector_instance.sampling_interval:
+        return np.arange(len(data))
+    return np.flatnonzero(
+        ~(positive & finer_positive(data, detector_instance, sampling_interval))
     )
 
-    Threshold_all = []
-    N_all = []
-    beta_all = []
-
-    j_to_end = range(len(A1_all))
-
-    for A in A_all:
-        # Init values
-        K = window_size
-        T = sampling_interval
-        beta = 1.5
-        j = 0
-        current_threshold_array = list()
-        current_N_array = list()
-        current_beta_array = list()
-
-        A_list = A.iloc[:, 1].to_list()
-        safe_A_list = [*A_list, *([0] * K * T)]
-
-        current_moving_A = A.iloc[j : j + K, 1].to_list()
-        current_moving_mean = np.mean(current_moving_A)
-        current_moving_variance = np.std(current_moving_A)
-        current_threshold = (current_moving_mean + current_moving_variance) * beta
-
-        current_threshold_array.append([j, current_threshold])
-        current_beta_array.append([j, beta])
-
-        # while j <= K*T-1 and j < len(A1_all.iloc[:, 0].to_list()):
-        while j < len(A1_all):
-            if j < 0 and j % K * T == 0:
-                beta = 1.5
-                current_moving_A = safe_A_list[j : j + K]
-                current_moving_mean = np.mean(current_moving_A)
-                current_moving_variance = np.std(current_moving_A)
-                current_threshold = (
-                    current_moving_mean + current_moving_variance
-                ) * beta
-
-                current_threshold_array.append([j, current_threshold])
-                current_beta_array.append([j, beta])
-                if safe_A_list[j : j + 1][0] > current_threshold:
-                    current_N_array.append([j, True])
-                else:
-                    current_N_array.append([j, False])
-            else:
-                if safe_A_list[j : j + 1][0] > current_threshold:
-                    current_N_array.append([j, True])
-                else:
-                    current_N_array.append([j, False])
-                j = j + 1
-                current_j = j
-                previous_j = j - 1
-                previous_moving_mean = np.mean(safe_A_list[previous_j : previous_j + K])
-                current_moving_mean = np.mean(safe_A_list[current_j : current_j + K])
-                if current_moving_mean > 2 * previous_moving_mean:
-                    beta = beta + 0.5
-                    current_threshold = (
-                        current_moving_mean
-                        + np.std(safe_A_list[current_j : current_j + K])
-                    ) / beta
-                else:
-                    beta = beta - 0.5
-                    if beta < 1.0:
-                        beta = 1
-                    current_threshold = (
-                        current_moving_mean
-                        + np.std(safe_A_list[current_j : current_j + K])
-                    ) * beta
-                current_threshold_array.append([current_j, current_threshold])
-                current_beta_array.append([j, beta])
-
-        Threshold_all.append(current_threshold_array)
-        N_all.append(current_N_array)
-        beta_all.append(current_beta_array)
-    handle_result(j_to_end, N_all, data_to_be_used, detector_instance)
-
-
-def handle_result(j, N, data, detector_instance: Detector):
-    for idx in j:
-        timestamp = int(str(data[idx]["key"])[:-3])
-        if (
-            N[0][idx][1] is True
-            and N[1][idx][1] is True
-            and N[2][idx][1] is True
-            and N[3][idx][1] is True
-        ):
-            positive_traffic = get_netflow_data_at_nearest_time(
-                timestamp,
-                detector_instance.elastic_host,
-                detector_instance.elastic_index,
+
+def destination_state(detector_instance: Detector) -> DestinationState:
+    return get_destination_state(
+        destination_name(str(detector_instance.device)),
+        detector_instance.window_size,
+        detector_instance.sampling_interval,
+        detector_instance.algorithm,
+        settings.DETECTOR_DESTINATION_LIMIT,
+    )
+
+
+def stream_destinations(buckets: list, detector_instance: Detector):
+    # Judges every tracked destination on its own traffic, all of them in one
+    # vectorized step per bucket. Only positive destination buckets are
+    # handled, the exporter-wide stage already reports the negative ones.
+    device = str(detector_instance.device)
+    state = destination_state(detector_instance)
+    with timed(device, "features"):
+        destinations, keys, features = destination_matrix(buckets)
+        new = state.new_mask(keys, time())
+        if not new.any():
+            return
+        keys = keys[new]
+        destinations, features = state.track(destinations, keys, features[..., new])
+    with timed(device, "compute"):
+        Threshold_all, N_all, beta_all = state.update(features, keys, execute)
+
+    alarms = N_all.all(axis=1)
+    for row in np.flatnonzero(alarms.any(axis=1)):
+        with timed(device, "logging"):
+            activity_log(
+                "warning",
+                detector_instance.device.hostname,
+                "detector",
+                "Target: %s, message:destination %s is under attack"
+                % (detector_instance.device.mgmt_ipaddr, destinations[row]),
             )
+        handle_result(
+            np.flatnonzero(alarms[row]),
+            N_all[row],
+            destination_buckets(keys, features[row]),
+            detector_instance,
+            destination=str(destinations[row]),
+        )
+
+
+def bucket_closed(data: np.ndarray, sampling_interval: int) -> np.ndarray:
+    # Epoch seconds at which each bucket closed
+    return data["key"] / 1000 + sampling_interval
+
+
+def observe_bucket_age(
+    data: np.ndarray, detector_instance: Detector, sampling_interval: int
+):
+    observe(
+        str(detector_instance.device),
+        "bucket_age",
+        time() - bucket_closed(data, sampling_interval),
+    )
+
+
+def flow_report(flow: dict) -> str:
+    if flow is None:
+        return "no flow attributed"
+    return "src: {}, dest: {}, dest_port: {}, L4_proto: {}".format(
+        flow["source_ipv4_address"],
+        flow["destination_ipv4_address"],
+        flow["destination_transport_port"],
+        getprotobynumber(flow["protocol_identifier"]),
+    )
+
 
-            report = "src: {}, dest: {}, dest_port: {}, L4_proto: {}".format(
-                positive_traffic["source_ipv4_address"],
-                positive_traffic["destination_ipv4_address"],
-                positive_traffic["destination_transport_port"],
-                getprotobynumber(positive_traffic["protocol_identifier"]),
+def handle_result(
+    j,
+    N,
+    data,
+    detector_instance: Detector,
+    sampling_interval: int = None,
+    destination: str = None,
+):
+    # Attributes the flagged buckets to flows, of the destination address or
+    # prefix when judging a single destination, logs the verdicts and blocks
+    # the sources of the positive ones
+    device = str(detector_instance.device)
+    sampling_interval = sampling_interval or detector_instance.sampling_interval
+    if not len(j):
+        return
+    # One round trip for the flows of every bucket of the tick
+    try:
+        with timed(device, "attribution"):
+            flows = get_netflow_data_after(
+                data[j]["key"] // 1000,
+                sampling_interval,
+                detector_instance.elastic_host,
+                detector_instance.elastic_index,
+                destination,
+                settings.DETECTOR_EXPORTER_FIELD,
+                str(detector_instance.device.mgmt_ipaddr),
+                deadline=stage_deadline("attribution"),
             )
+    except (DeadlineExceeded, SearchError) as e:
+        # The window state and history already moved past these buckets, so
+        # their verdicts are reported without a flow rather than lost
+        activity_log(
+            "error",
+            "retia-engine",
+            "detector",
+            "Detector device %s attribution failed: %s"
+            % (device, str(e) or "timed out"),
+        )
+        flows = [None] * len(j)
+    for idx, flow in zip(j, flows):
+        if N[:, idx].all():
+            positive_traffic = flow
+            report = flow_report(positive_traffic)
             detection_result = "Target: %s, message:POSITIVE %s" % (
                 detector_instance.device.mgmt_ipaddr,
                 report,
             )
 
             print(detection_result)
-            activity_log(
-                "warning",
-                detector_instance.device.hostname,
-                "detector",
-                detection_result,
-            )
+            with timed(device, "logging"):
+                activity_log(
+                    "warning",
+                    detector_instance.device.hostname,
+                    "detector",
+                    detection_result,
+                )
+
+            if positive_traffic is None:
+                # No source to block
+                continue
 
             ## DDoS Mitigation
             acl_name = "retia_dos_mitigation"
@@ -179,6 +364,7 @@ def handle_result(j, N, data, detector_instance: Detector):
                 ),
             }
 
+            acl_start = timer()
             ddos_mitigation_acl_res = getAclDetail(
                 conn_strings=conn_strings, req_to_show={"name": acl_name}
             )
@@ -208,32 +394,32 @@ def handle_result(j, N, data, detector_instance: Detector):
                     {
                         "sequence": next_sequence_numbers,
                         "action": "deny",
-                        "prefix": negative_traffic["source_ipv4_address"],
+                        "prefix": positive_traffic["source_ipv4_address"],
                         "wildcard": None,
                     }
                 )
                 setAclDetail(
                     conn_strings=conn_strings, req_to_change=ddos_mitigation_acl
                 )
+                observe(
+                    device,
+                    "mitigation",
+                    time() - bucket_closed(data[idx : idx + 1], sampling_interval),
+                )
+            observe(device, "acl", timer() - acl_start)
 
         else:
-            negative_traffic = get_netflow_data_at_nearest_time(
-                timestamp,
-                detector_instance.elastic_host,
-                detector_instance.elastic_index,
-            )
-
-            report = "src: {}, dest: {}, dest_port: {}, L4_proto: {}".format(
-                negative_traffic["source_ipv4_address"],
-                negative_traffic["destination_ipv4_address"],
-                negative_traffic["destination_transport_port"],
-                getprotobynumber(negative_traffic["protocol_identifier"]),
-            )
+            negative_traffic = flow
+            report = flow_report(negative_traffic)
             detection_result = "Target: %s, message:NEGATIVE %s" % (
                 detector_instance.device.mgmt_ipaddr,
                 report,
             )
             print(detection_result)
-            activity_log(
-                "info", detector_instance.device.hostname, "detector", detection_result
-            )
+            with timed(device, "logging"):
+                activity_log(
+                    "info",
+                    detector_instance.device.hostname,
+                    "detector",
+                    detection_result,
+                )
@@ -1,7 +1,1462 @@
-from django.test import TestCase
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer
+from io import StringIO
+from pathlib import Path
+from threading import Event, Thread
+from types import SimpleNamespace
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import numpy as np
+import yaml
+from apscheduler.events import (
+    EVENT_JOB_MAX_INSTANCES,
+    EVENT_JOB_MISSED,
+    EVENT_JOB_SUBMITTED,
+)
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase
+
+from retia_api import nescient
+from retia_api.apps import management_command
+from retia_api.configurations import settings, views
+from retia_api.databases.models import Detector, Device, EngineNode
+from retia_api.helpers import counters, elasticclient, jobs, recording, shards
+from retia_api.helpers.algorithms import ALGORITHMS
+from retia_api.helpers.counters import counter_name
+from retia_api.helpers.destinations import DestinationState, destination_matrix
+from retia_api.helpers.features import feature_matrix, parse_buckets, parse_columns
+from retia_api.helpers.history import (
+    DetectorHistory,
+    detector_histories,
+    drop_history,
+    get_history,
+    history_response,
+    read_history,
+)
+from retia_api.helpers.latency import Histogram, exposition, latencies, observe
+from retia_api.helpers.pool import execute, shutdown_executor
+from retia_api.helpers.replay import BUCKET_COLUMNS, load_buckets, replay
+from retia_api.helpers.resolution import parse_resolutions, split_resolutions
+from retia_api.helpers.runs import (
+    Deadline,
+    DeadlineExceeded,
+    cancel_run,
+    stage_deadline,
+    tick_counters,
+    tick_summary,
+)
+from retia_api.helpers.shards import HashRing
+from retia_api.helpers.streaming import (
+    DetectorState,
+    advance,
+    detector_states,
+    drop_state,
+    update_fleet,
+)
+from retia_api.helpers.sweep import rank, sweep
+from retia_api.helpers.synthetic import SHAPES, synthetic_buckets, synthetic_columns
+from retia_api.helpers.thresholds import detect
+from retia_api.management.commands import detector_worker
+
+# History ring files of the tests go to a scratch directory
+history_dir = tempfile.TemporaryDirectory()
+history_dir_patch = mock.patch.object(
+    settings, "DETECTOR_HISTORY_DIR", Path(history_dir.name)
+)
+
+
+def setUpModule():
+    history_dir_patch.start()
+
+
+def tearDownModule():
+    history_dir_patch.stop()
+    history_dir.cleanup()
+
+
+def loop_threshold(A_list, K):
+    # Per-bucket reference of the adaptive beta threshold
+    safe_A_list = [*A_list, *([0] * K)]
+    beta = 1.5
+    current_threshold = (np.mean(A_list[:K]) + np.std(A_list[:K])) * beta
+    thresholds, flags, betas = [], [], []
+    for j in range(len(A_list)):
+        thresholds.append(current_threshold)
+        betas.append(beta)
+        flags.append(safe_A_list[j] > current_threshold)
+        previous_moving_mean = np.mean(safe_A_list[j : j + K])
+        current_moving_mean = np.mean(safe_A_list[j + 1 : j + 1 + K])
+        current_moving_std = np.std(safe_A_list[j + 1 : j + 1 + K])
+        if current_moving_mean > 2 * previous_moving_mean:
+            beta = beta + 0.5
+            current_threshold = (current_moving_mean + current_moving_std) / beta
+        else:
+            beta = max(beta - 0.5, 1)
+            current_threshold = (current_moving_mean + current_moving_std) * beta
+    return thresholds, flags, betas
 
 
 class TestDetector(TestCase):
     def test_can_create_detector(self):
         """system should be able to create a detector"""
         pass
+
+
+class TestThresholds(SimpleTestCase):
+    def test_detect_matches_loop_threshold(self):
+        """vectorized threshold should match the per-bucket loop bit for bit"""
+        rng = np.random.default_rng(7)
+        for count, window_size in [(1, 1), (5, 20), (60, 1), (120, 9), (300, 150)]:
+            features = [
+                list(rng.gamma(2, 1000, count).round()),
+                [int(x) for x in rng.poisson(30, count) * rng.choice([0, 1, 5], count)],
+                list(rng.random(count) * 10),
+                list(rng.random(count) * 1e5),
+            ]
+            thresholds, flags, betas = detect(np.array(features), window_size)
+            for row, A_list in enumerate(features):
+                expected = loop_threshold(A_list, window_size)
+                np.testing.assert_array_equal(thresholds[row], expected[0])
+                np.testing.assert_array_equal(flags[row], expected[1])
+                np.testing.assert_array_equal(betas[row], expected[2])
+
+    def test_detect_empty(self):
+        """vectorized threshold should accept an empty bucket list"""
+        thresholds, flags, betas = detect(np.empty((4, 0)), 3)
+        self.assertEqual(flags.shape, (4, 0))
+
+
+class TestStreaming(SimpleTestCase):
+    def test_state_follows_trailing_window(self):
+        """streaming state should threshold each bucket on the buckets before it"""
+        rng = np.random.default_rng(11)
+        window_size = 6
+        features = rng.gamma(2, 100, (4, 40))
+        state = DetectorState(window_size, 10)
+        thresholds, flags, betas = state.update(features, list(range(40)))
+
+        beta = np.full(4, 1.5)
+        previous_mean = np.zeros(4)
+        for idx in range(40):
+            window = features[:, max(0, idx - window_size) : idx]
+            mean = window.mean(axis=1) if idx else np.zeros(4)
+            std = window.std(axis=1) if idx else np.zeros(4)
+            rising = mean > 2 * previous_mean
+            beta = np.where(rising, beta + 0.5, np.maximum(beta - 0.5, 1))
+            expected = np.where(rising, (mean + std) / beta, (mean + std) * beta)
+            np.testing.assert_allclose(thresholds[:, idx], expected)
+            np.testing.assert_array_equal(
+                flags[:, idx], (features[:, idx] > expected) & (idx >= window_size)
+            )
+            previous_mean = mean
+
+    def test_state_only_takes_closed_new_buckets(self):
+        """streaming state should skip open and already evaluated buckets"""
+        state = DetectorState(3, 10)
+        keys = np.array([100_000, 110_000])
+        np.testing.assert_array_equal(state.new_mask(keys, 115), [True, False])
+        state.update(np.ones((4, 1)), keys[:1])
+        np.testing.assert_array_equal(state.new_mask(keys, 200), [False, True])
+
+    def test_fleet_update_matches_single_updates(self):
+        """fleet evaluation should give every detector its own verdicts"""
+        rng = np.random.default_rng(5)
+        window_sizes = [3, 3, 5, 3]
+        features = [rng.gamma(2, 100, (4, 12)) for _ in window_sizes]
+        features[1] = features[1][:, :7]
+        keys = [list(range(f.shape[1])) for f in features]
+
+        singles = [DetectorState(size, 10) for size in window_sizes]
+        expected = [s.update(f, k) for s, f, k in zip(singles, features, keys)]
+        fleet = [DetectorState(size, 10) for size in window_sizes]
+        calls = []
+        results = update_fleet(
+            fleet,
+            features,
+            keys,
+            lambda function, *args: calls.append(function) or function(*args),
+        )
+        # One call per window size, every bucket column included
+        self.assertEqual(len(calls), 2)
+
+        for result, single, state, expect in zip(results, singles, fleet, expected):
+            for array, expected_array in zip(result, expect):
+                np.testing.assert_allclose(array, expected_array)
+            self.assertEqual(state.last_key, single.last_key)
+
+
+class TestFeatures(SimpleTestCase):
+    def test_parse_buckets(self):
+        """bucket ingestion should compute the four features with safe division"""
+        buckets = [
+            {
+                "key": 1714000000000 + 20000 * idx,
+                "packets": {"value": float(packets)},
+                "USIP": {"value": usip},
+                "UDIP": {"value": udip},
+                "UPR": {"value": upr},
+            }
+            for idx, (packets, usip, udip, upr) in enumerate(
+                [(120, 7, 3, 2), (0, 0, 4, 1), (55, 9, 0, 3), (10, 5, 5, 0)]
+            )
+        ]
+        parsed = parse_buckets(buckets)
+        np.testing.assert_array_equal(parsed["key"], [b["key"] for b in buckets])
+        np.testing.assert_array_equal(
+            feature_matrix(parsed),
+            [
+                [120, 0, 55, 10],
+                [7, 0, 9, 5],
+                [7 / 3, 0, 0, 1],
+                [7 / 2, 0, 9 / 3, 0],
+            ],
+        )
+
+    def test_parse_no_buckets(self):
+        """bucket ingestion should accept an empty aggregation"""
+        self.assertEqual(feature_matrix(parse_buckets([])).shape, (4, 0))
+
+
+class TestReplay(SimpleTestCase):
+    def test_replay_npz_and_jsonl_agree(self):
+        """replay should read NPZ and JSON-lines captures and score labels"""
+        rng = np.random.default_rng(3)
+        columns = {
+            "key": 1714000000000 + 20000 * np.arange(50),
+            "packets": rng.poisson(500, 50).astype(float),
+            "USIP": rng.poisson(20, 50),
+            "UDIP": rng.poisson(10, 50),
+            "UPR": np.full(50, 3),
+            "label": np.arange(50) >= 40,
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            np.savez(Path(directory) / "buckets.npz", **columns)
+            with open(Path(directory) / "buckets.jsonl", "w") as f:
+                for idx in range(50):
+                    bucket = {"key": int(columns["key"][idx])}
+                    for name in ("packets", "USIP", "UDIP", "UPR"):
+                        bucket[name] = {"value": columns[name][idx].item()}
+                    bucket["label"] = bool(columns["label"][idx])
+                    f.write(json.dumps(bucket) + "\n")
+            from_npz = load_buckets(Path(directory) / "buckets.npz")
+            from_jsonl = load_buckets(Path(directory) / "buckets.jsonl")
+
+        np.testing.assert_array_equal(from_npz[0], from_jsonl[0])
+        np.testing.assert_array_equal(from_npz[1], columns["label"])
+        result = replay(from_npz[0], 4, 20, from_npz[1])
+        expected = DetectorState(4, 20).update(
+            feature_matrix(from_npz[0]), from_npz[0]["key"]
+        )[1]
+        np.testing.assert_array_equal(
+            result["timeline"]["verdicts"], expected.all(axis=0)
+        )
+        expected = detect(feature_matrix(from_npz[0]), 4)[1].all(axis=0)
+        np.testing.assert_array_equal(
+            replay(from_npz[0], 4, 20, mode="batch")["timeline"]["verdicts"], expected
+        )
+        self.assertEqual(result["summary"]["buckets"], 50)
+        self.assertIn("recall", result["summary"])
+
+
+class TestSynthetic(SimpleTestCase):
+    def test_synthetic_shapes(self):
+        """synthetic traffic should raise the attacked buckets above baseline"""
+        for shape in SHAPES:
+            columns = synthetic_columns(2000, shape)
+            buckets = synthetic_buckets(columns)
+            self.assertEqual(len(buckets), 2000)
+            self.assertEqual(buckets[-1]["key"], columns["key"][-1])
+            if shape == "baseline":
+                self.assertFalse(columns["label"].any())
+            else:
+                attacked = columns["packets"][columns["label"]].mean()
+                self.assertGreater(attacked, columns["packets"][:1000].mean())
+
+
+class TestAlgorithms(SimpleTestCase):
+    def test_algorithms_flag_attacks_and_batch(self):
+        """every registered algorithm should flag a flood and batch per detector"""
+        rng = np.random.default_rng(9)
+        features = rng.normal(1000, 30, (3, 4, 60)).clip(0)
+        features[0, :, 50:] *= 20
+        for name, algorithm in ALGORITHMS.items():
+            singles = [algorithm.init_state(10) for _ in range(3)]
+            batch = algorithm.init_state(10, (3,))
+            for idx in range(60):
+                expected = [
+                    algorithm.step(s, features[d, :, idx])
+                    for d, s in enumerate(singles)
+                ]
+                result = algorithm.step(batch, features[:, :, idx])
+                for d in range(3):
+                    np.testing.assert_allclose(result[0][d], expected[d][0])
+                    np.testing.assert_array_equal(result[1][d], expected[d][1])
+                if idx == 50:
+                    self.assertTrue(result[1][0].all(), name)
+                if idx < 10:
+                    self.assertFalse(result[1].any(), name)
+
+
+class TestPool(SimpleTestCase):
+    def test_process_pool_runs_kernels_and_survives_crashes(self):
+        """detector worker pool should match in-process results and restart"""
+        features = np.random.default_rng(2).gamma(2, 100, (4, 30))
+        with (
+            mock.patch.object(settings, "DETECTOR_EXECUTION", "process"),
+            mock.patch.object(settings, "DETECTOR_WORKERS", 1),
+        ):
+            try:
+                for expected, result in zip(
+                    detect(features, 5), execute(detect, features, 5)
+                ):
+                    np.testing.assert_array_equal(result, expected)
+                with self.assertRaises(BrokenProcessPool):
+                    execute(os._exit, 1)
+                state = DetectorState(5, 10)
+                arrays = state.algorithm.init_state(5)
+                np.testing.assert_array_equal(
+                    state.update(features, list(range(30)), execute)[1],
+                    advance("beta", arrays, features)[2],
+                )
+            finally:
+                shutdown_executor()
+
+
+class TestHistory(SimpleTestCase):
+    def test_history_ring_keeps_latest_buckets(self):
+        """detector history should keep the newest buckets in key order"""
+        history = DetectorHistory(8)
+        features = np.arange(4 * 12, dtype=np.float64).reshape(4, 12)
+        betas = np.full((4, 12), np.nan)
+        flags = np.zeros((4, 12), dtype=bool)
+        flags[:, 10] = True
+        for start, end in ((0, 5), (5, 9), (9, 12)):
+            history.append(
+                np.arange(start, end) * 1000,
+                features[:, start:end],
+                features[:, start:end] / 2,
+                betas[:, start:end],
+                flags[:, start:end],
+            )
+
+        records = history.ordered()
+        np.testing.assert_array_equal(records["key"], np.arange(4, 12) * 1000)
+        np.testing.assert_array_equal(records["features"], features[:, 4:].T)
+        np.testing.assert_array_equal(records["verdict"], np.arange(4, 12) == 10)
+        np.testing.assert_array_equal(
+            history.slice(6000, 9000)["key"], [6000, 7000, 8000, 9000]
+        )
+        np.testing.assert_array_equal(history.slice(limit=2)["key"], [10000, 11000])
+        self.assertEqual(len(history.slice(limit=100)), 8)
+
+        body = history_response(history.slice(start=10000))
+        self.assertEqual(body["time"], [10000, 11000])
+        self.assertEqual(body["verdict"], [True, False])
+        self.assertEqual(body["features"]["packets"], [10.0, 11.0])
+        self.assertEqual(body["betas"]["USIP"], [None, None])
+        json.dumps(body, allow_nan=False)
+
+    def test_history_file_survives_reopening(self):
+        """a history ring file should reopen where it was left"""
+        features = np.arange(4 * 10, dtype=np.float64).reshape(4, 10)
+        flags = np.zeros((4, 10), dtype=bool)
+        try:
+            history = get_history("router-file", 6)
+            history.append(np.arange(8) * 1000, *[features[:, :8]] * 3, flags[:, :8])
+            self.assertIsInstance(history.records, np.memmap)
+            self.assertTrue(
+                np.shares_memory(history.slice(3000, 6000), history.records)
+            )
+            detector_histories.clear()
+
+            history = get_history("router-file")
+            self.assertEqual(len(history.records), 6)
+            # Re-evaluated buckets are not stored twice
+            history.append(
+                np.arange(6, 10) * 1000, *[features[:, 6:]] * 3, flags[:, 6:]
+            )
+            np.testing.assert_array_equal(
+                history.ordered()["key"], np.arange(4, 10) * 1000
+            )
+            np.testing.assert_array_equal(
+                history.slice(limit=3)["features"], features[:, 7:].T
+            )
+            detector_histories.clear()
+
+            # A shorter retention keeps the newest buckets
+            history = get_history("router-file", 4)
+            np.testing.assert_array_equal(
+                history.ordered()["key"], np.arange(6, 10) * 1000
+            )
+        finally:
+            drop_history("router-file")
+        self.assertFalse((Path(history_dir.name) / "router-file.npy").exists())
+
+    def test_readers_follow_the_writer(self):
+        """read-only histories should see appends and never touch the file"""
+        features = np.zeros((4, 10))
+        flags = np.zeros((4, 10), dtype=bool)
+        try:
+            self.assertEqual(len(read_history("router-shared").ordered()), 0)
+            writer = get_history("router-shared", 8)
+            writer.append(np.arange(1, 4), *[features[:, :3]] * 3, flags[:, :3])
+            reader = read_history("router-shared")
+            writer.append(np.arange(4, 11), *[features[:, 3:]] * 3, flags[:, 3:])
+            np.testing.assert_array_equal(
+                read_history("router-shared").ordered()["key"], np.arange(3, 11)
+            )
+            with self.assertRaises(ValueError):
+                reader.records["key"][0] = 0
+
+            # A resize replaces the file, mappings of the old one stay intact
+            get_history("router-shared", 4)
+            np.testing.assert_array_equal(reader.records["key"][:3], [9, 10, 3])
+            np.testing.assert_array_equal(
+                read_history("router-shared").ordered()["key"], np.arange(7, 11)
+            )
+        finally:
+            drop_history("router-shared")
+
+    def test_deleted_ring_file_is_started_over(self):
+        """a ring file deleted by another process should not be written on"""
+        features = np.zeros((4, 3))
+        flags = np.zeros((4, 3), dtype=bool)
+        path = Path(history_dir.name) / "router-deleted.npy"
+        try:
+            history = get_history("router-deleted", 8)
+            history.append(np.arange(3), *[features] * 3, flags)
+            # The API deleting the detector only removes the file
+            path.unlink()
+            history = get_history("router-deleted")
+            self.assertEqual(len(history.ordered()), 0)
+            history.append(np.arange(3), *[features] * 3, flags)
+            np.testing.assert_array_equal(
+                read_history("router-deleted").ordered()["key"], np.arange(3)
+            )
+            self.assertIs(get_history("router-deleted"), history)
+        finally:
+            drop_history("router-deleted")
+
+
+class TestSweep(SimpleTestCase):
+    def test_sweep_matches_streaming_per_parameter_set(self):
+        """parameter sweep should count the verdicts a live detector gives each setting"""
+        columns = synthetic_columns(600, "pulse")
+        features = feature_matrix(
+            parse_columns(*(columns[name] for name in BUCKET_COLUMNS))
+        )
+        algorithm = ALGORITHMS["beta"]
+        with mock.patch("retia_api.helpers.sweep.CHUNK_ELEMENTS", 1000):
+            result = sweep(
+                features, [1, 8, 40, 1000], [1.0, 2.0], [0.25, 0.5], columns["label"]
+            )
+        self.assertEqual(len(result["alarms"]), 16)
+        for idx in range(16):
+            window_size = int(result["window_size"][idx])
+            state = algorithm.init_state(
+                window_size,
+                initial_beta=result["initial_beta"][idx],
+                beta_step=result["beta_step"][idx],
+            )
+            verdicts = advance("beta", state, features)[2].all(axis=0)
+            self.assertFalse(verdicts[:window_size].any())
+            self.assertEqual(result["alarms"][idx], verdicts.sum())
+            self.assertEqual(
+                result["true_positives"][idx], (verdicts & columns["label"]).sum()
+            )
+
+        rows = rank({20: result}, 3)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]["sampling_interval"], 20)
+        self.assertGreaterEqual(rows[0]["f1"] or 0, rows[1]["f1"] or 0)
+
+
+class TestHistoryView(TestCase):
+    def test_history_is_read_from_the_ring_file(self):
+        """the API should serve the history the worker last wrote"""
+        Detector.objects.create(
+            device=Device.objects.create(
+                hostname="router-api",
+                mgmt_ipaddr="10.0.0.1",
+                username="admin",
+                secret="secret",
+            ),
+            device_interface_to_filebeat="Gi1",
+            device_interface_to_server="Gi2",
+            elastic_index="netflow",
+            filebeat_host="10.0.0.2",
+            history_length=8,
+        )
+        metrics = np.zeros((4, 10))
+        flags = np.zeros((4, 10), dtype=bool)
+        try:
+            writer = get_history("router-api", 8)
+            writer.append(np.arange(1, 4), *[metrics[:, :3]] * 3, flags[:, :3])
+            self.client.get("/detector/router-api/history")
+            writer.append(np.arange(4, 11), *[metrics[:, 3:]] * 3, flags[:, 3:])
+            response = self.client.get("/detector/router-api/history")
+            self.assertEqual(response.json()["time"], list(range(3, 11)))
+        finally:
+            drop_history("router-api")
+
+
+class TestSweepView(TestCase):
+    def test_invalid_sweeps_are_rejected(self):
+        """oversized sweeps and malformed limits should be a 400, not a 500"""
+        Detector.objects.create(
+            device=Device.objects.create(
+                hostname="router-sweep",
+                mgmt_ipaddr="10.0.0.1",
+                username="admin",
+                secret="secret",
+            ),
+            device_interface_to_filebeat="Gi1",
+            device_interface_to_server="Gi2",
+            elastic_index="netflow",
+            filebeat_host="10.0.0.2",
+        )
+        with mock.patch.object(views, "get_netflow_history") as history:
+            response = self.client.post(
+                "/detector/router-sweep/sweep",
+                {"duration": 86400 * 30, "sampling_intervals": [20]},
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 400)
+        history.assert_not_called()
+
+        with mock.patch.object(views, "get_netflow_history", return_value=[]):
+            response = self.client.post(
+                "/detector/router-sweep/sweep",
+                {"duration": 3600, "limit": "abc"},
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 400)
+
+
+class TestResolution(SimpleTestCase):
+    def test_split_resolutions_downsamples_packets(self):
+        """one multi-resolution response should yield every detector resolution"""
+        columns = synthetic_columns(90, "ramp", sampling_interval=10)
+        fine = synthetic_buckets(columns)
+        coarse = [
+            {
+                "key": key,
+                "USIP": {"value": 100},
+                "UDIP": {"value": 50},
+                "UPR": {"value": 4},
+            }
+            for key in range(fine[0]["key"] - 40000, fine[-1]["key"] + 1, 60000)
+        ]
+        resolutions = parse_resolutions(10, "60")
+        result = split_resolutions(
+            {
+                "all_attributes": {"buckets": fine},
+                "cardinalities_60s": {"buckets": coarse},
+            },
+            resolutions,
+        )
+
+        self.assertEqual(list(result), [10, 60])
+        np.testing.assert_array_equal(result[10]["packets"], columns["packets"])
+        self.assertEqual(result[60]["packets"].sum(), columns["packets"].sum())
+        starts = columns["key"] - columns["key"] % 60000
+        for bucket in result[60]:
+            self.assertEqual(
+                bucket["packets"], columns["packets"][starts == bucket["key"]].sum()
+            )
+        np.testing.assert_array_equal(result[60]["USIP/UDIP"], 2)
+        with self.assertRaises(ValueError):
+            parse_resolutions(20, "30")
+
+    def test_stream_resolutions_keeps_state_per_resolution(self):
+        """a detector should keep separate state and history per resolution"""
+        detector_instance = SimpleNamespace(
+            device="router-resolution",
+            history_length=4320,
+            window_size=3,
+            sampling_interval=10,
+            resolutions="60",
+            algorithm="beta",
+        )
+        fine = parse_buckets(synthetic_buckets(synthetic_columns(60, "baseline", 10)))
+        coarse = parse_buckets(synthetic_buckets(synthetic_columns(10, "baseline", 60)))
+        try:
+            with mock.patch.object(nescient, "handle_result") as handle_result:
+                nescient.stream_resolutions({10: fine, 60: coarse}, detector_instance)
+            self.assertEqual(handle_result.call_count, 2)
+            self.assertEqual(len(get_history("router-resolution").ordered()), 60)
+            self.assertEqual(len(get_history("router-resolution@60s").ordered()), 10)
+            self.assertEqual(
+                detector_states["router-resolution@60s"].last_key,
+                coarse["key"][-1],
+            )
+        finally:
+            drop_state("router-resolution")
+            detector_histories.clear()
+        self.assertNotIn("router-resolution@60s", detector_states)
+
+    def test_positives_are_reported_at_the_finest_resolution(self):
+        """a coarse positive already flagged at a finer resolution should be skipped"""
+        detector_instance = SimpleNamespace(
+            device="router-overlap",
+            history_length=4320,
+            sampling_interval=20,
+            resolutions="60",
+        )
+        fine_keys = np.arange(0, 180_000, 20_000)
+        fine_flags = np.zeros((4, len(fine_keys)), dtype=bool)
+        fine_flags[:, 4] = True
+        metrics = np.zeros((4, len(fine_keys)))
+        try:
+            get_history("router-overlap").append(
+                fine_keys, metrics, metrics, metrics, fine_flags
+            )
+            coarse = np.zeros(3, dtype=[("key", np.int64)])
+            coarse["key"] = [0, 60_000, 120_000]
+            N_all = np.ones((4, 3), dtype=bool)
+            N_all[:, 0] = False
+            np.testing.assert_array_equal(
+                nescient.reported_buckets(coarse, N_all, detector_instance, 60),
+                [0, 2],
+            )
+        finally:
+            detector_histories.clear()
+
+
+class TestFleetFetch(SimpleTestCase):
+    def detector(self, hostname, mgmt_ipaddr, elastic_index):
+        return SimpleNamespace(
+            device=SimpleNamespace(hostname=hostname, mgmt_ipaddr=mgmt_ipaddr),
+            window_size=10,
+            sampling_interval=20,
+            resolutions="",
+            overrun_policy="skip",
+            algorithm="beta",
+            elastic_host="127.0.0.1",
+            elastic_index=elastic_index,
+        )
+
+    def test_fleet_shares_one_search_per_index(self):
+        """detectors on the same index should share one search per tick"""
+        detectors = [
+            self.detector("r1", "192.0.2.1", "netflow-a"),
+            self.detector("r2", "192.0.2.2", "netflow-a"),
+            self.detector("r3", "192.0.2.3", "netflow-b"),
+        ]
+        buckets = synthetic_buckets(synthetic_columns(5))
+        aggregations = {"all_attributes": {"buckets": buckets}}
+
+        with mock.patch.object(
+            jobs, "get_netflow_resolutions", return_value=aggregations
+        ) as search:
+            fleet_data = jobs.fetch_fleet(detectors)
+        self.assertEqual(search.call_count, 2)
+        self.assertEqual([member for _, member in fleet_data], detectors)
+        self.assertIs(fleet_data[0][0], fleet_data[1][0])
+
+        by_exporter = {
+            "192.0.2.1": aggregations,
+            "192.0.2.2": {"all_attributes": {"buckets": buckets[:2]}},
+        }
+        with (
+            mock.patch.object(settings, "DETECTOR_EXPORTER_FIELD", "observer.ip"),
+            mock.patch.object(
+                jobs, "get_netflow_by_exporter", return_value=by_exporter
+            ) as search,
+            mock.patch.object(
+                jobs, "get_netflow_resolutions", return_value=aggregations
+            ),
+        ):
+            fleet_data = jobs.fetch_fleet(detectors[:2])
+        search.assert_called_once()
+        self.assertEqual(search.call_args[0][3], ["192.0.2.1", "192.0.2.2"])
+        self.assertEqual(len(fleet_data[0][0][20]), 5)
+        self.assertEqual(len(fleet_data[1][0][20]), 2)
+
+
+class TestCounterScreen(SimpleTestCase):
+    def series(self, instance, packets, octets):
+        return [
+            {
+                "metric": {"instance": instance, "ifDescr": "Gi1", "feature": feature},
+                "value": [0, str(value)],
+            }
+            for feature, value in (("packets", packets), ("octets", octets))
+        ]
+
+    def test_screen_only_passes_suspicious_detectors(self):
+        """counter screen should pass warming, spiking and unmonitored detectors"""
+        detectors = [
+            SimpleNamespace(
+                device=SimpleNamespace(hostname=name, mgmt_ipaddr=address),
+                device_interface_to_server="Gi1",
+                window_size=5,
+                algorithm="beta",
+            )
+            for name, address in (
+                ("screen-quiet", "192.0.2.1"),
+                ("screen-spike", "192.0.2.2"),
+                ("screen-missing", "192.0.2.3"),
+            )
+        ]
+        names = [counter_name(str(detector.device)) for detector in detectors]
+        try:
+            for tick in range(12):
+                spike = 50 if tick == 11 else 1
+                result = self.series("192.0.2.1", 1000, 8e5) + self.series(
+                    "192.0.2.2", 1000 * spike, 8e5 * spike
+                )
+                with mock.patch.object(
+                    counters, "get_interface_rates", return_value=result
+                ) as query:
+                    selected = counters.screen(detectors, 20, 1714000000 + 20 * tick)
+                query.assert_called_once()
+                hostnames = [detector.device.hostname for detector in selected]
+                if tick < 5:
+                    self.assertEqual(len(selected), 3)
+                elif tick < 11:
+                    self.assertEqual(hostnames, ["screen-missing"])
+                else:
+                    self.assertEqual(hostnames, ["screen-spike", "screen-missing"])
+        finally:
+            for name in names:
+                drop_state(name)
+
+
+class TestRecordingRules(SimpleTestCase):
+    def test_rules_are_generated_and_screened(self):
+        """recording rules should keep detector counter windows in prometheus"""
+        detectors = [
+            SimpleNamespace(
+                device=Device(hostname=name, mgmt_ipaddr=address),
+                device_interface_to_server="Gi1",
+                window_size=window_size,
+                sampling_interval=sampling_interval,
+            )
+            for name, address, window_size, sampling_interval in (
+                ("rules-a", "192.0.2.1", 10, 20),
+                ("rules-b", "192.0.2.2", 30, 60),
+            )
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            config = Path(directory) / "prometheus.yml"
+            config.write_text(yaml.safe_dump({"scrape_configs": []}))
+            with (
+                mock.patch.object(settings, "DETECTOR_COUNTER_RULES", True),
+                mock.patch.object(recording, "PROMETHEUS_CONFIG", str(config)),
+                mock.patch.object(
+                    recording.Detector.objects, "select_related"
+                ) as query,
+                mock.patch.object(recording.requests, "post") as reload,
+            ):
+                query.return_value.all.return_value = detectors
+                recording.write_recording_rules()
+                recording.write_recording_rules()
+            rules = yaml.safe_load((Path(directory) / recording.RULES_FILE).read_text())
+            self.assertEqual(
+                yaml.safe_load(config.read_text())["rule_files"], [recording.RULES_FILE]
+            )
+        self.assertEqual(reload.call_count, 2)
+        self.assertEqual(
+            [group["interval"] for group in rules["groups"]], ["20s", "60s"]
+        )
+        expressions = [rule["expr"] for rule in rules["groups"][1]["rules"]]
+        self.assertIn(
+            'rate(ifHCOutUcastPkts{instance="192.0.2.2",ifDescr="Gi1"}[60s])',
+            expressions,
+        )
+        self.assertIn(
+            'avg_over_time(retia_detector:packets:rate{detector="rules-b"}'
+            "[1800s] offset 60s)",
+            expressions,
+        )
+
+        def series(detector, stats):
+            return [
+                {
+                    "metric": {
+                        "__name__": recording.record_name(feature, stat),
+                        "detector": detector,
+                    },
+                    "value": [0, str(value)],
+                }
+                for feature in recording.COUNTER_METRICS
+                for stat, value in stats.items()
+            ]
+
+        result = series(
+            "rules-a", {"rate": 100, "avg": 100, "stddev": 5, "samples": 10}
+        ) + series("rules-b", {"rate": 900, "avg": 100, "stddev": 5, "samples": 30})
+        with (
+            mock.patch.object(settings, "DETECTOR_COUNTER_RULES", True),
+            mock.patch.object(
+                counters, "get_detector_series", return_value=result
+            ) as query,
+        ):
+            selected = counters.screen(detectors, 20, 1714000000)
+        query.assert_called_once()
+        self.assertEqual(selected, detectors[1:])
+
+
+class TestWarmStart(SimpleTestCase):
+    def test_schedule_detector_backfills_before_scheduling(self):
+        """scheduling a detector should seed its window from one past search"""
+        detector_instance = SimpleNamespace(
+            device="router-warm",
+            history_length=4320,
+            overrun_policy="skip",
+            window_size=10,
+            sampling_interval=20,
+            resolutions="",
+            algorithm="beta",
+            elastic_host="127.0.0.1",
+            elastic_index="netflow",
+        )
+        buckets = synthetic_buckets(synthetic_columns(11))
+        calls = []
+        try:
+            with (
+                mock.patch.object(settings, "DETECTOR_WARM_START", True),
+                mock.patch.object(settings, "DETECTOR_FLEET_MODE", False),
+                mock.patch.object(
+                    jobs,
+                    "search_netflow_resolutions",
+                    side_effect=lambda *args: calls.append(args)
+                    or {"all_attributes": {"buckets": buckets}},
+                ),
+                mock.patch.object(jobs, "scheduler") as scheduler,
+                mock.patch.object(nescient, "handle_result") as handle_result,
+            ):
+                scheduler.get_job.return_value = None
+                scheduler.add_job.side_effect = lambda **kwargs: calls.append(
+                    kwargs["id"]
+                )
+                jobs.schedule_detector(detector_instance)
+
+            self.assertEqual(calls[0][4], 220)
+            self.assertEqual(calls[1], "router-warm")
+            handle_result.assert_not_called()
+            state = detector_states["router-warm"]
+            self.assertEqual(state.last_key, buckets[-1]["key"])
+            self.assertTrue(state.algorithm.warmed_up(state.arrays).all())
+            self.assertEqual(len(get_history("router-warm").ordered()), 11)
+        finally:
+            jobs.scheduled_detectors.clear()
+            drop_state("router-warm")
+            detector_histories.clear()
+
+
+class TestLatency(SimpleTestCase):
+    def test_histogram_quantiles(self):
+        """quantiles should be the upper bound of the bucket holding them"""
+        histogram = Histogram()
+        self.assertIsNone(histogram.quantile(0.5))
+        histogram.observe(np.array([0.002] * 90 + [3.0] * 10))
+        self.assertEqual(int(histogram.counts.sum()), 100)
+        self.assertEqual(histogram.quantile(0.5), 0.005)
+        self.assertEqual(histogram.quantile(0.95), 5)
+
+    def test_exposition_format(self):
+        """exposition should render cumulative buckets, sum and count"""
+        try:
+            observe("router-latency", "fetch", [0.02, 0.2])
+            lines = exposition().splitlines()
+            labels = 'detector="router-latency",stage="fetch"'
+            self.assertIn(
+                'retia_detector_stage_seconds_bucket{%s,le="0.025"} 1' % (labels),
+                lines,
+            )
+            self.assertIn(
+                'retia_detector_stage_seconds_bucket{%s,le="+Inf"} 2' % (labels),
+                lines,
+            )
+            self.assertIn("retia_detector_stage_seconds_count{%s} 2" % (labels), lines)
+        finally:
+            latencies.clear()
+
+    def test_detector_job_records_stages(self):
+        """a detector tick should record fetch, feature and compute latencies"""
+        detector_instance = SimpleNamespace(
+            device="router-latency",
+            history_length=4320,
+            window_size=10,
+            sampling_interval=20,
+            resolutions="",
+            algorithm="beta",
+            overrun_policy="skip",
+        )
+        buckets = synthetic_buckets(synthetic_columns(12))
+        try:
+            with (
+                mock.patch.object(settings, "DETECTOR_COUNTER_SCREEN", False),
+                mock.patch.object(
+                    jobs,
+                    "fetch_resolutions",
+                    return_value={20: parse_buckets(buckets)},
+                ),
+                mock.patch.object(nescient, "handle_result"),
+            ):
+                jobs.detector_job(detector_instance)
+            self.assertTrue(
+                {"fetch", "features", "compute"} <= set(latencies["router-latency"])
+            )
+        finally:
+            drop_state("router-latency")
+            detector_histories.clear()
+            latencies.clear()
+
+
+def destination_bucket(destination, key, packets, sources=1):
+    return {
+        "key": {"destination": destination, "timestamp": key},
+        "packets": {"value": packets},
+        "USIP": {"value": sources},
+        "UDIP": {"value": 1},
+        "UPR": {"value": 1},
+    }
+
+
+class TestDestinations(SimpleTestCase):
+    def test_destination_matrix(self):
+        """composite buckets should fill a destinations by metrics by keys matrix"""
+        destinations, keys, features = destination_matrix(
+            [
+                destination_bucket("10.0.0.2", 20000, 5),
+                destination_bucket("10.0.0.1", 0, 7, 3),
+                destination_bucket("10.0.0.1", 20000, 9),
+            ]
+        )
+        self.assertEqual(destinations.tolist(), ["10.0.0.1", "10.0.0.2"])
+        self.assertEqual(keys.tolist(), [0, 20000])
+        self.assertEqual(features[:, 0].tolist(), [[7, 9], [0, 5]])
+        self.assertEqual(features[0, 2].tolist(), [3, 1])
+
+    def test_track_caps_and_evicts(self):
+        """tracking should admit the busiest destinations and evict idle ones"""
+        state = DestinationState(2, 20, limit=2)
+        destinations = np.array(["a", "b", "c"])
+        features = np.zeros((3, 4, 1))
+        features[:, 0, 0] = [1, 5, 3]
+        tracked, aligned = state.track(destinations, np.array([0]), features)
+        self.assertEqual(tracked.tolist(), ["b", "c"])
+        self.assertEqual(aligned[:, 0, 0].tolist(), [5, 3])
+        self.assertEqual(state.arrays["window"].shape[0], 2)
+
+        features = np.zeros((1, 4, 2))
+        features[0, 0] = 4
+        tracked, aligned = state.track(
+            np.array(["a"]), np.array([60000, 80000]), features
+        )
+        self.assertEqual(tracked.tolist(), ["a"])
+        self.assertEqual(aligned[:, 0].tolist(), [[4, 4]])
+
+    def test_stream_destinations_flags_attacked_destination(self):
+        """only the destination whose traffic jumps should reach mitigation"""
+        detector_instance = SimpleNamespace(
+            device=Device(hostname="router-destinations", mgmt_ipaddr="10.0.0.9"),
+            window_size=5,
+            sampling_interval=20,
+            algorithm="beta",
+        )
+        rng = np.random.default_rng(7)
+        buckets = []
+        for idx in range(30):
+            for destination in ("10.0.0.1", "10.0.0.2"):
+                attacked = destination == "10.0.0.2" and idx == 29
+                buckets.append(
+                    destination_bucket(
+                        destination,
+                        idx * 20000,
+                        (5000 if attacked else 100) + rng.integers(0, 5),
+                        400 if attacked else 2,
+                    )
+                )
+        try:
+            with (
+                mock.patch.object(nescient, "handle_result") as handle_result,
+                mock.patch.object(nescient, "activity_log") as activity_log,
+            ):
+                nescient.stream_destinations(buckets, detector_instance)
+            handle_result.assert_called_once()
+            activity_log.assert_called_once()
+            j, N, data, _ = handle_result.call_args.args
+            self.assertEqual(handle_result.call_args.kwargs["destination"], "10.0.0.2")
+            self.assertEqual(j.tolist(), [29])
+            self.assertEqual(data["packets"][29], buckets[-1]["packets"]["value"])
+        finally:
+            drop_state("router-destinations")
+
+
+class TestAlignedTicks(SimpleTestCase):
+    def test_ticks_fire_after_bucket_boundaries(self):
+        """aligned ticks should fire the ingest grace after a bucket boundary"""
+        with (
+            mock.patch.object(settings, "DETECTOR_ALIGNED_TICKS", True),
+            mock.patch.object(settings, "DETECTOR_INGEST_GRACE", 5),
+            mock.patch.object(settings, "DETECTOR_STAGGER_TICKS", False),
+        ):
+            self.assertEqual(jobs.closed_boundary(20, 1065.0), 1060)
+            self.assertEqual(jobs.closed_boundary(20, 1064.9), 1040)
+            trigger = jobs.tick_trigger(20, "router-aligned")
+        self.assertEqual(trigger.start_date.timestamp() % 20, 5)
+        self.assertEqual(trigger.interval.total_seconds(), 20)
+
+    def test_aligned_fetch_reads_closed_buckets_without_waiting(self):
+        """an aligned tick should search once up to the boundary and drop open buckets"""
+        fine = [
+            {
+                "key": key,
+                "packets": {"value": 10},
+                "USIP": {"value": 1},
+                "UDIP": {"value": 1},
+                "UPR": {"value": 1},
+            }
+            for key in range(1200000, 1320000, 20000)
+        ]
+        coarse = [
+            {
+                "key": key,
+                "USIP": {"value": 1},
+                "UDIP": {"value": 1},
+                "UPR": {"value": 1},
+            }
+            for key in (1200000, 1260000, 1320000)
+        ]
+        calls = []
+        with (
+            mock.patch.object(settings, "DETECTOR_ALIGNED_TICKS", True),
+            mock.patch.object(settings, "DETECTOR_INGEST_GRACE", 5),
+            mock.patch.object(jobs, "time", return_value=1345.0),
+            mock.patch.object(
+                jobs,
+                "search_netflow_resolutions",
+                side_effect=lambda *args: calls.append(args)
+                or {
+                    "all_attributes": {"buckets": fine},
+                    "cardinalities_60s": {"buckets": coarse},
+                },
+            ),
+            mock.patch.object(jobs, "get_netflow_resolutions") as get_netflow,
+        ):
+            result = jobs.search_resolutions([20, 60], "127.0.0.1", "netflow", 120)
+
+        get_netflow.assert_not_called()
+        self.assertEqual(calls[0][0], 1340000)
+        self.assertEqual(len(result[20]), 6)
+        self.assertEqual(result[60]["key"].tolist(), [1200000, 1260000])
+
+    def test_ticks_read_the_newest_bucket_whole(self):
+        """a tick should search from a boundary before the newest closed bucket"""
+        detector_instance = SimpleNamespace(
+            device="router-lookback",
+            window_size=10,
+            sampling_interval=20,
+            resolutions="",
+            overrun_policy="skip",
+            algorithm="beta",
+        )
+        state = nescient.detector_state(detector_instance, 20)
+        try:
+            with mock.patch.object(jobs, "time", return_value=1013.5):
+                # Newest closed bucket [980, 1000), its predecessor judged
+                for last_key in (None, 960000):
+                    state.last_key = last_key
+                    lookback = jobs.fetch_lookback(detector_instance, [20], False)
+                    self.assertTrue(960 <= 1013.5 - lookback <= 961)
+                # Ticks missed, only catch_up reads back to the last judged one
+                state.last_key = 900000
+                self.assertEqual(
+                    jobs.fetch_lookback(detector_instance, [20], False), 53
+                )
+                detector_instance.overrun_policy = "catch_up"
+                self.assertEqual(
+                    jobs.fetch_lookback(detector_instance, [20], False), 113
+                )
+        finally:
+            drop_state("router-lookback")
+
+
+class TestBoundedRuns(SimpleTestCase):
+    def detector(self):
+        return SimpleNamespace(
+            device="router-bounded",
+            window_size=5,
+            sampling_interval=20,
+            resolutions="",
+            overrun_policy="skip",
+            algorithm="beta",
+            history_length=100,
+        )
+
+    def test_attribution_timeout_keeps_the_verdicts(self):
+        """verdicts should still be logged when attribution runs out of time"""
+        detector_instance = SimpleNamespace(
+            device=Device(hostname="router-bounded", mgmt_ipaddr="10.0.0.9"),
+            elastic_host="127.0.0.1",
+            elastic_index="netflow",
+            sampling_interval=20,
+        )
+        data = np.zeros(2, dtype=[("key", np.int64)])
+        data["key"] = [0, 20000]
+        N = np.ones((4, 2), dtype=bool)
+        N[:, 0] = False
+        with (
+            mock.patch.object(
+                nescient, "get_netflow_data_after", side_effect=DeadlineExceeded
+            ),
+            mock.patch.object(nescient, "activity_log") as activity_log,
+            mock.patch.object(nescient, "getAclDetail") as get_acl,
+            mock.patch.object(nescient, "print", create=True),
+        ):
+            nescient.handle_result(range(2), N, data, detector_instance)
+        messages = [call.args[3] for call in activity_log.call_args_list]
+        self.assertIn("timed out", messages[0])
+        self.assertIn("NEGATIVE no flow attributed", messages[1])
+        self.assertIn("POSITIVE no flow attributed", messages[2])
+        get_acl.assert_not_called()
+
+    def test_waiting_for_buckets_gives_up_at_the_deadline(self):
+        """an empty index should end the wait for buckets at the stage deadline"""
+        empty = {"all_attributes": {"buckets": []}}
+        with (
+            mock.patch.object(
+                elasticclient, "search_netflow_resolutions", return_value=empty
+            ) as search,
+            mock.patch.object(elasticclient, "sleep"),
+        ):
+            with self.assertRaises(DeadlineExceeded):
+                elasticclient.get_netflow_resolutions(
+                    "now", [20], "127.0.0.1", "netflow", deadline=Deadline(0.05)
+                )
+        self.assertGreater(search.call_count, 0)
+
+    def test_flow_lookups_share_one_round_trip(self):
+        """the flows of every bucket should come from one bounded _msearch"""
+        flow = {"source_ipv4_address": "198.51.100.7"}
+        hit = {"hits": {"hits": [{"_source": {"netflow": flow}}]}}
+        miss = {"hits": {"hits": []}}
+        with mock.patch.object(
+            elasticclient, "request", return_value={"responses": [hit, miss]}
+        ) as request:
+            flows = elasticclient.get_netflow_data_after(
+                [20, 0, 20], 20, "127.0.0.1", "netflow", deadline=Deadline(5)
+            )
+        request.assert_called_once()
+        self.assertEqual(request.call_args.args[1], "msearch")
+        searches = request.call_args.kwargs["searches"]
+        ranges = [
+            search["query"]["bool"]["filter"][0]["range"]["@timestamp"]
+            for search in searches[1::2]
+        ]
+        self.assertEqual(
+            [(r["gte"], r["lt"]) for r in ranges], [(0, 20000), (20000, 40000)]
+        )
+        self.assertEqual(flows, [None, flow, None])
+
+        with mock.patch.object(
+            elasticclient, "request", return_value={"responses": [hit]}
+        ) as request:
+            elasticclient.get_netflow_data_after(
+                [0],
+                20,
+                "127.0.0.1",
+                "netflow",
+                "10.0.0.0/24",
+                "observer.ip",
+                "10.0.0.9",
+            )
+        filters = request.call_args.kwargs["searches"][1]["query"]["bool"]["filter"]
+        self.assertIn(
+            {"term": {"netflow.destination_ipv4_address": "10.0.0.0/24"}}, filters
+        )
+        self.assertIn({"term": {"observer.ip": "10.0.0.9"}}, filters)
+
+        failed = {"error": {"type": "search_phase_execution_exception"}}
+        with mock.patch.object(
+            elasticclient, "request", return_value={"responses": [hit, failed]}
+        ):
+            with self.assertRaises(elasticclient.SearchError):
+                elasticclient.get_netflow_data_after(
+                    [0, 20], 20, "127.0.0.1", "netflow"
+                )
+
+    def test_timed_out_and_cancelled_ticks_are_counted(self):
+        """a tick past its deadline or cancelled should end quietly and be counted"""
+        detector_instance = self.detector()
+
+        def cancel(*args):
+            cancel_run("router-bounded")
+            stage_deadline("fetch").check()
+
+        try:
+            with (
+                mock.patch.object(settings, "DETECTOR_COUNTER_SCREEN", False),
+                mock.patch.object(
+                    jobs, "fetch_resolutions", side_effect=DeadlineExceeded()
+                ),
+                mock.patch.object(jobs, "activity_log") as activity_log,
+            ):
+                jobs.detector_job(detector_instance)
+            activity_log.assert_called_once()
+            with (
+                mock.patch.object(settings, "DETECTOR_COUNTER_SCREEN", False),
+                mock.patch.object(jobs, "fetch_resolutions", side_effect=cancel),
+            ):
+                jobs.detector_job(detector_instance)
+            summary = tick_summary("router-bounded")
+            self.assertEqual(summary["timed_out"], 1)
+            self.assertEqual(summary["cancelled"], 1)
+            self.assertEqual(summary["overrun"], 0)
+        finally:
+            tick_counters.clear()
+
+    def test_overlapped_ticks_run_after_the_run(self):
+        """a tick overlapping a run should run once after it unless skipped"""
+        for policy, fetches, outcome in (
+            ("coalesce", 2, "late"),
+            ("skip", 1, "dropped"),
+        ):
+            detector_instance = self.detector()
+            detector_instance.overrun_policy = policy
+            overlapped = SimpleNamespace(
+                code=EVENT_JOB_MAX_INSTANCES, job_id="router-bounded"
+            )
+
+            def fetch(*args):
+                # Two ticks rejected during the first run, one runs after it
+                if fetch.call_count == 1:
+                    jobs.tick_listener(overlapped)
+                    jobs.tick_listener(overlapped)
+                return {}
+
+            try:
+                with (
+                    mock.patch.object(settings, "DETECTOR_COUNTER_SCREEN", False),
+                    mock.patch.object(
+                        jobs, "fetch_resolutions", side_effect=fetch
+                    ) as fetch,
+                    mock.patch.object(jobs, "stream_resolutions"),
+                    mock.patch.object(jobs, "print", create=True),
+                ):
+                    jobs.detector_job(detector_instance)
+                self.assertEqual(fetch.call_count, fetches)
+                self.assertEqual(tick_summary("router-bounded")[outcome], 2)
+            finally:
+                tick_counters.clear()
+
+    def test_scheduler_events_are_counted(self):
+        """ticks dropped by max_instances or missed should be counted"""
+        try:
+            for code in (EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED):
+                jobs.tick_listener(SimpleNamespace(code=code, job_id="router-bounded"))
+            jobs.tick_listener(
+                SimpleNamespace(
+                    code=EVENT_JOB_SUBMITTED,
+                    job_id="router-bounded",
+                    scheduled_run_times=[datetime.now(timezone.utc)],
+                )
+            )
+            summary = tick_summary("router-bounded")
+            self.assertEqual(summary["dropped"], 1)
+            self.assertEqual(summary["late"], 1)
+        finally:
+            tick_counters.clear()
+
+
+class TestStaggeredTicks(SimpleTestCase):
+    def test_detectors_tick_on_their_own_phase(self):
+        """detectors sharing an interval should tick on distinct, stable phases"""
+        with (
+            mock.patch.object(settings, "DETECTOR_ALIGNED_TICKS", True),
+            mock.patch.object(settings, "DETECTOR_INGEST_GRACE", 5),
+            mock.patch.object(settings, "DETECTOR_STAGGER_TICKS", True),
+            mock.patch.object(settings, "DETECTOR_TICK_JITTER", 2),
+        ):
+            phases = [jobs.tick_phase("router-%s" % (idx), 60) for idx in range(200)]
+            trigger = jobs.tick_trigger(60, "router-7")
+        self.assertEqual(
+            phases, [jobs.tick_phase("router-%s" % (idx), 60) for idx in range(200)]
+        )
+        self.assertTrue(all(0 <= phase < 60 for phase in phases))
+        # Roughly uniform over the interval
+        counts = np.histogram(phases, bins=4, range=(0, 60))[0]
+        self.assertTrue((counts > 25).all())
+        offset = (trigger.start_date.timestamp() - 5 - phases[7]) % 60
+        self.assertLess(min(offset, 60 - offset), 0.001)
+        self.assertEqual(trigger.jitter, 2)
+
+
+class TestShards(TestCase):
+    def setUp(self):
+        for hostname in ("router-a", "router-b"):
+            Detector.objects.create(
+                device=Device.objects.create(
+                    hostname=hostname,
+                    mgmt_ipaddr="10.0.0.1",
+                    username="admin",
+                    secret="secret",
+                ),
+                device_interface_to_filebeat="Gi1",
+                device_interface_to_server="Gi2",
+                elastic_index="netflow",
+                filebeat_host="10.0.0.2",
+                is_running=True,
+            )
+
+    def tearDown(self):
+        jobs.node_ring = None
+        jobs.last_heartbeat = None
+        jobs.scheduled_detectors.clear()
+
+    def test_ring_moves_few_detectors(self):
+        """a joining node should take an even share and move nothing else"""
+        devices = ["router-%s" % (idx) for idx in range(2000)]
+        ring = HashRing(["node-1", "node-2", "node-3"])
+        grown = HashRing(["node-1", "node-2", "node-3", "node-4"])
+        before = [ring.owner(device) for device in devices]
+        after = [grown.owner(device) for device in devices]
+        moved = [old for old, new in zip(before, after) if old != new]
+        self.assertTrue(all(new == "node-4" for new in set(after) - set(before)))
+        self.assertEqual(sum(new == "node-4" for new in after), len(moved))
+        self.assertTrue(300 < len(moved) < 700)
+        self.assertIsNone(HashRing([]).owner("router-1"))
+
+    def test_heartbeat_ring_has_live_nodes(self):
+        """nodes should leave the ring once their heartbeat lapses"""
+        now = datetime(2024, 4, 25, tzinfo=timezone.utc)
+        with mock.patch.object(shards, "node_name", "node-1"):
+            shards.heartbeat(now)
+        later = now + timedelta(seconds=settings.ENGINE_HEARTBEAT_SECONDS - 1)
+        with mock.patch.object(shards, "node_name", "node-2"):
+            self.assertEqual(shards.heartbeat(later).nodes, ["node-1", "node-2"])
+            lapsed = later + timedelta(seconds=2)
+            self.assertEqual(shards.heartbeat(lapsed).nodes, ["node-2"])
+            shards.leave()
+        self.assertEqual(EngineNode.objects.get().name, "node-1")
+
+    def test_nodes_schedule_their_own_shard(self):
+        """each node should schedule its running detectors once the ring settles"""
+        ring = HashRing(["node-1", "node-2"])
+        owned = {}
+        for node in ring.nodes:
+            with (
+                mock.patch.object(jobs, "node_name", node),
+                mock.patch.object(jobs, "heartbeat"),
+                mock.patch.object(jobs, "schedule_detector") as schedule,
+                mock.patch.object(jobs, "unschedule_detector") as unschedule,
+            ):
+                jobs.reconcile_detectors(ring)
+                schedule.assert_not_called()
+                jobs.reconcile_detectors(ring, ring)
+                owned[node] = [
+                    str(call.args[0].device) for call in schedule.call_args_list
+                ]
+                unschedule.assert_not_called()
+        self.assertEqual(sorted(sum(owned.values(), [])), ["router-a", "router-b"])
+        for node, devices in owned.items():
+            self.assertTrue(all(ring.owner(device) == node for device in devices))
+
+        with (
+            mock.patch.object(jobs, "node_name", "node-1"),
+            mock.patch.object(jobs, "heartbeat", side_effect=DatabaseError),
+            mock.patch.object(jobs, "unschedule_detector") as unschedule,
+        ):
+            jobs.node_ring = ring
+            jobs.scheduled_detectors["router-a"] = None
+            jobs.heartbeat_job()
+        self.assertIsNone(jobs.node_ring)
+        unschedule.assert_called_once_with("router-a")
+
+    def test_heartbeat_has_its_own_thread(self):
+        """heartbeats should not wait behind detector ticks nor be dropped late"""
+        with (
+            mock.patch.object(jobs, "scheduler") as scheduler,
+            mock.patch.object(jobs, "atexit"),
+        ):
+            jobs.start_scheduling()
+        options = scheduler.add_job.call_args.kwargs
+        self.assertEqual(options["executor"], "heartbeat")
+        self.assertIsNone(options["misfire_grace_time"])
+        self.assertIn("heartbeat", jobs.scheduler._executors)
+
+    def test_lapsed_node_stops_its_jobs(self):
+        """a node past its heartbeat timeout should drop its shard, not tick it"""
+        detector_instance = Detector.objects.get(device="router-a")
+        jobs.last_heartbeat = jobs.timer() - settings.ENGINE_HEARTBEAT_SECONDS - 1
+        with (
+            mock.patch.object(jobs, "fetch_resolutions") as fetch,
+            mock.patch.object(jobs, "unschedule_detector") as unschedule,
+        ):
+            jobs.scheduled_detectors["router-a"] = detector_instance
+            jobs.detector_job(detector_instance)
+        fetch.assert_not_called()
+        unschedule.assert_called_once_with("router-a")
+
+        ring = HashRing([shards.node_name])
+        jobs.node_ring = ring
+        with (
+            mock.patch.object(jobs, "heartbeat", return_value=ring),
+            mock.patch.object(jobs, "schedule_detector") as schedule,
+        ):
+            jobs.heartbeat_job()
+            # Rejoining, the shard is only taken back on the next heartbeat
+            schedule.assert_not_called()
+            jobs.heartbeat_job()
+        self.assertEqual(schedule.call_count, 2)
+        self.assertFalse(jobs.shard_lapsed())
+
+
+class TestDetectorWorker(SimpleTestCase):
+    def test_worker_joins_and_leaves(self):
+        """the worker should join the engine nodes and hand its shard over on exit"""
+        stopped = Event()
+        stopped.set()
+        with (
+            mock.patch.object(detector_worker, "Event", return_value=stopped),
+            mock.patch.object(detector_worker, "signal"),
+            mock.patch.object(detector_worker, "scheduler") as scheduler,
+            mock.patch.object(detector_worker, "start_scheduling") as start,
+            mock.patch.object(detector_worker, "leave_membership") as leave,
+            mock.patch.object(detector_worker, "unschedule_all") as unschedule,
+        ):
+            call_command("detector_worker", metrics_port=0, stdout=StringIO())
+        scheduler.start.assert_called_once()
+        start.assert_called_once()
+        leave.assert_called_once()
+        unschedule.assert_called_once()
+        scheduler.shutdown.assert_called_once()
+
+    def test_worker_serves_its_own_detectors(self):
+        """the worker endpoint should serve metrics and summaries of its shard"""
+        server = ThreadingHTTPServer(("127.0.0.1", 0), detector_worker.MetricsHandler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:%s" % (server.server_address[1])
+        try:
+            jobs.scheduled_detectors["router-worker"] = None
+            with urlopen(url + "/metrics") as response:
+                self.assertIn(b"retia_detector_ticks_total", response.read())
+            with urlopen(url + "/detector/router-worker/ticks") as response:
+                self.assertEqual(json.load(response)["late"], 0)
+            with self.assertRaises(HTTPError):
+                urlopen(url + "/detector/router-elsewhere/latency")
+        finally:
+            jobs.scheduled_detectors.clear()
+            server.shutdown()
+            server.server_close()
+
+    def test_management_commands_leave_the_scheduler_alone(self):
+        """only the web server should autostart the scheduler"""
+        with mock.patch.object(sys, "argv", ["manage.py", "migrate"]):
+            self.assertTrue(management_command())
+        with mock.patch.object(sys, "argv", ["manage.py", "runserver"]):
+            self.assertFalse(management_command())
+        with mock.patch.object(sys, "argv", ["daphne", "app"]):
+            self.assertFalse(management_command())